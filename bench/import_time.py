@@ -0,0 +1,62 @@
+"""Measures the time it takes to import kmvid.
+
+Each measurement is done in a fresh interpreter so that nothing is
+cached in sys.modules. Run with:
+
+    > uv run bench/import_time.py [module] [runs]
+
+"""
+import os
+import os.path
+import statistics
+import subprocess
+import sys
+
+_SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+_CODE = """
+import time
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+import sys
+print(t, ",".join(m for m in ("numpy", "scipy") if m in sys.modules))
+"""
+
+def measure(module="kmvid.script", runs=10):
+    """Returns a list of import times in seconds, one for each run, and
+    the heavy modules that got loaded as part of the import.
+
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [_SRC_PATH] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    times = []
+    heavy = ""
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", _CODE % module],
+                                capture_output = True,
+                                text = True,
+                                env = env,
+                                check = True)
+        t, _, heavy = result.stdout.strip().partition(" ")
+        times.append(float(t))
+
+    return times, heavy
+
+def run():
+    module = sys.argv[1] if len(sys.argv) > 1 else "kmvid.script"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    times, heavy = measure(module, runs)
+
+    print("import %s" % module)
+    print("    runs    %d" % runs)
+    print("    median  %.1f ms" % (statistics.median(times) * 1000))
+    print("    min     %.1f ms" % (min(times) * 1000))
+    print("    max     %.1f ms" % (max(times) * 1000))
+    print("    heavy   %s" % (heavy or "-"))
+
+if __name__ == '__main__':
+    run()
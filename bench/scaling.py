@@ -0,0 +1,196 @@
+"""Measures how rendering scales with project size using the
+synthetic projects from bench/stress.py.
+
+Each sweep varies one parameter (clips, depth, keyframes or videos)
+with the others at their base values. Every point runs in a fresh
+interpreter so that memory measurements don't carry over. Run with:
+
+    > uv run bench/scaling.py -o scaling.json
+    > uv run bench/scaling.py --sweep clips --sweep depth --quick
+
+For each point the time to build the project, serialize it to json,
+load it back and render a frame is measured, along with the peak
+memory growth and the python memory held by the project tree. The
+printed exponent is the slope between neighbouring points on a log-log
+scale, 1 is linear and anything clearly above it is superlinear.
+
+"""
+import argparse
+import json
+import math
+import os
+import os.path
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stress
+
+import kmvid.data.common as common
+import kmvid.data.project as project
+
+BASE = {'clips': 100, 'depth': 1, 'keyframes': 0, 'videos': 0}
+
+SWEEPS = {
+    'clips': [10, 100, 1000, 10000],
+    'depth': [1, 4, 16, 64],
+    'keyframes': [10, 100, 1000, 10000],
+    'videos': [1, 2, 4, 8],
+}
+
+# measurements for which exponents are printed
+METRICS = ['build', 'serialize', 'deserialize', 'frame', 'rss_bytes', 'tree_bytes']
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def measure_point(params, frames=5):
+    """Builds a project from params and returns a dict of measurements.
+    Run in a separate process, see run_point.
+
+    frames -- Number of frames rendered, spread over the duration. The
+    median frame time is reported.
+
+    """
+    # generate videos up front so that build doesn't include ffmpeg
+    stress.get_test_videos(params.get('videos', 0), 640, 360, 2, 25)
+
+    base_rss = project._get_peak_rss()
+
+    proj, build = _timed(lambda: stress.make_project(**params))
+    data, serialize = _timed(lambda: proj.to_simple().get_json())
+
+    def deserialize():
+        simple = common.Simple()
+        simple.data = json.loads(data)
+        return project.Project.from_simple(simple)
+    _, deserialize_time = _timed(deserialize)
+
+    duration = proj.duration
+    times = []
+    with proj.session() as session:
+        # the first frame includes opening resources
+        _, first_frame = _timed(lambda: session.get_frame(0))
+        for n in range(1, frames + 1):
+            _, t = _timed(lambda: session.get_frame(duration * n / (frames + 1)))
+            times.append(t)
+
+    peak_rss = project._get_peak_rss()
+
+    tracemalloc.start()
+    proj = stress.make_project(**params)
+    tree_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return {
+        'params': params,
+        'build': build,
+        'serialize': serialize,
+        'deserialize': deserialize_time,
+        'json_bytes': len(data),
+        'first_frame': first_frame,
+        'frame': statistics.median(times) if times else None,
+        'rss_bytes': (peak_rss - base_rss
+                      if peak_rss is not None and base_rss is not None
+                      else None),
+        'tree_bytes': tree_bytes,
+    }
+
+def run_point(params, frames=5):
+    """Runs measure_point in a fresh interpreter and returns the
+    result.
+
+    """
+    result = subprocess.run([sys.executable, os.path.abspath(__file__),
+                             "point", json.dumps(params), "--frames", str(frames)],
+                            capture_output = True,
+                            text = True,
+                            check = True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def get_exponents(points, param, metric):
+    """Returns the log-log slopes of metric between neighbouring points,
+    None where either value is missing or zero.
+
+    """
+    exponents = []
+    for a, b in zip(points, points[1:]):
+        x0, x1 = a['params'][param], b['params'][param]
+        y0, y1 = a[metric], b[metric]
+        if not (x0 and x1 and y0 and y1) or x0 == x1:
+            exponents.append(None)
+        else:
+            exponents.append(math.log(y1 / y0) / math.log(x1 / x0))
+    return exponents
+
+def _format_value(metric, value):
+    if value is None:
+        return "-"
+    if metric.endswith('_bytes'):
+        return "%.1f MB" % (value / 1e6)
+    return "%.2f ms" % (value * 1000)
+
+def print_sweep(param, points):
+    print("%s (base %s)" % (param, ", ".join("%s=%s" % (k, v)
+                                              for k, v in BASE.items()
+                                              if k != param)))
+    print("    %-10s" % param + "".join("%14s" % m for m in METRICS))
+    for point in points:
+        print("    %-10s" % point['params'][param] +
+              "".join("%14s" % _format_value(m, point[m]) for m in METRICS))
+
+    exponents = {m: get_exponents(points, param, m) for m in METRICS}
+    for n in range(len(points) - 1):
+        print("    %-10s" % "exponent" +
+              "".join("%14s" % ("-" if exponents[m][n] is None
+                                else "%.2f" % exponents[m][n])
+                      for m in METRICS))
+    print()
+
+def run_sweeps(options):
+    sweeps = options.sweep or list(SWEEPS)
+    if options.videos is False:
+        sweeps = [s for s in sweeps if s != 'videos']
+
+    data = {'base': BASE, 'sweeps': {}}
+    for param in sweeps:
+        values = SWEEPS[param][:-1] if options.quick else SWEEPS[param]
+        points = []
+        for value in values:
+            params = dict(BASE)
+            params[param] = value
+            points.append(run_point(params, options.frames))
+        data['sweeps'][param] = points
+        print_sweep(param, points)
+
+    if options.output:
+        with open(options.output, 'w', encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+def run():
+    parser = argparse.ArgumentParser(description="kmvid scaling curves")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "point"])
+    parser.add_argument("params", nargs="?", help="json parameters for point")
+    parser.add_argument("-o", "--output", help="json file to write results to")
+    parser.add_argument("--sweep", action="append", choices=list(SWEEPS),
+                        help="parameter to sweep, may be repeated, default all")
+    parser.add_argument("--frames", type=int, default=5)
+    parser.add_argument("--no-videos", dest="videos", action="store_false",
+                        help="skip the videos sweep, which needs ffmpeg")
+    parser.add_argument("--quick", action="store_true",
+                        help="skip the largest value of each sweep")
+
+    options = parser.parse_args()
+    if options.command == "point":
+        print(json.dumps(measure_point(json.loads(options.params), options.frames)))
+    else:
+        run_sweeps(options)
+
+if __name__ == '__main__':
+    run()
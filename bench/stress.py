@@ -0,0 +1,121 @@
+"""Builds synthetic projects for stress testing and scaling
+measurements, see bench/scaling.py.
+
+    import stress
+    proj = stress.make_project(clips=1000, depth=4, keyframes=100)
+
+Clips are small color tiles spread over the frame. Videos are
+generated locally with ffmpeg's test source and cached in a
+directory, so ffmpeg is only needed when videos is above 0.
+
+"""
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+
+_ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(_ROOT_PATH, "src"))
+
+import kmvid.data.clip as clip
+import kmvid.data.effect as effect
+import kmvid.data.ffmpeg as ffmpeg
+import kmvid.data.project as project
+
+_VIDEO_DIR = os.path.join(tempfile.gettempdir(), "kmvid_stress")
+
+# lavfi sources used for video layers, cycled through so that
+# neighbouring layers differ
+_VIDEO_SOURCES = ["testsrc", "testsrc2", "smptebars", "rgbtestsrc"]
+
+def make_test_video(path, width, height, duration, fps, source="testsrc"):
+    """Writes a test pattern video to path unless it already exists and
+    returns path.
+
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp.mp4"
+        subprocess.run([ffmpeg._FFMPEG_PATH,
+                        '-y', '-loglevel', 'quiet',
+                        '-f', 'lavfi',
+                        '-i', '%s=size=%dx%d:rate=%s' % (source, width, height, fps),
+                        '-t', str(duration),
+                        '-pix_fmt', 'yuv420p',
+                        tmp],
+                       check = True)
+        os.replace(tmp, path)
+    return path
+
+def get_test_videos(count, width, height, duration, fps, video_dir=None):
+    """Returns paths to count distinct test videos, generating the ones
+    that don't exist yet.
+
+    """
+    video_dir = video_dir or _VIDEO_DIR
+    paths = []
+    for n in range(count):
+        source = _VIDEO_SOURCES[n % len(_VIDEO_SOURCES)]
+        name = "%s_%d_%dx%d_%gs_%gfps.mp4" % (source, n, width, height, duration, fps)
+        paths.append(make_test_video(os.path.join(video_dir, name),
+                                     width, height, duration, fps, source))
+    return paths
+
+def _make_keyframes(value, count, duration, amplitude):
+    if count <= 1:
+        return value
+    return {duration * n / (count - 1): value + (amplitude if n % 2 else 0)
+            for n in range(count)}
+
+def _make_tile(n, size, depth):
+    hue = (n * 37) % 256
+    tile = clip.color(color=(hue, 255 - hue, (n * 11) % 256, 255),
+                      width=size, height=size)
+
+    # each level adds a transparent clip of the same size, so the
+    # cost per level is one extra paste of the tile
+    for _ in range(depth - 1):
+        tile = clip.color(color=(0, 0, 0, 0), width=size, height=size).add(tile)
+
+    return tile
+
+def make_project(clips=10, depth=1, keyframes=0, videos=0, width=640,
+                 height=360, duration=2, fps=25, tile_size=16, video_dir=None):
+    """Returns a project with the given amount of synthetic content.
+
+    clips -- Number of color tiles.
+
+    depth -- Nesting depth of each tile, 1 adds the tiles directly to
+    the root clip.
+
+    keyframes -- Number of keyframes on the x and y position of each
+    tile, 0 for static positions.
+
+    videos -- Number of video layers covering the frame, drawn below
+    the tiles with partial transparency. Each layer reads a separate
+    file.
+
+    tile_size -- Width and height of the tiles in pixels.
+
+    video_dir -- Directory to cache generated videos in.
+
+    """
+    proj = project.Project(width=width, height=height, fps=fps,
+                           duration=duration)
+
+    for path in get_test_videos(videos, width, height, duration, fps, video_dir):
+        proj.add(clip.video(path).add(effect.Fade(value=0.5)))
+
+    cols = max(1, (width - tile_size) // tile_size)
+    rows = max(1, (height - tile_size) // tile_size)
+    for n in range(clips):
+        x = (n % cols) * tile_size
+        y = ((n // cols) % rows) * tile_size
+        tile = _make_tile(n, tile_size, depth)
+        tile.add(effect.Pos(
+            x = _make_keyframes(x, keyframes, duration, tile_size // 2),
+            y = _make_keyframes(y, keyframes, duration, tile_size // 2)))
+        proj.add(tile)
+
+    return proj
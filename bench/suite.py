@@ -0,0 +1,300 @@
+"""Performance benchmarks with stored baselines.
+
+Covers effects at several resolutions, variable and expression
+evaluation, text wrapping and fitting, ffmpeg read and write
+throughput and full renders of the examples. Run with:
+
+    > uv run bench/suite.py run -o bench/baseline.json
+    > uv run bench/suite.py run -o results.json
+    > uv run bench/suite.py compare bench/baseline.json results.json
+
+compare exits with code 1 if any benchmark is slower than the
+baseline by more than the threshold (default 10%). Use -k to only run
+benchmarks containing the given text and --quick for fewer repeats
+and shorter example renders. ffmpeg benchmarks are skipped if ffmpeg
+is not installed.
+
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import os.path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+_ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(_ROOT_PATH, "src"))
+
+import kmvid.data.clip as clip
+import kmvid.data.effect as effect
+import kmvid.data.expression as expression
+import kmvid.data.ffmpeg as ffmpeg
+import kmvid.data.project as project
+import kmvid.data.state as state
+import kmvid.data.text as text
+import kmvid.data.variable as variable
+
+import PIL.Image
+
+RESOLUTIONS = [(320, 180), (1280, 720), (1920, 1080)]
+
+# effect name -> function returning the effect for a clip of size (w, h)
+EFFECTS = {
+    'pos': lambda w, h: effect.Pos(horizontal=0.5, vertical=0.5),
+    'resize': lambda w, h: effect.Resize(width=w // 2),
+    'rotate': lambda w, h: effect.Rotate(33),
+    'fade': lambda w, h: effect.Fade(value=0.5),
+    'crop': lambda w, h: effect.Crop(left=10, top=10, right=10, bottom=10),
+    'draw': lambda w, h: (effect.Draw()
+                          .config(fill=(255, 0, 0), color=(0, 0, 0), pen_width=3)
+                          .rectangle(10, 10, w // 2, h // 2)
+                          .ellipse(w // 2, h // 2, w // 3, h // 3)),
+    'border': lambda w, h: effect.Border(width=10, all=dict(size=h // 10)),
+    'alpha_shape': lambda w, h: effect.AlphaShape(x=0, y=0, w=w, h=0, size=w // 4),
+    'blur': lambda w, h: effect.Blur(x=4, y=4),
+}
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim "
+         "ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut "
+         "aliquip ex ea commodo consequat.")
+
+def measure(fn, repeat=5, number=1):
+    """Calls fn number times per run and returns the seconds per call
+    for each of repeat runs.
+
+    """
+    fn() # warm up caches and lazy imports
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+def bench_effects(options):
+    for effect_name, make_effect in EFFECTS.items():
+        for w, h in RESOLUTIONS:
+            root = clip.color(color=(20, 20, 20), width=w, height=h)
+            c = clip.color(color=(200, 100, 50, 255), width=w, height=h)
+            c.add(make_effect(w, h))
+            root.add(c)
+
+            def render():
+                with state.State():
+                    root.get_frame()
+
+            yield "effect.%s.%dx%d" % (effect_name, w, h), render, 1
+
+def bench_variables(options):
+    static = variable.Variable(variable.VariableConfig(int))
+    static.set_value(10)
+
+    keyframes = variable.Variable(variable.VariableConfig(float))
+    keyframes.set_value({t: float(t % 7) for t in range(1000)})
+
+    expr = variable.Variable(variable.VariableConfig(float))
+    expr.set_value(expression.parse(('+', ('*', 'time', 2), ('/', 'time', 3), 1)))
+
+    def evaluate(var):
+        def fn():
+            with state.State():
+                for n in range(1000):
+                    state.set_time(n * 0.999)
+                    var.get_value()
+        return fn
+
+    yield "variable.static.1000", evaluate(static), 1
+    yield "variable.keyframes.1000", evaluate(keyframes), 1
+    yield "variable.expression.1000", evaluate(expr), 1
+
+def bench_text(options):
+    # fit_font looks fonts up by name so it needs a registered font
+    text.font_cache.preload()
+    if not text.font_cache.font_data:
+        print("no fonts registered, skipping text benchmarks")
+        return
+
+    name = sorted(text.font_cache.font_data)[0]
+    variant = sorted(text.font_cache.font_data[name].get_variants())[0]
+    font = text.get_font(name, 24, variant)
+
+    yield "text.wrap", lambda: text.wrap_text(font, LOREM, 300), 10
+    yield "text.fit", lambda: text.fit_font(font, LOREM[:60], 500), 10
+
+def _has_ffmpeg():
+    return (shutil.which(ffmpeg._FFMPEG_PATH) is not None and
+            shutil.which(ffmpeg._FFPROBE_PATH) is not None)
+
+def bench_ffmpeg(options):
+    if not _has_ffmpeg():
+        print("ffmpeg not found, skipping ffmpeg benchmarks")
+        return
+
+    tmp = tempfile.mkdtemp()
+    try:
+        yield from _bench_ffmpeg(tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def _bench_ffmpeg(tmp):
+    frames = 50
+    for w, h in RESOLUTIONS:
+        path = os.path.join(tmp, "video_%dx%d.mp4" % (w, h))
+        subprocess.run([ffmpeg._FFMPEG_PATH,
+                        '-y', '-loglevel', 'quiet',
+                        '-f', 'lavfi',
+                        '-i', 'testsrc=size=%dx%d:rate=25' % (w, h),
+                        '-t', str(frames / 25),
+                        '-pix_fmt', 'yuv420p',
+                        path],
+                       check = True)
+
+        def read(path=path):
+            with ffmpeg.FfmpegReader(path) as reader:
+                for n in range(frames):
+                    reader.get_frame(n / 25)
+
+        image = PIL.Image.new("RGB", (w, h), (100, 150, 200))
+
+        def write(w=w, h=h, image=image):
+            with ffmpeg.FfmpegWriter(os.path.join(tmp, "out.mp4"), (w, h), 25,
+                                     preset="ultrafast") as writer:
+                for n in range(frames):
+                    writer.write_frame(image)
+
+        yield "ffmpeg.read.%dx%d.%dframes" % (w, h, frames), read, 1
+        yield "ffmpeg.write.%dx%d.%dframes" % (w, h, frames), write, 1
+
+def _load_example(name):
+    path = os.path.join(_ROOT_PATH, "example", name + ".py")
+    spec = importlib.util.spec_from_file_location("example_" + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bench_examples(options):
+    for name in ["cards", "text_blocks"]:
+        module = _load_example(name)
+
+        def render(module=module):
+            # run the example with write replaced by rendering the
+            # frames without encoding them
+            write = project.Project.write
+
+            def render_frames(proj):
+                step = 10 / proj.fps if options.quick else None
+                for frame in proj.iter_frames(step=step):
+                    pass
+
+            project.Project.write = render_frames
+            try:
+                module.run()
+            finally:
+                project.Project.write = write
+
+        yield "example.%s" % name, render, 1
+
+SUITES = [bench_effects, bench_variables, bench_text, bench_ffmpeg, bench_examples]
+
+def run_suite(options):
+    repeat = 2 if options.quick else options.repeat
+    results = {}
+
+    for suite in SUITES:
+        for name, fn, number in suite(options):
+            if options.k and options.k not in name:
+                continue
+
+            try:
+                times = measure(fn, repeat, number)
+            except Exception as e:
+                # e.g. examples using fonts that aren't installed
+                print("%-40s failed: %s" % (name, e))
+                continue
+
+            results[name] = {
+                'median': statistics.median(times),
+                'min': min(times),
+                'runs': repeat,
+            }
+            print("%-40s %10.3f ms" % (name, results[name]['median'] * 1000))
+
+    data = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': options.quick,
+        },
+        'results': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w', encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+def compare(baseline, results, threshold):
+    """Returns a list of (name, baseline seconds, result seconds, ratio,
+    regressed) for benchmarks present in both.
+
+    """
+    rows = []
+    for name, base in baseline['results'].items():
+        result = results['results'].get(name)
+        if result is None:
+            continue
+        ratio = result['median'] / base['median'] if base['median'] else 1
+        rows.append((name, base['median'], result['median'], ratio,
+                     ratio > 1 + threshold))
+    return rows
+
+def run_compare(options):
+    with open(options.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(options.results, encoding="utf-8") as f:
+        results = json.load(f)
+
+    rows = compare(baseline, results, options.threshold)
+    for name, base, result, ratio, regressed in rows:
+        print("%-40s %10.3f ms %10.3f ms %+7.1f%% %s" % (
+            name, base * 1000, result * 1000, (ratio - 1) * 100,
+            "REGRESSION" if regressed else ""))
+
+    regressions = [row for row in rows if row[4]]
+    print("%d benchmarks compared, %d regressions" % (len(rows), len(regressions)))
+    return 1 if regressions else 0
+
+def run():
+    parser = argparse.ArgumentParser(description="kmvid benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("-o", "--output", help="json file to write results to")
+    run_parser.add_argument("-k", help="only run benchmarks containing this text")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--quick", action="store_true",
+                            help="fewer repeats and shorter example renders")
+
+    compare_parser = commands.add_parser("compare", help="compare results to a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="allowed slowdown as a fraction, default 0.1")
+
+    options = parser.parse_args()
+    if options.command == "run":
+        run_suite(options)
+    else:
+        sys.exit(run_compare(options))
+
+if __name__ == '__main__':
+    run()
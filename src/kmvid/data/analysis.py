@@ -0,0 +1,387 @@
+import kmvid.data.clip as clip
+import kmvid.data.effect as effect
+import kmvid.data.ffmpeg as ffmpeg
+import kmvid.data.resource as resource
+import kmvid.data.state as state
+
+import bisect
+import collections
+import itertools
+
+class ResourceAccess:
+    def __init__(self, res, frame_time,
+                 threshold=ffmpeg.ReadPlanner.RESET_THRESHOLD):
+        """Access pattern of a single resource over a render.
+
+        res -- The resource.
+
+        frame_time -- Duration of a source frame, used to tell
+        sequential reads from skips.
+
+        threshold -- Seconds a reader skips ahead by decoding rather
+        than starting a new process.
+
+        """
+        self.resource = res
+        self.name = getattr(res, 'path', None) or type(res).__name__
+        self.frame_time = frame_time
+        self.threshold = threshold
+
+        self.accesses = 0
+        self.first_frame = None
+        self.last_frame = None
+
+        # steps between consecutive source times
+        self.repeats = 0        # same time again
+        self.sequential = 0     # next frame
+        self.skips = 0          # forward, within the reader threshold
+        self.long_skips = 0     # forward, past the reader threshold
+        self.backward_jumps = 0
+
+        # estimated decoder processes by reason, videos only
+        self.spawns = collections.Counter()
+        self.runs = 0           # accesses served by one decoder process
+        self.longest_run = 0
+
+        self._last_time = None
+        self._run = 0
+
+    def add(self, frame, time):
+        self.accesses += 1
+        if self.first_frame is None:
+            self.first_frame = frame
+        self.last_frame = frame
+
+        if self._last_time is not None:
+            step = time - self._last_time
+            if abs(step) < self.frame_time * 1e-6:
+                self.repeats += 1
+            elif step < 0:
+                self.backward_jumps += 1
+            elif step < self.frame_time * 1.5:
+                self.sequential += 1
+            elif step <= self.threshold:
+                self.skips += 1
+            else:
+                self.long_skips += 1
+        self._last_time = time
+
+    def add_spawn(self, reason):
+        self.spawns[reason] += 1
+        self.runs += 1
+        self._run = 0
+
+    def add_run_access(self):
+        self._run += 1
+        self.longest_run = max(self.longest_run, self._run)
+
+    def get_restarts(self):
+        """Returns the estimated number of decoder processes started
+        after the first one.
+
+        """
+        return max(0, sum(self.spawns.values()) - 1)
+
+def _make_planner(res, fps=None):
+    """Returns an ffmpeg.ReadPlanner making the same decisions as the
+    reader of the video resource res.
+
+    """
+    info = res.get_info()
+    return ffmpeg.ReadPlanner(info.fps_exact or fps, (info.width, info.height))
+
+class Analysis:
+    """Result of a dry run over a project timeline, see
+    Project.analyze.
+
+    """
+
+    def __init__(self, frames=0):
+        self.frames = frames
+        self.resources = [] # ResourceAccess objects, in order of first use
+        self.concurrent_readers = {} # path -> max videos reading it in one frame
+        self.peak_active_resources = 0
+        self.peak_open_resources = 0
+        self.peak_open_decoders = 0
+
+    def get_restarts(self):
+        """Returns the estimated number of decoder restarts, processes
+        started after the first one of each video.
+
+        """
+        return sum(r.get_restarts() for r in self.resources)
+
+    def get_summary(self):
+        """Returns a text report of the access patterns."""
+        lines = ["%d frames, %d resources, %d estimated decoder restarts" % (
+            self.frames, len(self.resources), self.get_restarts())]
+        lines.append("peak resources %d active in a frame, %d open, %d decoders" % (
+            self.peak_active_resources,
+            self.peak_open_resources,
+            self.peak_open_decoders))
+
+        for path, count in sorted(self.concurrent_readers.items()):
+            if count > 1:
+                lines.append("%d concurrent readers of %s" % (count, path))
+
+        lines.append("%-32s %8s %6s %6s %6s %6s %6s %8s %8s" % (
+            "resource", "frames", "seq", "repeat", "skip", "long", "back",
+            "restarts", "longest"))
+        for r in self.resources:
+            name = r.name if len(r.name) <= 32 else "..." + r.name[-29:]
+            lines.append("%-32s %8d %6d %6d %6d %6d %6d %8s %8s" % (
+                name, r.accesses, r.sequential, r.repeats, r.skips,
+                r.long_skips, r.backward_jumps,
+                r.get_restarts() if r.spawns else "-",
+                r.longest_run if r.spawns else "-"))
+
+        return "\n".join(lines)
+
+def analyze(root, times, fps):
+    """Walks root at each of the given times the same way rendering
+    does, without reading or drawing anything, and returns an
+    Analysis of how resources are accessed.
+
+    root -- Root clip.
+
+    times -- Iterable of global times.
+
+    fps -- Frame rate of the render, used for resources without a
+    frame rate of their own.
+
+    """
+    analysis = Analysis()
+    accesses = {}   # id(resource) -> ResourceAccess
+    readers = {}    # id(resource) -> ffmpeg.ReadPlanner
+
+    with state.State():
+        for frame, time in enumerate(times):
+            state.set_time(time)
+
+            active = []
+            _walk(root, active)
+
+            per_path = collections.Counter()
+            for clp, source_time in active:
+                res = clp.resource
+                access = accesses.get(id(res))
+                if access is None:
+                    access = ResourceAccess(res, 1 / fps)
+                    if isinstance(res, resource.VideoResource):
+                        reader = _make_planner(res, fps)
+                        readers[id(res)] = reader
+                        access = ResourceAccess(res, reader.frame_time,
+                                                reader.reset_threshold)
+                    accesses[id(res)] = access
+                    analysis.resources.append(access)
+
+                reader = readers.get(id(res))
+                access.add(frame, source_time)
+
+                if reader is not None:
+                    per_path[res.path] += 1
+                    _, reason = reader.plan(source_time)
+                    if reason is not None:
+                        access.add_spawn(reason)
+                    access.add_run_access()
+
+            for path, count in per_path.items():
+                analysis.concurrent_readers[path] = max(
+                    count, analysis.concurrent_readers.get(path, 0))
+
+            # resources stay open until the render is done
+            analysis.peak_active_resources = max(analysis.peak_active_resources,
+                                                 len(active))
+            analysis.frames = frame + 1
+
+    analysis.peak_open_resources = len(accesses)
+    analysis.peak_open_decoders = len(readers)
+    return analysis
+
+def _walk(clp, active):
+    """Appends (clip, source time) for clp and its active sub-clips to
+    active, following Clip._get_frame_internal.
+
+    """
+    frame_time = state.local_time
+    if clp._time_map:
+        frame_time = clp._time_map.get(state.local_time)
+    active.append((clp, frame_time))
+
+    for item in clp.items:
+        if isinstance(item, clip.Clip):
+            start_time = item.start_time
+            duration = item.duration
+
+            if (start_time <= state.local_time and
+                (duration is None or
+                 state.local_time < start_time + duration)):
+                with state.AdjustLocalTime(start_time):
+                    _walk(item, active)
+
+class CostModel:
+    """Estimated seconds to render parts of a frame, used to balance
+    work between parallel renders.
+
+    Costs are in seconds per megapixel of the clip size, so that
+    layers of different resolutions compare. The defaults are rough
+    figures from bench/suite.py, use from_profiler to calibrate them
+    on a previous run of the project.
+
+    """
+
+    # seconds per megapixel for effects by type name
+    EFFECT_COSTS = {
+        'Pos': 0.0005,
+        'Crop': 0.001,
+        'Fade': 0.003,
+        'Draw': 0.008,
+        'Rotate': 0.018,
+        'Blur': 0.022,
+        'Border': 0.025,
+        'Resize': 0.03,
+        'AlphaShape': 1.6,
+    }
+
+    # seconds per megapixel for reading frames from resources
+    RESOURCE_COSTS = {
+        'ColorResource': 0,
+        'ImageResource': 0,
+        'ImageSequenceResource': 0.01,
+        'VideoResource': 0.018,
+    }
+
+    def __init__(self, effect_costs=None, resource_costs=None,
+                 default_effect_cost=0.01, clip_cost=0.007, spawn_cost=0.1):
+        """effect_costs, resource_costs -- Seconds per megapixel by type
+        name, overriding the defaults.
+
+        default_effect_cost -- Seconds per megapixel of effects missing
+        from effect_costs.
+
+        clip_cost -- Seconds per megapixel of compositing a clip.
+
+        spawn_cost -- Seconds to start a decoder process.
+
+        """
+        self.effect_costs = dict(self.EFFECT_COSTS, **(effect_costs or {}))
+        self.resource_costs = dict(self.RESOURCE_COSTS, **(resource_costs or {}))
+        self.default_effect_cost = default_effect_cost
+        self.clip_cost = clip_cost
+        self.spawn_cost = spawn_cost
+
+    @staticmethod
+    def from_profiler(prof, **kwargs):
+        """Returns a CostModel with the costs measured by a
+        profiler.Profiler, falling back to the defaults for types that
+        weren't rendered.
+
+        """
+        effect_costs = {}
+        resource_costs = {}
+        clip_cost = None
+        for stat in prof.get_stats():
+            if not stat.pixels:
+                continue
+            cost = stat.self_total / (stat.pixels / 1e6)
+            if stat.kind == 'effect':
+                effect_costs[stat.name] = cost
+            elif stat.kind == 'resource':
+                resource_costs[stat.name] = cost
+            elif stat.kind == 'clip' and stat.name == 'Clip':
+                clip_cost = cost
+
+        if clip_cost is not None:
+            kwargs.setdefault('clip_cost', clip_cost)
+        return CostModel(effect_costs, resource_costs, **kwargs)
+
+    def get_clip_cost(self, clp, render_scale=1):
+        """Returns the estimated seconds to render clp, not including
+        its sub-clips.
+
+        """
+        info = clp.resource.get_info()
+        megapixels = ((info.width or 0) * (info.height or 0) *
+                      render_scale * render_scale / 1e6)
+
+        cost = self.clip_cost + self.resource_costs.get(
+            type(clp.resource).__name__, self.default_effect_cost)
+        for item in clp.items:
+            if isinstance(item, effect.Effect):
+                cost += self.effect_costs.get(type(item).__name__,
+                                              self.default_effect_cost)
+        return cost * megapixels
+
+def estimate_costs(root, times, model=None, render_scale=1):
+    """Returns a list with the estimated seconds to render each of the
+    given global times, from the clips active at each time and the
+    decoder processes the analysis expects to be started.
+
+    root -- Root clip.
+
+    times -- Iterable of global times, in render order.
+
+    model -- CostModel, defaults to the default costs.
+
+    """
+    model = model or CostModel()
+    readers = {}  # id(resource) -> ffmpeg.ReadPlanner
+    clip_costs = {} # id(clip) -> cost
+    costs = []
+
+    with state.State():
+        for time in times:
+            state.set_time(time)
+
+            active = []
+            _walk(root, active)
+
+            cost = 0
+            for clp, source_time in active:
+                if id(clp) not in clip_costs:
+                    clip_costs[id(clp)] = model.get_clip_cost(clp, render_scale)
+                cost += clip_costs[id(clp)]
+
+                res = clp.resource
+                if isinstance(res, resource.VideoResource):
+                    reader = readers.get(id(res))
+                    if reader is None:
+                        reader = _make_planner(res)
+                        readers[id(res)] = reader
+                    if reader.plan(source_time)[1] is not None:
+                        cost += model.spawn_cost
+
+            costs.append(cost)
+
+    return costs
+
+def partition(costs, count):
+    """Splits the indexes of costs into at most count consecutive
+    ranges of roughly equal total cost. Returns a list of (start, end)
+    index pairs, with end not included.
+
+    """
+    if not costs:
+        return []
+    count = max(1, min(count, len(costs)))
+
+    cumulative = list(itertools.accumulate(costs))
+    if cumulative[-1] <= 0:
+        cumulative = list(range(1, len(costs) + 1))
+    total = cumulative[-1]
+
+    bounds = [0]
+    for n in range(1, count):
+        # split before or after the item reaching the target share,
+        # whichever is closer, leaving at least one item for each
+        # remaining range
+        target = total * n / count
+        index = bisect.bisect_left(cumulative, target)
+        before = cumulative[index - 1] if index > 0 else 0
+        if cumulative[index] - target <= target - before:
+            index += 1
+        index = max(bounds[-1] + 1, min(index, len(costs) - (count - n)))
+        bounds.append(index)
+    bounds.append(len(costs))
+
+    return list(zip(bounds, bounds[1:]))
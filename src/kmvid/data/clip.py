@@ -12,9 +12,20 @@ def color(color=(0, 0, 0), width=100, height=100, mode=None, **clip_args):
                                        mode = mode),
                 **clip_args)
 
-def image(path, mode=None, **clip_args):
+def image(path, mode=None, scale=None, **clip_args):
     """Creates an image clip from the given path."""
-    return Clip(resource.ImageResource(path, mode),
+    return Clip(resource.ImageResource(path, mode, scale),
+                **clip_args)
+
+def image_sequence(path, fps=25, mode=None, scale=None, **clip_args):
+    """Creates a clip from numbered image files. The path contains a
+    printf style frame number, such as 'shot_%05d.png'.
+
+    """
+    return Clip(resource.ImageSequenceResource(path,
+                                               fps = fps,
+                                               mode = mode,
+                                               scale = scale),
                 **clip_args)
 
 def video(path, **clip_args):
@@ -81,6 +92,27 @@ class Clip(common.Node, variable.VariableHold):
 
     time = property(get_time_map)
 
+    def get_source_time_map(self):
+        """Returns a CompiledTimeMap from root time to the time used for
+        this clip's resource, flattening the start time offsets of
+        all parent clips. Returns None if the clip has no TimeMap.
+
+        Use get_many on the result to compute resource times for
+        several frames at once.
+
+        """
+        time_map = self.get_time_map()
+        if time_map is None:
+            return None
+
+        offset = 0
+        node = self
+        while isinstance(node, Clip):
+            offset += node.start_time
+            node = node.parent
+
+        return time_map.compile().shift(offset)
+
     def _get_duration(self):
         value = None
         if self.get_time_map():
@@ -114,9 +146,9 @@ class Clip(common.Node, variable.VariableHold):
         frame_time = state.local_time
         if self._time_map:
             frame_time = self._time_map.get(state.local_time)
-        image = self.resource.get_frame(frame_time)
+        image = self.resource.get_frame(frame_time, state.render_scale)
 
-        with state.Render(parent_image, image) as render:
+        with state.Render(parent_image, image, shared=True) as render:
             for item in self.items:
 
                 if isinstance(item, effect.Effect):
@@ -133,10 +165,10 @@ class Clip(common.Node, variable.VariableHold):
                         sub_data = None
 
                         with state.AdjustLocalTime(start_time):
-                            sub_data = item._get_frame_internal(image)
+                            sub_data = item._get_frame_internal(render.image)
 
                         if sub_data is not None:
-                            image.paste(
+                            render.get_writable_image().paste(
                                 sub_data.image,
                                 (int(sub_data.x), int(sub_data.y)),
                                 (sub_data.image
@@ -1,6 +1,10 @@
+import kmvid.data.stats as stats
+
 import collections
 import enum
+import fractions
 import json
+import math
 
 import PIL.ImageChops
 
@@ -194,12 +198,44 @@ class Node(Simpleable):
         s.register_node(obj)
 
 class Render:
-    def __init__(self, parent_image, image):
+    def __init__(self, parent_image, image, shared=False):
+        """parent_image -- The image of the parent clip. Must not be
+        modified.
+
+        image -- The image being rendered.
+
+        shared -- True if image is owned by someone else, such as a
+        resource, and must not be modified. A private copy is made by
+        get_writable_image when needed.
+
+        """
         self.parent_image = parent_image
-        self.image = image
+        self._image = image
+        self._shared = shared
         self.x = 0
         self.y = 0
 
+    def get_image(self):
+        return self._image
+
+    def set_image(self, image):
+        if image is not self._image:
+            self._image = image
+            self._shared = False
+
+    image = property(get_image, set_image)
+
+    def get_writable_image(self):
+        """Returns the image, copying it first if it's shared. Use this
+        before modifying the image in place.
+
+        """
+        if self._shared:
+            self._image = self._image.copy()
+            self._shared = False
+            stats.increment("image_copy")
+        return self._image
+
 #--------------------------------------------------
 # util
 
@@ -225,6 +261,7 @@ def merge_alpha(image, alpha, strategy=AlphaStrategyType.MIN):
         alpha = PIL.Image.new(mode = "L",
                               size = image.size,
                               color = min(255, max(0, int(alpha * 255))))
+        stats.increment("layer_alloc")
     else:
         if not alpha.mode == "L":
             alpha = alpha.getchannel("A")
@@ -244,3 +281,47 @@ def merge_alpha(image, alpha, strategy=AlphaStrategyType.MIN):
 
     image.putalpha(alpha)
     return image
+
+#--------------------------------------------------
+# timebase
+
+# fraction of a frame that times may fall short of a frame boundary
+# and still be counted as that frame, absorbing rounding errors
+_FRAME_TOLERANCE = 1e-6
+
+def to_rational(fps):
+    """Returns fps as a Fraction. NTSC style rates given as decimals,
+    such as 29.97 or 23.976, are read as 30000/1001 and 24000/1001.
+
+    fps -- Number, Fraction, (numerator, denominator) tuple or a
+    "numerator/denominator" string as reported by ffprobe.
+
+    """
+    if isinstance(fps, fractions.Fraction):
+        return fps
+    if isinstance(fps, (tuple, list)):
+        return fractions.Fraction(int(fps[0]), int(fps[1]))
+    if isinstance(fps, str):
+        return fractions.Fraction(fps)
+    if isinstance(fps, int) or float(fps).is_integer():
+        return fractions.Fraction(int(fps))
+
+    ntsc = fps * 1.001
+    if abs(ntsc - round(ntsc)) < 1e-3:
+        return fractions.Fraction(round(ntsc) * 1000, 1001)
+    return fractions.Fraction(fps).limit_denominator(1001)
+
+def get_frame_index(time, fps):
+    """Returns the index of the frame containing time, at the rate fps
+    given as a Fraction. Times within a small fraction of a frame
+    before a boundary count as the next frame.
+
+    """
+    return math.floor(time * fps.numerator / fps.denominator + _FRAME_TOLERANCE)
+
+def get_frame_time(index, fps):
+    """Returns the start time of frame index at the rate fps given as a
+    Fraction.
+
+    """
+    return index * fps.denominator / fps.numerator
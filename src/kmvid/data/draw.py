@@ -1,4 +1,5 @@
 import kmvid.data.common as common
+import kmvid.data.stats as stats
 import kmvid.data.text
 import kmvid.data.variable as variable
 
@@ -39,6 +40,7 @@ class Draw(common.Node, variable.VariableHold):
             image = PIL.Image.new(mode = self.mode,
                                   size = original_image.size,
                                   color = (0, 0, 0, 0))
+            stats.increment("layer_alloc")
 
         draw = PIL.ImageDraw.Draw(image)
 
@@ -175,10 +177,11 @@ class Config(Instruction):
     shapes and the color of text.""")
     pen_width = variable.VariableConfig(
         int, default=0,
-        doc="""With of the tracing/border around drawn objects. Set to 0 to disable.""")
+        doc="""With of the tracing/border around drawn objects. Set to 0 to disable.""",
+        scaled=True)
 
     font_name = variable.VariableConfig(str)
-    font_size = variable.VariableConfig(int)
+    font_size = variable.VariableConfig(int, scaled=True)
     font_variant = variable.VariableConfig(str)
 
     def __init__(self, **kwargs):
@@ -218,10 +221,10 @@ class Config(Instruction):
 
 @variable.holder
 class Rectangle(Instruction):
-    x = variable.VariableConfig(int, 0)
-    y = variable.VariableConfig(int, 0)
-    width = variable.VariableConfig(int)
-    height = variable.VariableConfig(int)
+    x = variable.VariableConfig(int, 0, scaled=True)
+    y = variable.VariableConfig(int, 0, scaled=True)
+    width = variable.VariableConfig(int, scaled=True)
+    height = variable.VariableConfig(int, scaled=True)
     center = variable.VariableConfig(
         bool, doc="Use x and y as the center of the rectangle rather than the upper left corner.")
 
@@ -243,11 +246,11 @@ class Rectangle(Instruction):
 
 @variable.holder
 class Ellipse(Instruction):
-    x = variable.VariableConfig(int, 0)
-    y = variable.VariableConfig(int, 0)
-    width = variable.VariableConfig(int)
-    height = variable.VariableConfig(int)
-    radius = variable.VariableConfig(float)
+    x = variable.VariableConfig(int, 0, scaled=True)
+    y = variable.VariableConfig(int, 0, scaled=True)
+    width = variable.VariableConfig(int, scaled=True)
+    height = variable.VariableConfig(int, scaled=True)
+    radius = variable.VariableConfig(float, scaled=True)
     center = variable.VariableConfig(
         bool, doc="Use x and y as the center of the ellipse rather than the upper left corner.")
 
@@ -278,17 +281,18 @@ class Text(Instruction):
     text = variable.VariableConfig(
         str, doc="""Text to draw. If the text contains linebreak characters multiple
         lines are drawn.""")
-    x = variable.VariableConfig(int, 0, doc="Left coordinate to place text.")
-    y = variable.VariableConfig(int, 0, doc="Top coordinate to place text.")
+    x = variable.VariableConfig(int, 0, doc="Left coordinate to place text.", scaled=True)
+    y = variable.VariableConfig(int, 0, doc="Top coordinate to place text.", scaled=True)
     font_name = variable.VariableConfig(str, doc="Name of the font.")
-    size = variable.VariableConfig(int, doc="Size of the font.")
+    size = variable.VariableConfig(int, doc="Size of the font.", scaled=True)
     variant = variable.VariableConfig(str, doc="Variant of the font.")
     width = variable.VariableConfig(
         int, doc="""The width at which point text wrapping occurs. If set to None no
     wrapping takes place. If parts of the text can't fit it will be
     truncated. If size (or font_size from config, if size is not set)
     is None then the font size is adapted so that text fits into
-    width.""")
+    width.""",
+        scaled=True)
     anchor = variable.VariableConfig(
         str, doc="""Where to place the text in relation to x and y coordinates. By
     default top left is used.
@@ -338,7 +342,7 @@ class Text(Instruction):
 @variable.holder
 class Line(Instruction):
     """Draw lines or a polygon."""
-    path = variable.VariableConfig(doc="A list of (x, y) pairs.")
+    path = variable.VariableConfig(doc="A list of (x, y) pairs.", scaled=True)
     close = variable.VariableConfig(
         bool, False, doc="""When true an additional line from the last point to the first point
     will be drawn. This turns the lines into a polygon which can be
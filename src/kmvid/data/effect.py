@@ -4,13 +4,13 @@ import kmvid.data.draw as draw
 import kmvid.data.gradient as gradient
 import kmvid.data.variable as variable
 import kmvid.data.state as state
+import kmvid.data.stats as stats
 
 import PIL.ImageChops
 import PIL.ImageFilter
 import PIL.ImageOps
 import enum
 import math
-import numpy as np
 import sys
 
 class Effect(common.Node, variable.VariableHold):
@@ -87,9 +87,9 @@ class Pos(Effect):
     """
 
     x = variable.VariableConfig(
-        int, doc="""Absolute x position.""")
+        int, doc="""Absolute x position.""", scaled=True)
     y = variable.VariableConfig(
-        int, doc="""Absolute y position.""")
+        int, doc="""Absolute y position.""", scaled=True)
     center = variable.VariableConfig(
         bool, False, doc="""For use with x and y variables.
 
@@ -97,9 +97,9 @@ class Pos(Effect):
         rather than the upper left corner.""")
 
     x_offset = variable.VariableConfig(
-        int, 0, doc="""Offset for x position.""")
+        int, 0, doc="""Offset for x position.""", scaled=True)
     y_offset = variable.VariableConfig(
-        int, 0, doc="""Offset for y position.""")
+        int, 0, doc="""Offset for y position.""", scaled=True)
 
     horizontal = variable.VariableConfig(
         float, doc="""Relative horizontal position.
@@ -168,8 +168,8 @@ class Resize(Effect):
     height may be omitted.
 
     """
-    width = variable.VariableConfig(int, doc="New width of the clip.")
-    height = variable.VariableConfig(int, doc="New height of the clip.")
+    width = variable.VariableConfig(int, doc="New width of the clip.", scaled=True)
+    height = variable.VariableConfig(int, doc="New height of the clip.", scaled=True)
     strategy = variable.VariableConfig(
         ResizeType, ResizeType.FIT,
         doc="""How to resize the image.
@@ -239,7 +239,9 @@ class Rotate(Effect):
         Effect.__init__(self, args=args, kwargs=kwargs)
 
     def apply(self, render):
-        render.image = render.image.convert("RGBA")
+        if render.image.mode != "RGBA":
+            render.image = render.image.convert("RGBA")
+            stats.increment("image_convert")
         old = render.image.size
         render.image = render.image.rotate(-self.angle,
                                            #resample=PIL.Image.Resampling.BICUBIC,
@@ -290,7 +292,7 @@ class Fade(Effect):
                     fade_out_value = 1 - (time - fade_start) / self.fade_out
 
         render.image = common.merge_alpha(
-            render.image,
+            render.get_writable_image(),
             max(0, min(1, value, fade_in_value, fade_out_value)),
             self.alpha_strategy)
 
@@ -300,10 +302,10 @@ class Crop(Effect):
     edge. The clip remains in position.
 
     """
-    left = variable.VariableConfig(int, 0)
-    top = variable.VariableConfig(int, 0)
-    right = variable.VariableConfig(int, 0)
-    bottom = variable.VariableConfig(int, 0)
+    left = variable.VariableConfig(int, 0, scaled=True)
+    top = variable.VariableConfig(int, 0, scaled=True)
+    right = variable.VariableConfig(int, 0, scaled=True)
+    bottom = variable.VariableConfig(int, 0, scaled=True)
 
     def __init__(self, **kwargs):
         Effect.__init__(self, kwargs=kwargs)
@@ -348,7 +350,7 @@ class Draw(Effect):
         return self
 
     def apply(self, render):
-        self.draw.apply(render.image)
+        self.draw.apply(render.get_writable_image())
 
     def to_simple(self):
         s = common.Simple(self)
@@ -386,7 +388,8 @@ class Border(Effect):
 
     width = variable.VariableConfig(
         int, 5, doc="""The width of the border. The image grows by width pixels in all
-    directions. Use a width of 0 to disable drawing a border.""")
+    directions. Use a width of 0 to disable drawing a border.""",
+        scaled=True)
     color = variable.VariableConfig(
         default=(255, 255, 255), doc="""Color of the border.""")
 
@@ -428,7 +431,7 @@ class Border(Effect):
         width = int(self.width + 0.5)
 
         common.merge_alpha(
-            render.image,
+            render.get_writable_image(),
             self._get_alpha_channel(render.image))
 
         if width > 0:
@@ -437,6 +440,7 @@ class Border(Effect):
                 size=(render.image.size[0] + width * 2,
                       render.image.size[1] + width * 2),
                 color=self.color)
+            stats.increment("layer_alloc")
 
             common.merge_alpha(
                 bg,
@@ -451,6 +455,7 @@ class Border(Effect):
 
     def _get_alpha_channel(self, image):
         alpha = PIL.Image.new(mode="L", size=image.size, color=255)
+        stats.increment("layer_alloc")
         draw = PIL.ImageDraw.Draw(alpha)
 
         self._apply_corner(alpha, draw, self.tl)
@@ -548,11 +553,14 @@ class BorderCorner(common.Node, variable.VariableHold):
         BorderCornerType, BorderCornerType.CURVE,
         doc="""General shape of the corner.""")
     size = variable.VariableConfig(
-        int, doc="""Convenience for setting both width and height.""")
+        int, doc="""Convenience for setting both width and height.""",
+        scaled=True)
     width = variable.VariableConfig(
-        int, doc="""Horizontal anchor point for the corner. Uses size if not set.""")
+        int, doc="""Horizontal anchor point for the corner. Uses size if not set.""",
+        scaled=True)
     height = variable.VariableConfig(
-        int, doc="""Vertical anchor point for the corner. Uses size if not set.""")
+        int, doc="""Vertical anchor point for the corner. Uses size if not set.""",
+        scaled=True)
 
     def __init__(self, **kwargs):
         common.Node.__init__(self)
@@ -592,17 +600,20 @@ class AlphaShape(Effect):
 
     """
     type = variable.VariableConfig(AlphaShapeType, AlphaShapeType.LINE)
-    x = variable.VariableConfig(int, 0)
-    y = variable.VariableConfig(int, 0)
+    x = variable.VariableConfig(int, 0, scaled=True)
+    y = variable.VariableConfig(int, 0, scaled=True)
     w = variable.VariableConfig(
         int, 100,
-        doc="""Corresponding absolute value is x + w. Negative values point left.""")
+        doc="""Corresponding absolute value is x + w. Negative values point left.""",
+        scaled=True)
     h = variable.VariableConfig(
         int, 0,
-        doc="""Corresponding absolute value is y + h. Negative values point up.""")
+        doc="""Corresponding absolute value is y + h. Negative values point up.""",
+        scaled=True)
     size = variable.VariableConfig(
         float, 0,
-        doc="""The size of the transition.""")
+        doc="""The size of the transition.""",
+        scaled=True)
     invert = variable.VariableConfig(
         bool, False,
         doc="""Reverses the alpha values, changing the direction the fade takes.""")
@@ -623,6 +634,8 @@ class AlphaShape(Effect):
             raise ValueError("Unknown alpha shape type: %s" % str(self.type))
 
     def _line_shape(self, render):
+        import numpy as np
+
         x1 = self.x
         y1 = self.y
         x2 = x1 + self.w
@@ -651,11 +664,13 @@ class AlphaShape(Effect):
                 e[...] = value
 
         alpha_layer = PIL.Image.fromarray(layer)
-        render.image = common.merge_alpha(render.image,
+        render.image = common.merge_alpha(render.get_writable_image(),
                                           alpha_layer,
                                           self.alpha_strategy)
 
     def _ellipse_shape(self, render):
+        import numpy as np
+
         x1 = self.x + self.w/2
         y1 = self.y + self.h/2
         wr = self.w/2
@@ -715,7 +730,7 @@ class AlphaShape(Effect):
                 e[...] = value
 
         alpha_layer = PIL.Image.fromarray(layer)
-        render.image = common.merge_alpha(render.image,
+        render.image = common.merge_alpha(render.get_writable_image(),
                                           alpha_layer,
                                           self.alpha_strategy)
 
@@ -726,8 +741,8 @@ class BlurType(enum.Enum):
 @variable.holder
 class Blur(Effect):
     type = variable.VariableConfig(BlurType, BlurType.BOX)
-    x = variable.VariableConfig(float, 2, doc="""Bluring along the X axis.""")
-    y = variable.VariableConfig(float, 2, doc="""Bluring along the Y axis.""")
+    x = variable.VariableConfig(float, 2, doc="""Bluring along the X axis.""", scaled=True)
+    y = variable.VariableConfig(float, 2, doc="""Bluring along the Y axis.""", scaled=True)
 
     def __init__(self, *args, **kwargs):
         Effect.__init__(self, args=args, kwargs=kwargs)
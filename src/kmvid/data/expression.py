@@ -48,6 +48,16 @@ class SymDef:
     def get(self, node):
         return self.function()
 
+def _get_render_size(index):
+    """Returns the size of the current render in unscaled pixels, the
+    same unit as pixel variables.
+
+    """
+    size = state.render.image.size[index]
+    if state.render_scale != 1:
+        return size / state.render_scale
+    return size
+
 __FUNCTION_MAPPING__ = {}
 __SYMBOL_MAPPING__ = {}
 
@@ -60,8 +70,8 @@ for fdef in [FnDef('+', operator.add,     ftype="binary"),
 
 for sdef in [SymDef('time', lambda: state.local_time),
              SymDef('global-time', lambda: state.global_time),
-             SymDef('width', lambda: state.render.image.size[0]),
-             SymDef('height', lambda: state.render.image.size[1]),
+             SymDef('width', lambda: _get_render_size(0)),
+             SymDef('height', lambda: _get_render_size(1)),
              ]:
     __SYMBOL_MAPPING__[sdef.name] = sdef
 
@@ -119,7 +129,7 @@ class Function(Expression):
         obj.name = s.get('name')
         obj.args = []
         for arg_data in s.get('args'):
-            obj.add_arg(Expression.from_simple(s, common.Simple.from_data(arg_data)))
+            obj.add_arg(Expression.from_simple(common.Simple.from_data(s, arg_data)))
         return obj
 
 class Symbol(Expression):
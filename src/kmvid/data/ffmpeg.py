@@ -1,28 +1,243 @@
+import kmvid.data.common as common
+import kmvid.data.stats as stats
+
 import PIL.Image
+import enum
+import fractions
+import hashlib
 import json
 import logging
+import math
 import os
+import os.path
+import queue
+import shutil
 import subprocess
+import threading
+import time
+import weakref
 
 logger = logging.getLogger(__name__)
 
 _FFMPEG_PATH = "ffmpeg"
 _FFPROBE_PATH = "ffprobe"
 
+_CACHE_DIR = os.environ.get(
+    "KMVID_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "kmvid"))
+
+_video_formats = None
+
+# running ffmpeg processes used for reading and writing
+_processes = weakref.WeakSet()
+
+def get_process_count():
+    """Returns the number of ffmpeg processes currently running for
+    readers and writers.
+
+    """
+    return len([p for p in list(_processes) if p.poll() is None])
+
+class IoStats:
+    def __init__(self):
+        """Time spent waiting on an ffmpeg process by a reader or writer.
+
+        startup_time -- Seconds from starting a process until it
+        accepted or produced the first frame.
+
+        blocked_time -- Seconds blocked reading frames from or writing
+        frames to the process pipe.
+
+        queue_time -- Seconds write_frame waited for room in the
+        writer queue, always 0 for readers.
+
+        frames -- Frames read or written.
+
+        spawns -- Processes started.
+
+        seeks -- Processes started to jump backwards or far ahead,
+        including reading reverse chunks.
+
+        restarts -- Processes started to change how frames are
+        decoded, as when frame decimation starts, changes or ends.
+
+        """
+        self.startup_time = 0
+        self.blocked_time = 0
+        self.queue_time = 0
+        self.frames = 0
+        self.spawns = 0
+        self.seeks = 0
+        self.restarts = 0
+
+    def to_dict(self):
+        return dict(vars(self))
+
+class PixelFormat(enum.Enum):
+    RGB24 = 0
+    YUV420P = 1
+    NV12 = 2
+
+class OutputFormat(enum.Enum):
+    FILE = 0
+    HLS = 1
+    FRAGMENTED_MP4 = 2
+
+class Rendition:
+    def __init__(self, filename, width=None, height=None, preset=None,
+                 crf=None, tune=None, output_format=None,
+                 segment_duration=None, output_pixel_format=None,
+                 threads=None):
+        """An output of FfmpegWriter, see its renditions argument.
+
+        filename -- File to write to.
+
+        width, height -- Size of the rendition. If only one is given
+        the other is derived from the aspect ratio of the input. If
+        neither is given the input size is used.
+
+        preset, crf, tune, output_format, segment_duration,
+        output_pixel_format, threads -- See FfmpegWriter. Unset
+        options are taken from the writer.
+
+        """
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.preset = preset
+        self.crf = crf
+        self.tune = tune
+        self.output_format = (None if output_format is None else
+                              common.to_enum(output_format, OutputFormat))
+        self.segment_duration = segment_duration
+        self.output_pixel_format = output_pixel_format
+        self.threads = threads
+
+    def get_filter(self):
+        """Returns the ffmpeg filter scaling frames to this rendition."""
+        if self.width is None and self.height is None:
+            return 'null'
+        # -2 keeps the aspect ratio while staying divisible by two
+        return 'scale=%d:%d' % (self.width or -2, self.height or -2)
+
+    def get_output_options(self, default):
+        """Returns the ffmpeg output options for this rendition.
+
+        default -- Rendition holding values for unset options.
+
+        """
+        preset = self.preset or default.preset
+        crf = self.crf if self.crf is not None else default.crf
+        tune = self.tune or default.tune
+        output_format = self.output_format or default.output_format
+        segment_duration = self.segment_duration or default.segment_duration
+        pixel_format = self.output_pixel_format or default.output_pixel_format
+        threads = self.threads if self.threads is not None else default.threads
+
+        options = [
+            '-codec:v', 'libx264', # video codec
+            '-preset' , preset,    # preset for x264 (ultrafast, superfast, veryfast, faster, fast, medium, slow, veryslow)
+        ]
+        if pixel_format is not None:
+            options += ['-pix_fmt', pixel_format]
+        if threads is not None:
+            # per output option, every rendition needs its own
+            options += ['-threads', str(threads)]
+        if crf is not None:
+            options += ['-crf', str(crf)]
+        if tune is not None:
+            options += ['-tune', tune]
+
+        if output_format not in (None, OutputFormat.FILE):
+            # segments can only be cut at keyframes
+            options += ['-force_key_frames',
+                        'expr:gte(t,n_forced*%s)' % segment_duration]
+
+        if output_format == OutputFormat.HLS:
+            options += [
+                '-f'                 , 'hls',
+                '-hls_time'          , str(segment_duration),
+                '-hls_playlist_type' , 'event', # playlist grows while writing
+                '-hls_flags'         , 'independent_segments',
+                '-hls_list_size'     , '0',
+            ]
+        elif output_format == OutputFormat.FRAGMENTED_MP4:
+            options += [
+                '-f'            , 'mp4',
+                '-movflags'     , 'frag_keyframe+empty_moov+default_base_moof',
+                '-frag_duration', str(int(segment_duration * 1000000)),
+            ]
+
+        options.append(self.filename)
+        return options
+
 class FfmpegWriter:
-    def __init__(self, filename, size, fps):
+    def __init__(self, filename, size, fps, pixel_format=PixelFormat.RGB24,
+                 preset="medium", crf=None, threads=None, tune=None,
+                 queue_size=4, renditions=None,
+                 output_format=OutputFormat.FILE, segment_duration=2,
+                 output_pixel_format=None):
         """filename -- File to write to. If the file exists it will be
-        overwritten.
+        overwritten. Ignored if renditions are given.
 
         size -- (w, h) tuple designating the width and height for the
         video. This must match the images fed to write_frame.
 
         fps -- The FPS to use for the generated video.
 
+        pixel_format -- PixelFormat used when piping frames to ffmpeg.
+        YUV420P and NV12 are converted from RGB before piping, which
+        halves the amount of data sent and spares the encoder the
+        conversion. They require even width and height.
+
+        preset -- x264 preset (ultrafast, superfast, veryfast,
+        faster, fast, medium, slow, veryslow).
+
+        crf -- x264 constant rate factor. Lower is better quality.
+        Uses the x264 default if None.
+
+        threads -- Number of encoder threads. Uses the ffmpeg default
+        if None.
+
+        tune -- x264 tune option (film, animation, grain, ...).
+
+        queue_size -- Number of frames that can be queued for the
+        writer thread before write_frame blocks.
+
+        renditions -- List of Rendition objects. If given each frame
+        is piped once and ffmpeg splits and scales it to every
+        rendition, writing all files in one pass.
+
+        output_format -- OutputFormat. HLS writes a playlist to
+        filename (.m3u8) along with segment files next to it, the
+        playlist is updated as segments are finished. FRAGMENTED_MP4
+        writes an mp4 file that is playable while it's being written.
+        Both allow playback to start before writing is done.
+
+        segment_duration -- Target duration in seconds of HLS
+        segments and mp4 fragments.
+
+        output_pixel_format -- ffmpeg pixel format of the encoded
+        video, such as 'yuv420p'. If None ffmpeg picks one for plain
+        files, which is yuv444p for RGB24 input. HLS, fragmented mp4
+        and renditions default to 'yuv420p' so that browsers and
+        players can decode them, which requires even width and
+        height.
+
         """
         self.filename = filename
+        self.renditions = renditions
         self.size = size
-        self.fps = fps if isinstance(fps, str) else "%.02f" % fps
+        if isinstance(fps, fractions.Fraction):
+            self.fps = "%d/%d" % (fps.numerator, fps.denominator)
+        else:
+            self.fps = fps if isinstance(fps, str) else "%.02f" % fps
+        self.pixel_format = common.to_enum(pixel_format, PixelFormat)
+
+        if (self.pixel_format != PixelFormat.RGB24 and
+            (size[0] % 2 != 0 or size[1] % 2 != 0)):
+            raise ValueError("Pixel format %s requires even width and height, got %dx%d" % (
+                self.pixel_format.name, size[0], size[1]))
 
         # ffmpeg documentation
         #
@@ -38,6 +253,31 @@ class FfmpegWriter:
         # belong to different files. All options apply ONLY to the
         # next input or output file and are reset between files.
 
+        if output_pixel_format is None and (
+                renditions or
+                common.to_enum(output_format, OutputFormat) != OutputFormat.FILE):
+            output_pixel_format = "yuv420p"
+        self.output_pixel_format = output_pixel_format
+
+        default = Rendition(self.filename, preset=preset, crf=crf, tune=tune,
+                            output_format=output_format,
+                            segment_duration=segment_duration,
+                            output_pixel_format=output_pixel_format,
+                            threads=threads)
+        if renditions:
+            outputs = []
+            split = '[0:v]split=%d%s' % (
+                len(renditions),
+                ''.join('[s%d]' % n for n in range(len(renditions))))
+            filters = [split]
+            for n, rendition in enumerate(renditions):
+                filters.append('[s%d]%s[o%d]' % (n, rendition.get_filter(), n))
+                outputs += ['-map', '[o%d]' % n]
+                outputs += rendition.get_output_options(default)
+            outputs = ['-filter_complex', ';'.join(filters), *outputs]
+        else:
+            outputs = default.get_output_options(default)
+
         cmd = [
             # command
             _FFMPEG_PATH,
@@ -49,37 +289,120 @@ class FfmpegWriter:
             '-r'       , self.fps,       # frame rate
             '-f'       , 'rawvideo',     # input file format
             '-codec:v' , 'rawvideo',     # video codec
-            '-pix_fmt' , 'rgb24',        # pixel format
+            '-pix_fmt' , self.pixel_format.name.lower(), # pixel format
             # '-an'      ,                 # disable audio stream (needed?)
             '-i'       , '-',            # use stdin
 
             # output video
-            '-codec:v'    , 'libx264', # video codec
-            '-preset'     , 'medium',  # preset for x264 (ultrafast, superfast, veryfast, faster, fast, medium, slow, veryslow)
-            self.filename ,            # output file
+            *outputs,
         ]
 
+        self.io = IoStats()
+        self.io.spawns = 1
+
+        stats.increment("ffmpeg_spawn")
+        stats.increment("ffmpeg_spawn_writer")
+        start = time.perf_counter()
         self.process = subprocess.Popen(cmd, stdin = subprocess.PIPE)
+        _processes.add(self.process)
+        # startup ends when the first frame is written, see _run
+        self._popen_time = time.perf_counter() - start
+
+        # seconds spent on the writer thread, see _run
+        self.convert_time = 0
+        self.write_time = 0
+
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._error = None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
 
     def write_frame(self, image):
         """Write the given image as the next video frame.
 
+        The image is converted and piped to ffmpeg on a separate
+        thread and must not be modified afterwards.
+
         image -- A pillow image object. It will automatically be
         converted to fit the video format.
 
         """
-        image = image.convert("RGB")
-        self.process.stdin.write(image.tobytes())
+        self._raise_error()
+        if self._queue.full():
+            # the encoder is slower than rendering
+            start = time.perf_counter()
+            self._queue.put(image)
+            blocked = time.perf_counter() - start
+            self.io.queue_time += blocked
+            stats.increment("encoder_queue_seconds", blocked)
+        else:
+            self._queue.put(image)
+
+    def _run(self):
+        while True:
+            image = self._queue.get()
+            if image is None:
+                return
+            if self._error is not None:
+                continue
+
+            try:
+                start = time.perf_counter()
+                data = self._to_bytes(image)
+                converted = time.perf_counter()
+                self.process.stdin.write(data)
+                written = time.perf_counter()
+                stats.increment("encoder_bytes", len(data))
+                self.convert_time += converted - start
+                self.write_time += written - converted
+                if self._popen_time is not None:
+                    # the first frame is written once ffmpeg has started
+                    self._add_startup_time(self._popen_time + written - converted)
+                else:
+                    stats.increment("encoder_blocked_seconds", written - converted)
+                    self.io.blocked_time += written - converted
+                self.io.frames += 1
+            except Exception as e:
+                self._error = e
+
+    def _add_startup_time(self, seconds):
+        self.io.startup_time = seconds
+        stats.increment("encoder_startup_seconds", seconds)
+        self._popen_time = None
+
+    def _to_bytes(self, image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+            stats.increment("image_convert")
+        if self.pixel_format == PixelFormat.RGB24:
+            return image.tobytes()
+        return rgb_to_yuv420(image, self.pixel_format == PixelFormat.NV12)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise Exception("Failed writing to ffmpeg: %s" % str(self._error))
 
     def close(self):
         if self.process:
-            self.process.stdin.close()
+            self._queue.put(None)
+            self._thread.join()
+            if self._popen_time is not None:
+                # no frames written
+                self._add_startup_time(self._popen_time)
+
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
             try:
                 return_code = self.process.wait(5)
             except subprocess.TimeoutExpired:
                 self.process.kill()
+                return_code = self.process.wait()
             self.process = None
 
+            self._raise_error()
             if return_code != 0:
                 raise Exception("ffmpeg existing with code %d" % return_code)
 
@@ -89,23 +412,226 @@ class FfmpegWriter:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+# Maps full range JPEG YCbCr, as produced by PIL, to limited range.
+_Y_LIMITED = [16 + (v * 219 + 127) // 255 for v in range(256)]
+_C_LIMITED = [128 + int(math.floor((v - 128) * 224 / 255 + 0.5))
+              for v in range(256)]
+
+def rgb_to_yuv420(image, nv12=False):
+    """Converts an RGB image to planar yuv420p bytes, or nv12 with
+    interleaved chroma, using BT.601 limited range. Width and height
+    must be even.
+
+    """
+    # PIL's YCbCr conversion uses the BT.601 matrix in full range, all
+    # of the work here is done in C by PIL, which is several times
+    # faster than doing the matrix math in numpy.
+    y, u, v = image.convert("YCbCr").split()
+    stats.increment("image_convert")
+    y = y.point(_Y_LIMITED)
+    u = u.reduce(2).point(_C_LIMITED)
+    v = v.reduce(2).point(_C_LIMITED)
+
+    if nv12:
+        return y.tobytes() + PIL.Image.merge("LA", (u, v)).tobytes()
+    return y.tobytes() + u.tobytes() + v.tobytes()
+
+class ReadPlanner:
+    # defaults of FfmpegReader
+    RESET_THRESHOLD = 5
+    REVERSE_CHUNK_SIZE = 24
+    REVERSE_CHUNK_BYTES = 256 * 1024 * 1024
+    DECIMATE_RATIO = 2
+
+    # actions returned by plan
+    CHUNK = "chunk"         # the frame is in the reverse chunk
+    REVERSE = "reverse"     # decode a new reverse chunk ending at the frame
+    FORWARD = "forward"     # decode forward to the frame
+
+    def __init__(self, fps, size, reverse_chunk_size=REVERSE_CHUNK_SIZE,
+                 reverse_chunk_bytes=REVERSE_CHUNK_BYTES,
+                 decimate_ratio=DECIMATE_RATIO,
+                 reset_threshold=RESET_THRESHOLD):
+        """Decides how FfmpegReader gets to each requested frame and when
+        it starts a new ffmpeg process. Analysis dry runs use it to
+        follow the same decisions without reading anything.
+
+        fps -- Frame rate of the video, see common.to_rational.
+
+        size -- (w, h) of the frames read, used to limit the reverse
+        chunk by reverse_chunk_bytes.
+
+        reverse_chunk_size, reverse_chunk_bytes, decimate_ratio,
+        reset_threshold -- See FfmpegReader.
+
+        """
+        self.rate = common.to_rational(fps)
+        self.frame_time = 1 / float(self.rate)
+        self.decimate_ratio = decimate_ratio
+        self.reset_threshold = reset_threshold
+
+        # frames are kept as RGBA
+        frame_bytes = size[0] * size[1] * 4
+        self.reverse_chunk_frames = max(1, min(reverse_chunk_size,
+                                               reverse_chunk_bytes // frame_bytes))
+
+        self.started = False    # a process has been started since close
+        self.position = None    # index of the last decoded frame
+        self.last_time = None
+        self.chunk = None       # (first, last) frame index of the reverse chunk
+        self.decimation = None  # Decimation of the current process
+        self.steps = []         # distance in frames between recent requests
+
+    def plan(self, time):
+        """Returns (action, reason) for reading the frame at time and
+        updates the state as if it was read.
+
+        action -- CHUNK, REVERSE or FORWARD.
+
+        reason -- Why a new process has to be started before the
+        action, see the ffmpeg_spawn_<reason> stats counters, or None
+        if the current process is used. Processes only output the
+        frames selected by self.decimation, if set.
+
+        """
+        last_time = self.last_time
+        self.last_time = time
+        index = common.get_frame_index(time, self.rate)
+
+        if self.chunk and self.chunk[0] <= index <= self.chunk[1]:
+            return (self.CHUNK, None)
+
+        if (self.position is not None and
+            last_time is not None and
+            last_time - self.reset_threshold <= time < last_time and
+            self.position > index):
+            self.chunk = (max(0, index - self.reverse_chunk_frames + 1), index)
+            self.decimation = None
+            return (self.REVERSE, self._start(index, "reverse_chunk"))
+
+        self.chunk = None
+
+        ratio = self._get_sampling_ratio(time, last_time)
+        if ratio is not None and (self.decimation is None or
+                                  not self.decimation.matches(ratio)):
+            self.decimation = Decimation(time * float(self.rate), ratio)
+            return (self.FORWARD, self._start(index, "decimation"))
+
+        if self.decimation is not None:
+            if (index >= self.decimation.start and
+                self.decimation.is_selected(index - self.decimation.start)):
+                self.position = index
+                return (self.FORWARD, None)
+            # the frame was dropped
+            self.decimation = None
+            self.position = None
+
+        reason = None
+        if self.position is None:
+            reason = "restart" if self.started else "first_use"
+        elif self.position > index:
+            reason = "backward_seek"
+        elif (index - self.position - 1) * self.frame_time > self.reset_threshold:
+            reason = "threshold_jump"
+
+        if reason is not None:
+            return (self.FORWARD, self._start(index, reason))
+        self.position = index
+        return (self.FORWARD, None)
+
+    def close(self):
+        """Forgets the current process, as when the reader is closed."""
+        self.started = False
+        self.position = None
+        self.chunk = None
+        self.decimation = None
+
+    def _start(self, index, reason):
+        self.started = True
+        self.position = index
+        return reason
+
+    def _get_sampling_ratio(self, time, last_time):
+        """Tracks the distance between requests. Returns the distance in
+        frames if the last requests are evenly spaced at least
+        decimate_ratio frames apart, otherwise None.
+
+        """
+        if self.decimate_ratio is None:
+            return None
+
+        if last_time is None or time <= last_time:
+            self.steps = []
+            return None
+
+        self.steps.append((time - last_time) / self.frame_time)
+        self.steps = self.steps[-3:]
+
+        low = min(self.steps)
+        high = max(self.steps)
+        if (len(self.steps) == 3 and
+            low >= self.decimate_ratio and
+            high - low < high * _DECIMATION_TOLERANCE):
+            return self.steps[-1]
+        return None
+
 class FfmpegReader:
-    def __init__(self, filename):
+    def __init__(self, filename,
+                 reverse_chunk_size=ReadPlanner.REVERSE_CHUNK_SIZE,
+                 decimate_ratio=ReadPlanner.DECIMATE_RATIO,
+                 scale=None, size=None,
+                 reverse_chunk_bytes=ReadPlanner.REVERSE_CHUNK_BYTES,
+                 reset_threshold=ReadPlanner.RESET_THRESHOLD):
         """Create a frame reader for the given filename.
 
         filename -- File to read from.
 
+        reverse_chunk_size -- Maximum number of frames decoded at a
+        time when reading backwards.
+
+        reverse_chunk_bytes -- Memory budget for the frames decoded
+        when reading backwards. Limits the number of frames below
+        reverse_chunk_size for large videos, at least one frame is
+        always read.
+
+        decimate_ratio -- When frames are requested at evenly spaced
+        times this many source frames apart, or more, ffmpeg is asked
+        to only output the frames that will be used. None disables
+        this.
+
+        scale -- If given frames are scaled by ffmpeg to this fraction
+        of the video size.
+
+        size -- If given frames are scaled by ffmpeg to this (w, h)
+        size. Takes precedence over scale.
+
+        reset_threshold -- Seconds the reader skips ahead by decoding
+        rather than starting a new process.
+
         """
         self.filename = filename
+        self.scale = scale
+        self.output_size = size
         self.fps = None
         self.size = (1, 1)
+        self.reverse_chunk_size = reverse_chunk_size
+        self.reverse_chunk_bytes = reverse_chunk_bytes
+        self.decimate_ratio = decimate_ratio
+        self.reset_threshold = reset_threshold
 
         self._frame_size = None
         self._frame_time = None
+        self._rate = None # exact frame rate as a Fraction
 
         self._process = None
         self._last_frame = None
-        self._reset_threshold = 5
+        self._planner = None # ReadPlanner, created with the video info
+
+        self._chunk = [] # FrameInfo objects from the last reverse read
+        self._decimation = None # Decimation used by the current process
+
+        self.io = IoStats()
+        self._spawn_time = None # set until the first frame of a process is read
 
     def get_frame_info(self, time):
         """Returns a FrameInfo object corresponding to the given time.
@@ -114,9 +640,17 @@ class FfmpegReader:
         the eof attribute set to True will be returned.
 
         This method is optimized for sequential fetching of frames. If
-        the requested time is in the past or too far into the future a
-        complete reset of the internal state will occur to fetch that
-        frame.
+        the requested time is too far into the future a complete reset
+        of the internal state will occur to fetch that frame.
+
+        Fetching frames backwards in small steps, as when playing in
+        reverse, decodes reverse_chunk_size frames leading up to the
+        requested time and serves the following requests from those.
+        Other jumps into the past reset the internal state.
+
+        Fetching frames forward at a steady pace that skips frames, as
+        with sped up clips, makes ffmpeg drop the unused frames
+        before they are converted and piped.
 
         The FrameInfo object returned is cached so fetching the same
         frame multiple times has low cost.
@@ -124,14 +658,72 @@ class FfmpegReader:
         time -- The time in the video to fetch the frame from.
 
         """
-        # reset process if needed
-        if (not self._last_frame or
-            self._last_frame.start_time > time or
-            self._last_frame.end_time + self._reset_threshold < time):
-            self._setup_process(time)
+        if self._planner is None:
+            self._setup_video_info()
+
+        index = self.get_frame_index(time)
+        action, reason = self._planner.plan(time)
+
+        if action == ReadPlanner.CHUNK:
+            # short chunks end at the end of the video
+            return self._get_chunk_frame(index) or self._last_frame
+        if action == ReadPlanner.REVERSE:
+            return self._read_chunk(index)
+
+        self._chunk = []
+        if reason is not None:
+            self._setup_process(time, reason)
 
         # fast-forward if needed
-        while not self._last_frame.eof and self._last_frame.end_time < time:
+        while not self._last_frame.eof and self._last_frame.index < index:
+            self._next_frame()
+
+        return self._last_frame
+
+    def get_frame_index(self, time):
+        """Returns the index of the frame shown at time."""
+        if self._rate is None:
+            self._setup_video_info()
+        return common.get_frame_index(time, self._rate)
+
+    def get_frame_time(self, index):
+        """Returns the start time of the frame at index."""
+        if self._rate is None:
+            self._setup_video_info()
+        return common.get_frame_time(index, self._rate)
+
+    def _get_chunk_frame(self, index):
+        """Returns the frame at index from the reverse chunk or None."""
+        if (len(self._chunk) > 0 and
+            self._chunk[0].index <= index <= self._chunk[-1].index):
+            return self._chunk[index - self._chunk[0].index]
+        return None
+
+    def get_reverse_chunk_frames(self):
+        """Returns the number of frames decoded at a time when reading
+        backwards, reverse_chunk_size limited by reverse_chunk_bytes.
+
+        """
+        if self._planner is None:
+            self._setup_video_info()
+        return self._planner.reverse_chunk_frames
+
+    def _read_chunk(self, index):
+        """Decodes the frames leading up to and including index and
+        stores them as the reverse chunk. Returns the frame at index.
+
+        """
+        start = self._planner.chunk[0]
+
+        self._chunk = []
+        self._setup_process(self.get_frame_time(start), reason="reverse_chunk")
+
+        while True:
+            if self._last_frame.eof:
+                break
+            self._chunk.append(self._last_frame)
+            if self._last_frame.index >= index:
+                break
             self._next_frame()
 
         return self._last_frame
@@ -151,53 +743,74 @@ class FfmpegReader:
 
     def _setup_video_info(self):
         """Reads video information through ffprobe."""
-        cmd = [
-            _FFPROBE_PATH,
-            '-loglevel'       , '0',
-            '-of'             , 'csv=print_section=0:item_sep=,', # output format
-            '-select_streams' , 'v:0',
-            '-show_entries'   , 'stream=r_frame_rate,width,height',
-            self.filename
-        ]
-
-        result = subprocess.run(cmd, capture_output = True, text = True)
-
-        # TODO how do you know what order the values are printed in?
-        # Maybe use json format for this instead and parse properly.
-        w, h, f = result.stdout.split(',')
-        n, d = f.split('/')
+        if not os.path.exists(self.filename):
+            raise Exception(f"Video file does not exist: {self.filename}")
 
-        self.size = (int(w), int(h))
-        self.fps = int(n) / int(d)
+        probe = Ffprobe(self.filename)
+        if probe.fps_exact is None:
+            raise Exception(f"Unable to read video information from '{self.filename}'")
+
+        self.size = probe.size
+        if self.output_size is not None:
+            self.size = tuple(self.output_size)
+        elif self.scale is not None:
+            self.size = (max(1, round(self.size[0] * self.scale)),
+                         max(1, round(self.size[1] * self.scale)))
+        self._rate = common.to_rational(probe.fps_exact)
+        self.fps = float(self._rate)
         self._frame_size = self.size[0] * self.size[1] * 3
         self._frame_time = 1 / self.fps
+        self._planner = ReadPlanner(self._rate, self.size,
+                                    reverse_chunk_size = self.reverse_chunk_size,
+                                    reverse_chunk_bytes = self.reverse_chunk_bytes,
+                                    decimate_ratio = self.decimate_ratio,
+                                    reset_threshold = self.reset_threshold)
 
-    def _setup_process(self, start_time):
+    def _setup_process(self, start_time, reason):
         """Starts the underlaying ffmpeg process to fetch data from the video
         file. If there's currently a process it will be terminated
-        first.
+        first. Only the frames selected by the decimation of the
+        planner are read, if any.
 
         start_time -- The point in the video to start reading data.
 
-        """
-        if self._process:
-            self.close()
+        reason -- Why the process is started, counted in the
+        ffmpeg_spawn_<reason> stats counter.
 
-        if not os.path.exists(self.filename):
-            raise Exception(f"Video file does not exist: {self.filename}")
+        """
+        self._close_process()
 
         if self._frame_size is None:
             self._setup_video_info()
 
+        index = self.get_frame_index(start_time)
+
+        filters = []
+        options = []
+        self._decimation = self._planner.decimation
+        if self._decimation is not None:
+            filters.append("select='%s'" % self._decimation.get_expression())
+            options += ['-fps_mode', 'passthrough']
+        if self.scale is not None or self.output_size is not None:
+            filters.append("scale=%d:%d" % self.size)
+        if filters:
+            options = ['-vf', ','.join(filters), *options]
+
+        # ffmpeg starts at the first frame at or after the seek time,
+        # seek to the middle of the previous frame to start at the
+        # frame containing start_time
+        seek_time = max(0, (index - 0.5) * self._frame_time)
+
         cmd = [
             _FFMPEG_PATH,
             '-loglevel', 'quiet',
 
             # input video
-            '-ss' , "%.5f" % start_time, # start time
+            '-ss' , "%.5f" % seek_time, # start time
             '-i'  , self.filename,
 
             # output video
+            *options,
             '-f'       , 'rawvideo', # video format
             '-pix_fmt' , 'rgb24',    # pixel format
             '-codec:v' , 'rawvideo', # video codec
@@ -206,14 +819,26 @@ class FfmpegReader:
             # TODO '-ss' here to trim output?
         ]
 
+        stats.increment("ffmpeg_spawn")
+        stats.increment("ffmpeg_spawn_" + reason)
+        self.io.spawns += 1
+        if reason in ("restart", "decimation"):
+            self.io.restarts += 1
+            stats.increment("decoder_restarts")
+        elif reason != "first_use":
+            self.io.seeks += 1
+            stats.increment("decoder_seeks")
+
+        self._spawn_time = time.perf_counter()
         self._process = subprocess.Popen(cmd,
                                          bufsize = self._frame_size,
                                          stdout = subprocess.PIPE,
                                          #stderr = subprocess.PIPE,
                                          stdin = subprocess.DEVNULL)
-        self._next_frame(start_time)
+        _processes.add(self._process)
+        self._next_frame(index)
 
-    def _next_frame(self, time=None):
+    def _next_frame(self, index=None):
         """Advances to the next frame by reading it from the ffmpeg process
         output. This sets up the self._last_frame to contain the next
         frame.
@@ -221,25 +846,26 @@ class FfmpegReader:
         If there is no more data to read _last_frame will be populated
         and the eof attribute will be True.
 
-        time -- Indicates the time to use for the frame. Not the time
-        for the frame you want but the time that will be used for the
-        next frame. If time is not given the last frame will be used
-        to figure out this frames time.
+        index -- Index of the frame being read, used for the first
+        frame after starting a process. If not given the frame
+        following the last frame is assumed.
 
         """
         frame = FrameInfo()
 
-        if time is not None:
-            n = int(time / self._frame_time)
-            frame.start_time = n * self._frame_time
-            frame.end_time = frame.start_time + self._frame_time
+        if self._decimation is not None:
+            frame.index = self._decimation.start + self._decimation.next_index()
+        elif index is not None:
+            frame.index = index
         elif self._last_frame:
-            frame.start_time = self._last_frame.end_time
-            frame.end_time = frame.start_time + self._frame_time
+            frame.index = self._last_frame.index + 1
         else:
-            raise Exception("Unable to set frame time")
+            raise Exception("Unable to set frame index")
 
-        frame_bytes = self._process.stdout.read(self._frame_size)
+        frame.start_time = self.get_frame_time(frame.index)
+        frame.end_time = self.get_frame_time(frame.index + 1)
+
+        frame_bytes = self._read_frame_bytes()
 
         if len(frame_bytes) == 0:
             frame.eof = True
@@ -251,15 +877,45 @@ class FfmpegReader:
 
         frame.image = PIL.Image.frombytes("RGB", self.size, frame_bytes)
         frame.image = frame.image.convert("RGBA")
+        stats.increment("image_alloc")
+        stats.increment("image_convert")
+        self.io.frames += 1
         self._last_frame = frame
 
-    def close(self):
+    def _read_frame_bytes(self):
+        """Reads the next frame from the process and accounts for the
+        time spent waiting on it.
+
+        """
+        start = time.perf_counter()
+        frame_bytes = self._process.stdout.read(self._frame_size)
+        end = time.perf_counter()
+        stats.increment("decoder_bytes", len(frame_bytes))
+
+        if self._spawn_time is not None:
+            self.io.startup_time += end - self._spawn_time
+            stats.increment("decoder_startup_seconds", end - self._spawn_time)
+            self._spawn_time = None
+        else:
+            self.io.blocked_time += end - start
+            stats.increment("decoder_blocked_seconds", end - start)
+
+        return frame_bytes
+
+    def _close_process(self):
         if self._process:
             self._process.stdout.close()
             # TODO close things right self._process.terminate()
             self._process.wait()
             self._process = None
         self._last_frame = None
+        self._decimation = None
+
+    def close(self):
+        self._close_process()
+        self._chunk = []
+        if self._planner is not None:
+            self._planner.close()
 
     def __enter__(self):
         return self
@@ -275,6 +931,7 @@ class Ffprobe:
         self.size = None
         self.fps = None
         self.fps_exact = None
+        self.pix_fmt = None
         self.duration = None
 
         self._run()
@@ -290,17 +947,19 @@ class Ffprobe:
             '-hide_banner',
         ]
 
+        stats.increment("ffprobe")
         result = subprocess.run(cmd, capture_output = True, text = True)
         if result is None or result.stdout is None:
             logger.debug("ffprobe failed for: %s" % self.filename)
         else:
-            data = json.loads(result.stdout)
+            data = json.loads(result.stdout or "{}")
 
-            for stream in data['streams']:
+            for stream in data.get('streams', []):
                 if stream['codec_type'] == 'video':
                     self.width = int(stream['width'])
                     self.height = int(stream['height'])
                     self.size = (self.width, self.height)
+                    self.pix_fmt = stream.get('pix_fmt')
 
                     n, d = stream['r_frame_rate'].split('/')
                     self.fps_exact = (int(n), int(d))
@@ -308,22 +967,176 @@ class Ffprobe:
 
                     break
 
-            self.duration = float(data['format']['duration'])
+            duration = data.get('format', {}).get('duration')
+            if duration is not None:
+                self.duration = float(duration)
+
+_DECIMATION_TOLERANCE = 1e-6
+
+class Decimation:
+    def __init__(self, start_frame, ratio):
+        """Selection of frames needed when reading every ratio frames
+        starting at start_frame. Frames are counted from the first
+        frame read.
+
+        start_frame -- Frame position of the first request, may be
+        fractional.
+
+        ratio -- Distance in frames between requests.
+
+        """
+        self.start = int(start_frame)
+        self.phase = start_frame - self.start
+        self.ratio = ratio
+        self.last_index = -1
+
+        # snap values that are off due to rounding errors
+        if abs(self.ratio - round(self.ratio)) < _DECIMATION_TOLERANCE:
+            self.ratio = float(round(self.ratio))
+        if self.phase > 1 - _DECIMATION_TOLERANCE:
+            self.start += 1
+            self.phase = 0.0
+        elif self.phase < _DECIMATION_TOLERANCE:
+            self.phase = 0.0
+
+    def matches(self, ratio):
+        """Returns True if ratio is the same as this decimation ratio
+        give or take rounding errors.
+
+        """
+        return abs(self.ratio - ratio) < self.ratio * _DECIMATION_TOLERANCE
+
+    def get_expression(self):
+        """Returns an ffmpeg select expression for the needed frames."""
+        return "lt(ceil((n-%r)/%r)*%r+%r,n+1)" % (
+            self.phase, self.ratio, self.ratio, self.phase)
+
+    def is_selected(self, n):
+        """Same as the ffmpeg expression, evaluated the same way so that
+        the results match exactly.
+
+        """
+        return math.ceil((n - self.phase) / self.ratio) * self.ratio + self.phase < n + 1
+
+    def next_index(self):
+        """Advances to and returns the index of the next selected frame."""
+        n = self.last_index + 1
+        while not self.is_selected(n):
+            n += 1
+        self.last_index = n
+        return n
 
 class FrameInfo:
     def __init__(self):
         self.image = None
+        self.index = 0
         self.start_time = 0
         self.end_time = 0
         self.eof = False
 
+def get_proxy(filename, height=540):
+    """Returns the path to a proxy of the given video, creating it if
+    needed. Proxies are lower resolution copies using only intra
+    frames (MJPEG), making seeking and decoding cheap.
+
+    Proxies are stored in the proxies folder of the kmvid cache
+    directory and are keyed on the path, size and modification time
+    of the source, so changed sources get new proxies.
+
+    filename -- The source video.
+
+    height -- Height of the proxy. Width follows the aspect ratio.
+
+    """
+    stat = os.stat(filename)
+    key = "%s:%d:%d:%d" % (os.path.abspath(filename),
+                           stat.st_size,
+                           stat.st_mtime_ns,
+                           height)
+    name = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".mkv"
+    path = os.path.join(_CACHE_DIR, "proxies", name)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary name so that interrupted transcodes are
+        # never mistaken for finished proxies
+        tmp_path = "%s.%d.tmp.mkv" % (path, os.getpid())
+        cmd = [
+            _FFMPEG_PATH,
+            '-y',
+            '-loglevel', 'quiet',
+            '-i'       , filename,
+            '-an'      ,                     # no audio
+            '-vf'      , 'scale=-2:%d' % height,
+            '-codec:v' , 'mjpeg',            # intra frames only
+            '-q:v'     , '3',                # jpeg quality
+            '-fps_mode', 'passthrough',      # keep source timestamps
+            tmp_path,
+        ]
+
+        logger.info("Creating proxy for %s" % filename)
+        stats.increment("ffmpeg_spawn")
+        stats.increment("ffmpeg_spawn_proxy")
+        result = subprocess.run(cmd, stdin = subprocess.DEVNULL)
+        if result.returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise Exception("Failed creating proxy for '%s', ffmpeg exited with code %d" % (
+                filename, result.returncode))
+        os.replace(tmp_path, path)
+
+    return path
+
 def get_video_formats():
     """Returns a dict of {<file ending>: <format name>} for formats
     supported by ffmpeg. File endings are lowercase. Supported formats
     may vary between ffmpeg versions.
 
+    The result is computed on first use and cached, both in memory
+    and on disk in the kmvid cache directory (KMVID_CACHE_DIR
+    environment variable, defaults to ~/.cache/kmvid). The disk cache
+    is keyed on the ffmpeg executable so upgrading ffmpeg refreshes
+    it. If ffmpeg can't be found an empty dict is returned.
+
     """
-    cmd = [_FFMPEG_PATH, '-formats', '-v', 'quiet']
+    global _video_formats
+    if _video_formats is None:
+        _video_formats = _load_video_formats()
+    return _video_formats
+
+def _load_video_formats():
+    executable = shutil.which(_FFMPEG_PATH)
+    if executable is None:
+        logger.debug("ffmpeg not found, no video formats available")
+        return {}
+
+    stat = os.stat(executable)
+    key = "%s:%d:%d" % (executable, stat.st_size, stat.st_mtime_ns)
+    path = os.path.join(_CACHE_DIR, "video_formats.json")
+
+    try:
+        with open(path, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get('key') == key:
+            return data['formats']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    formats = _read_video_formats(executable)
+
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        with open(path, 'w', encoding="utf-8") as f:
+            json.dump({'key': key, 'formats': formats}, f)
+    except OSError as e:
+        logger.debug("Unable to write video format cache %s: %s" % (path, e))
+
+    return formats
+
+def _read_video_formats(executable):
+    """Queries ffmpeg for the supported formats."""
+    cmd = [executable, '-formats', '-v', 'quiet']
     result = subprocess.run(cmd, capture_output = True, text = True)
     lines = result.stdout.split("\n")
     lines = lines[5:]
@@ -0,0 +1,629 @@
+import kmvid.data.clip as clip
+import kmvid.data.effect as effect
+import kmvid.data.ffmpeg as ffmpeg
+import kmvid.data.project as project
+import kmvid.data.resource as resource
+import kmvid.data.state as state
+import kmvid.data.text as text
+
+import PIL.Image
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+class Event:
+    def __init__(self, kind, name, node_id, start):
+        """A timed call of an instrumented method.
+
+        kind -- 'clip', 'effect', 'resource', 'writer' or 'frame'.
+
+        name -- Type name of the instrumented object.
+
+        node_id -- global_id of the clip or effect, None for other
+        objects.
+
+        start -- Start time in seconds, relative to the profiler start.
+
+        """
+        self.kind = kind
+        self.name = name
+        self.node_id = node_id
+        self.start = start
+        self.duration = 0
+        self.self_duration = 0
+        self.pixels = 0
+        self.thread_id = threading.get_ident()
+        self.frame_time = None
+
+class Stat:
+    def __init__(self, kind, name, node_id):
+        self.kind = kind
+        self.name = name
+        self.node_id = node_id
+        self.count = 0
+        self.total = 0
+        self.self_total = 0
+        self.pixels = 0
+
+    def add(self, event):
+        self.count += 1
+        self.total += event.duration
+        self.self_total += event.self_duration
+        self.pixels += event.pixels
+
+def _get_pixels(image):
+    if image is None:
+        return 0
+    return image.size[0] * image.size[1]
+
+class Profiler:
+    """Records the time spent rendering clips, applying effects,
+    reading resources and writing frames.
+
+    The render methods are wrapped while the profiler is active and
+    restored afterwards, so there is no overhead when it isn't used.
+
+        with profiler.Profiler() as prof:
+            project.write()
+
+        print(prof.get_summary())
+        prof.save_trace("trace.json") # chrome://tracing or Perfetto
+
+    """
+
+    def __init__(self):
+        self.events = []
+        self._start = None
+        self._local = threading.local()
+        self._patches = []
+
+    def start(self):
+        """Starts recording. Prefer using the profiler as a context
+        manager.
+
+        """
+        self._start = time.perf_counter()
+
+        classes = [effect.Effect]
+        while classes:
+            cls = classes.pop()
+            classes.extend(cls.__subclasses__())
+            if 'apply' in cls.__dict__:
+                self._patch(cls, 'apply', 'effect', self._wrap_effect)
+
+        classes = [resource.Resource]
+        while classes:
+            cls = classes.pop()
+            classes.extend(cls.__subclasses__())
+            if 'get_frame' in cls.__dict__:
+                self._patch(cls, 'get_frame', 'resource', self._wrap_resource)
+
+        self._patch(clip.Clip, '_get_frame_internal', 'clip', self._wrap_clip)
+        self._patch(ffmpeg.FfmpegWriter, 'write_frame', 'writer', self._wrap_writer)
+
+    def stop(self):
+        """Stops recording and restores the instrumented methods."""
+        for cls, name, original in reversed(self._patches):
+            setattr(cls, name, original)
+        self._patches = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _patch(self, cls, name, kind, wrap):
+        original = cls.__dict__[name]
+        self._patches.append((cls, name, original))
+        setattr(cls, name, wrap(original, kind))
+
+    def _begin(self, kind, name, node_id):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        event = Event(kind, name, node_id, time.perf_counter() - self._start)
+        stack.append(event)
+        return event
+
+    def _end(self, event, pixels):
+        event.duration = time.perf_counter() - self._start - event.start
+        event.pixels = pixels
+
+        stack = self._local.stack
+        stack.pop()
+
+        event.self_duration += event.duration
+        if stack:
+            stack[-1].self_duration -= event.duration
+
+        self.events.append(event)
+
+    def _wrap_clip(self, fn, kind):
+        profiler = self
+
+        @functools.wraps(fn)
+        def wrapper(self, parent_image):
+            frame = None
+            if parent_image is None:
+                frame = profiler._begin('frame', 'Frame', None)
+                frame.frame_time = state.global_time
+
+            event = profiler._begin(kind, type(self).__name__, self.global_id)
+            render = None
+            try:
+                render = fn(self, parent_image)
+                return render
+            finally:
+                pixels = _get_pixels(render.image if render else None)
+                profiler._end(event, pixels)
+                if frame is not None:
+                    profiler._end(frame, pixels)
+
+        return wrapper
+
+    def _wrap_effect(self, fn, kind):
+        profiler = self
+
+        @functools.wraps(fn)
+        def wrapper(self, render):
+            event = profiler._begin(kind, type(self).__name__, self.global_id)
+            try:
+                return fn(self, render)
+            finally:
+                profiler._end(event, _get_pixels(render.image))
+
+        return wrapper
+
+    def _wrap_resource(self, fn, kind):
+        profiler = self
+
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            event = profiler._begin(kind, type(self).__name__, None)
+            image = None
+            try:
+                image = fn(self, *args, **kwargs)
+                return image
+            finally:
+                profiler._end(event, _get_pixels(image))
+
+        return wrapper
+
+    def _wrap_writer(self, fn, kind):
+        profiler = self
+
+        @functools.wraps(fn)
+        def wrapper(self, image):
+            event = profiler._begin(kind, type(self).__name__, None)
+            try:
+                return fn(self, image)
+            finally:
+                profiler._end(event, _get_pixels(image))
+
+        return wrapper
+
+    def get_stats(self, by_node=False):
+        """Returns a list of Stat objects aggregated over the whole
+        recording, sorted by self time with the most expensive first.
+        Self time excludes time spent in nested instrumented calls.
+
+        by_node -- If True clips and effects are aggregated per
+        global_id rather than per type.
+
+        """
+        stats = collections.OrderedDict()
+        for event in self.events:
+            if event.kind == 'frame':
+                continue
+            key = (event.kind, event.name, event.node_id if by_node else None)
+            if key not in stats:
+                stats[key] = Stat(*key)
+            stats[key].add(event)
+
+        return sorted(stats.values(), key=lambda s: s.self_total, reverse=True)
+
+    def get_frames(self):
+        """Returns a list of (frame time, duration, {type name: self
+        time}) tuples, one per rendered frame.
+
+        """
+        frames = []
+        events = sorted((e for e in self.events if e.kind != 'frame'),
+                        key=lambda e: e.start)
+        index = 0
+        for frame in sorted((e for e in self.events if e.kind == 'frame'),
+                            key=lambda e: e.start):
+            totals = collections.Counter()
+            while index < len(events) and events[index].start < frame.start:
+                index += 1
+            while (index < len(events) and
+                   events[index].start < frame.start + frame.duration):
+                if events[index].thread_id == frame.thread_id:
+                    totals[events[index].name] += events[index].self_duration
+                index += 1
+            frames.append((frame.frame_time, frame.duration, dict(totals)))
+        return frames
+
+    def get_summary(self, count=10, by_node=False):
+        """Returns a text table of the count most expensive entries."""
+        frames = [e for e in self.events if e.kind == 'frame']
+        total = sum(e.duration for e in frames)
+
+        lines = ["%d frames in %.3f s" % (len(frames), total)]
+        if frames:
+            lines[0] += ", %.2f ms per frame" % (total / len(frames) * 1000)
+
+        lines.append("%-10s %-24s %8s %10s %10s %8s %12s" % (
+            "kind", "name", "id", "self ms", "total ms", "calls", "Mpixels"))
+        for stat in self.get_stats(by_node)[:count]:
+            lines.append("%-10s %-24s %8s %10.2f %10.2f %8d %12.2f" % (
+                stat.kind,
+                stat.name,
+                "" if stat.node_id is None else stat.node_id,
+                stat.self_total * 1000,
+                stat.total * 1000,
+                stat.count,
+                stat.pixels / 1e6))
+        return "\n".join(lines)
+
+    def get_trace(self):
+        """Returns the recording in the Chrome trace event format, which
+        can also be opened in Perfetto.
+
+        """
+        pid = os.getpid()
+        trace_events = []
+        for event in self.events:
+            args = {'pixels': event.pixels}
+            if event.node_id is not None:
+                args['global_id'] = event.node_id
+            if event.frame_time is not None:
+                args['time'] = event.frame_time
+
+            trace_events.append({
+                'name': event.name,
+                'cat': event.kind,
+                'ph': 'X',
+                'ts': event.start * 1e6,
+                'dur': event.duration * 1e6,
+                'pid': pid,
+                'tid': event.thread_id,
+                'args': args,
+            })
+
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def save_trace(self, path):
+        """Writes the trace returned by get_trace to path as json."""
+        with open(path, 'w', encoding="utf-8") as f:
+            json.dump(self.get_trace(), f)
+
+def _get_rss():
+    """Returns the current resident set size in bytes. Falls back to
+    the peak where the current size isn't available.
+
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return project._get_peak_rss()
+
+def _find_images(obj, depth=4):
+    """Yields the PIL images held by obj, looking through containers,
+    futures and the attributes of kmvid objects up to depth levels
+    down.
+
+    """
+    if isinstance(obj, PIL.Image.Image):
+        yield obj
+    elif depth <= 0 or obj is None:
+        return
+    elif isinstance(obj, concurrent.futures.Future):
+        if obj.done() and not obj.cancelled() and obj.exception() is None:
+            yield from _find_images(obj.result(), depth - 1)
+    elif isinstance(obj, dict):
+        for value in list(obj.values()):
+            yield from _find_images(value, depth - 1)
+    elif isinstance(obj, (list, tuple, set, collections.deque)):
+        for value in list(obj):
+            yield from _find_images(value, depth - 1)
+    elif type(obj).__module__.startswith("kmvid.") and hasattr(obj, '__dict__'):
+        for value in list(vars(obj).values()):
+            yield from _find_images(value, depth - 1)
+
+def _count_images(obj, seen):
+    """Returns the bytes of images held by obj that aren't in seen, and
+    adds them to seen.
+
+    """
+    total = 0
+    for image in _find_images(obj):
+        if id(image) not in seen:
+            seen.add(id(image))
+            total += resource._get_image_bytes(image)
+    return total
+
+def _format_bytes(value):
+    if abs(value) < 1e6:
+        return "%.1f kB" % (value / 1e3)
+    return "%.1f MB" % (value / 1e6)
+
+def _iter_clips(root):
+    yield root
+    for item in root.items:
+        if isinstance(item, clip.Clip):
+            yield from _iter_clips(item)
+
+class MemorySample:
+    def __init__(self, frame, time):
+        """Memory use after rendering a frame.
+
+        frame -- Number of frames rendered so far.
+
+        time -- Global time of the frame.
+
+        """
+        self.frame = frame
+        self.time = time
+        self.rss_bytes = 0
+        self.traced_bytes = None
+        self.traced_peak_bytes = None
+        self.image_bytes = {} # owner -> bytes of live images
+        self.open_resources = 0
+        self.unattached_resources = {} # type name -> count
+        self.font_variants = 0
+        self.ffmpeg_processes = 0
+        self.snapshot = None
+
+    def to_dict(self):
+        return {
+            'frame': self.frame,
+            'time': self.time,
+            'rss_bytes': self.rss_bytes,
+            'traced_bytes': self.traced_bytes,
+            'traced_peak_bytes': self.traced_peak_bytes,
+            'image_bytes': self.image_bytes,
+            'open_resources': self.open_resources,
+            'unattached_resources': self.unattached_resources,
+            'font_variants': self.font_variants,
+            'ffmpeg_processes': self.ffmpeg_processes,
+        }
+
+class MemoryProfiler:
+    """Samples memory use every few frames while rendering and points
+    out what keeps growing.
+
+    Each sample holds the RSS, the python memory traced by tracemalloc
+    and the bytes of live images by owner: the image cache, the clip
+    owning a resource, or resources that are open but no longer part
+    of the rendered tree.
+
+        with profiler.MemoryProfiler(every=10) as mem:
+            project.write()
+
+        print(mem.get_summary())
+        mem.save("memory.json")
+
+    """
+
+    def __init__(self, every=10, trace=True, trace_frames=1):
+        """every -- Number of frames between samples.
+
+        trace -- If True python allocations are traced with
+        tracemalloc, which makes rendering noticeably slower but
+        shows where growing memory is allocated.
+
+        trace_frames -- Number of stack frames stored per traced
+        allocation.
+
+        """
+        self.every = every
+        self.trace = trace
+        self.trace_frames = trace_frames
+        self.samples = []
+        self.frames = 0
+        self._patches = []
+        self._started_tracing = False
+
+    def start(self):
+        """Starts sampling. Prefer using the profiler as a context
+        manager.
+
+        """
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+            self._started_tracing = True
+
+        original = clip.Clip.__dict__['_get_frame_internal']
+        self._patches.append((clip.Clip, '_get_frame_internal', original))
+        setattr(clip.Clip, '_get_frame_internal', self._wrap_clip(original))
+
+    def stop(self):
+        """Stops sampling and restores the instrumented methods."""
+        for cls, name, original in reversed(self._patches):
+            setattr(cls, name, original)
+        self._patches = []
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _wrap_clip(self, fn):
+        profiler = self
+
+        @functools.wraps(fn)
+        def wrapper(self, parent_image):
+            render = fn(self, parent_image)
+            if parent_image is None:
+                profiler.frames += 1
+                if (profiler.frames - 1) % profiler.every == 0:
+                    profiler.sample(self)
+            return render
+
+        return wrapper
+
+    def sample(self, root=None):
+        """Records a sample and returns it.
+
+        root -- Root clip of the render, used to attribute images to
+        clips. Without it images held by resources are attributed to
+        the resources alone.
+
+        """
+        s = MemorySample(self.frames, state.global_time)
+        s.rss_bytes = _get_rss()
+        s.ffmpeg_processes = ffmpeg.get_process_count()
+
+        if tracemalloc.is_tracing():
+            s.traced_bytes, s.traced_peak_bytes = tracemalloc.get_traced_memory()
+            s.snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ])
+
+        # the cache is counted first so that images it shares with
+        # resources are attributed to it
+        seen = set()
+        s.image_bytes['image_cache'] = _count_images(
+            list(resource.image_cache._images.values()), seen)
+
+        attached = set()
+        if root is not None:
+            for c in _iter_clips(root):
+                attached.add(id(c.resource))
+                size = _count_images(c.resource, seen)
+                if size:
+                    key = "clip %s %s" % (c.global_id, type(c.resource).__name__)
+                    s.image_bytes[key] = size
+
+        managed = (list(state.resource_manager.resources)
+                   if state.resource_manager else [])
+        s.open_resources = len(managed)
+        for r in managed:
+            if id(r) in attached:
+                continue
+            name = type(r).__name__
+            if root is not None:
+                s.unattached_resources[name] = s.unattached_resources.get(name, 0) + 1
+            size = _count_images(r, seen)
+            if size:
+                key = ("unattached " if root is not None else "") + name
+                s.image_bytes[key] = s.image_bytes.get(key, 0) + size
+
+        s.font_variants = sum(len(data.cache)
+                              for data in text.font_cache.font_data.values())
+
+        self.samples.append(s)
+        return s
+
+    def get_leaks(self, count=5, min_traced_bytes=64 * 1024):
+        """Returns a list of (description, first value, last value)
+        for things that grew between the first and last sample.
+
+        Images and counts are included if they grew in most of the
+        samples, traced allocations are the count sites that grew the
+        most, by at least min_traced_bytes.
+
+        """
+        if len(self.samples) < 2:
+            return []
+
+        first, last = self.samples[0], self.samples[-1]
+        leaks = []
+
+        def growing(get):
+            values = [get(s) for s in self.samples]
+            steps = [b > a for a, b in zip(values, values[1:])]
+            return values[-1] > values[0] and sum(steps) * 2 >= len(steps)
+
+        for key in sorted(set(last.image_bytes) | set(first.image_bytes)):
+            if growing(lambda s: s.image_bytes.get(key, 0)):
+                leaks.append(("images " + key,
+                              first.image_bytes.get(key, 0),
+                              last.image_bytes.get(key, 0)))
+
+        if growing(lambda s: s.font_variants):
+            leaks.append(("font variants", first.font_variants, last.font_variants))
+
+        for key in sorted(last.unattached_resources):
+            if growing(lambda s: s.unattached_resources.get(key, 0)):
+                leaks.append(("unclosed " + key,
+                              first.unattached_resources.get(key, 0),
+                              last.unattached_resources[key]))
+
+        if growing(lambda s: s.ffmpeg_processes):
+            leaks.append(("ffmpeg processes", first.ffmpeg_processes,
+                          last.ffmpeg_processes))
+
+        if first.snapshot is not None and last.snapshot is not None:
+            diffs = last.snapshot.compare_to(first.snapshot, 'lineno')
+            for diff in diffs[:count]:
+                if diff.size_diff < min_traced_bytes:
+                    break
+                frame = diff.traceback[0]
+                leaks.append(("traced %s:%d" % (frame.filename, frame.lineno),
+                              diff.size - diff.size_diff,
+                              diff.size))
+
+        return leaks
+
+    def get_summary(self, count=5):
+        """Returns a compact text report of the samples."""
+        if not self.samples:
+            return "no samples"
+
+        first, last = self.samples[0], self.samples[-1]
+        mb = _format_bytes
+
+        lines = ["%d frames, %d samples every %d frames" % (
+            self.frames, len(self.samples), self.every)]
+        lines.append("%-12s %s -> %s (max %s)" % (
+            "rss", mb(first.rss_bytes), mb(last.rss_bytes),
+            mb(max(s.rss_bytes for s in self.samples))))
+        if last.traced_bytes is not None:
+            lines.append("%-12s %s -> %s (peak %s)" % (
+                "traced", mb(first.traced_bytes), mb(last.traced_bytes),
+                mb(last.traced_peak_bytes)))
+
+        owners = sorted(last.image_bytes.items(), key=lambda i: i[1], reverse=True)
+        lines.append("%-12s %s in %d owners" % (
+            "images", mb(sum(last.image_bytes.values())),
+            len([o for o in owners if o[1]])))
+        for owner, size in owners[:count]:
+            if size:
+                lines.append("    %-40s %10s" % (owner, mb(size)))
+
+        leaks = self.get_leaks(count)
+        lines.append("possible leaks" if leaks else "no growth between samples")
+        for name, before, after in leaks:
+            if name.startswith(("images", "traced")):
+                before, after = mb(before), mb(after)
+            lines.append("    %-40s %10s -> %s" % (name, before, after))
+
+        return "\n".join(lines)
+
+    def save(self, path):
+        """Writes the samples and leaks to path as json."""
+        with open(path, 'w', encoding="utf-8") as f:
+            json.dump({
+                'every': self.every,
+                'frames': self.frames,
+                'samples': [s.to_dict() for s in self.samples],
+                'leaks': self.get_leaks(),
+            }, f)
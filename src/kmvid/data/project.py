@@ -1,16 +1,30 @@
+import kmvid.data.analysis as analysis
 import kmvid.data.clip as clip
 import kmvid.data.common as common
 import kmvid.data.ffmpeg as ffmpeg
+import kmvid.data.resource as resource
 import kmvid.data.state as state
+import kmvid.data.stats as stats
 import kmvid.data.variable as variable
 
+import collections
+import concurrent.futures
+import contextlib
+import enum
+import fractions
+import json
 import math
+import os
 import sys
 import threading
 import time
 
 import PIL.Image
 
+class FrameFormat(enum.Enum):
+    PIL = 0
+    NUMPY = 1
+
 @variable.holder
 class Project(common.Node, variable.VariableHold):
     """Project is the base for rendering. It contains convenience
@@ -34,6 +48,54 @@ class Project(common.Node, variable.VariableHold):
         project. If duration is not set and not able to be derived
         some rendering functions will fail."""
     )
+    pixel_format = variable.VariableConfig(
+        ffmpeg.PixelFormat, ffmpeg.PixelFormat.RGB24,
+        doc="""Pixel format used to pipe frames to the encoder.
+
+        YUV420P and NV12 convert frames before piping them, sending
+        half as much data as RGB24. Width and height must be even.""")
+    preset = variable.VariableConfig(
+        str, "medium",
+        doc="""x264 preset, from ultrafast to veryslow.""")
+    crf = variable.VariableConfig(
+        int, None,
+        doc="""x264 constant rate factor. Lower values give better
+        quality. Uses the x264 default if not set.""")
+    threads = variable.VariableConfig(
+        int, None,
+        doc="""Number of encoder threads. Uses the ffmpeg default if not
+        set.""")
+    tune = variable.VariableConfig(
+        str, None,
+        doc="""x264 tune option, such as film or animation.""")
+    output_format = variable.VariableConfig(
+        ffmpeg.OutputFormat, ffmpeg.OutputFormat.FILE,
+        doc="""Container written by write.
+
+        HLS writes filename as a playlist (.m3u8) with segments next to
+        it, FRAGMENTED_MP4 writes an mp4 file that can be played while
+        it is being rendered.""")
+    segment_duration = variable.VariableConfig(
+        float, 2,
+        doc="""Target duration in seconds of HLS segments and mp4
+        fragments.""")
+    render_scale = variable.VariableConfig(
+        float, 1,
+        doc="""Scale to render at, such as 0.5 or 0.25 for drafts.
+
+        The output size, pixel variables and resource frames are all
+        scaled so the composition stays the same while rendering costs
+        roughly the square of the scale.""")
+    proxy_height = variable.VariableConfig(
+        int, None,
+        doc="""Height of video proxies, disabled if not set.
+
+        Previews (get_frame, session and get_frame_wall) read videos
+        taller than this from low resolution intra frame copies,
+        created once and cached on disk, making seeking cheap. Proxies
+        are never used at render_scale 1, they are only read when
+        render_scale is below 1 and shows the video at or below this
+        height. This also applies to write and iter_frames.""")
 
     def __init__(self, *args, **kwargs):
         common.Node.__init__(self)
@@ -62,12 +124,183 @@ class Project(common.Node, variable.VariableHold):
         Call 'show' on the image to display it directly.
 
         """
-        with state.State():
-            state.set_time(time)
-            render = self.root_clip.get_frame()
-            return render.image
+        with self.session() as session:
+            return session.get_frame(time)
+
+    def session(self, render_scale=None):
+        """Returns a Session for rendering several frames with
+        resources kept open in between, such as when scrubbing.
+
+        with project.session() as s:
+            s.get_frame(1.5)
+
+        render_scale -- Overrides the render_scale variable.
+
+        """
+        return Session(self, render_scale)
+
+    def make_proxies(self):
+        """Creates proxies for all videos in the project, see the
+        proxy_height variable. Otherwise proxies are created on first
+        use.
+
+        """
+        if self.proxy_height is None:
+            return
+
+        clips = [self.root_clip]
+        while clips:
+            c = clips.pop()
+            if isinstance(c.resource, resource.VideoResource):
+                if c.resource.get_info().height > self.proxy_height:
+                    ffmpeg.get_proxy(c.resource.path, self.proxy_height)
+            clips.extend(i for i in c.items if isinstance(i, clip.Clip))
+
+    def get_render_size(self):
+        """Returns the (width, height) of rendered frames, taking
+        render_scale into account.
+
+        """
+        if self.render_scale == 1:
+            return (self.width, self.height)
+        return (max(1, round(self.width * self.render_scale)),
+                max(1, round(self.height * self.render_scale)))
+
+    def iter_frames(self, start=0, end=None, step=None, fmt=FrameFormat.PIL):
+        """Generator yielding frames from start until end.
+
+        The same state is kept for all frames so videos are decoded
+        sequentially instead of being reopened and seeked for every
+        frame. The generator should be exhausted or closed before
+        rendering anything else.
+
+        start -- Time of the first frame.
+
+        end -- Time to stop at, not included. Defaults to the project
+        duration.
+
+        step -- Time between frames. Defaults to one frame at the
+        project fps.
+
+        fmt -- FrameFormat of the yielded frames, PIL images or numpy
+        arrays of shape (height, width, 3).
+
+        """
+        fmt = common.to_enum(fmt, FrameFormat)
+        if fmt == FrameFormat.NUMPY:
+            import numpy as np
+
+        for render in self._iter_renders(start, end, step):
+            if fmt == FrameFormat.NUMPY:
+                yield np.asarray(render.image)
+            else:
+                yield render.get_writable_image()
+
+    def analyze(self, start=0, end=None, step=None):
+        """Walks the timeline without reading or drawing any frames and
+        returns an analysis.Analysis of how resources will be
+        accessed: sequential runs, skips and jumps per resource,
+        estimated decoder restarts, concurrent readers of the same
+        file and the peak number of open resources.
+
+        print(project.analyze().get_summary())
+
+        start, end, step -- See iter_frames.
 
-    def get_frame_wall(self, width=1920, cols=3, rows=None, frame_selection=None):
+        """
+        return analysis.analyze(self.root_clip,
+                                self._iter_times(start, end, step),
+                                self.fps)
+
+    def estimate_costs(self, start=0, end=None, step=None, model=None):
+        """Returns a list of (time, seconds) with the estimated cost of
+        rendering each frame, from the active clips, their effects and
+        sizes, and expected decoder restarts. Nothing is rendered.
+
+        start, end, step -- See iter_frames.
+
+        model -- analysis.CostModel, such as one calibrated from a
+        profiler run with CostModel.from_profiler.
+
+        """
+        times = list(self._iter_times(start, end, step))
+        return list(zip(times, analysis.estimate_costs(self.root_clip,
+                                                       times,
+                                                       model,
+                                                       self.render_scale)))
+
+    def get_segments(self, count, start=0, end=None, step=None, model=None):
+        """Splits the frames from start to end into at most count
+        consecutive segments of roughly equal estimated cost, for
+        rendering in parallel. Returns a list of (start, end) times to
+        pass on to iter_frames, as fractions.Fraction on the frame grid
+        so that each frame falls in exactly one segment.
+
+        start, end, step -- See iter_frames.
+
+        model -- See estimate_costs.
+
+        """
+        first_time, step, _ = self._get_time_grid(start, end, step)
+        frames = self.estimate_costs(start, end, step, model)
+
+        return [(first_time + first * step, first_time + last * step)
+                for first, last in analysis.partition([c for _, c in frames],
+                                                      count)]
+
+    def get_frame_rate(self):
+        """Returns the frame rate as an exact fractions.Fraction, such as
+        30000/1001 for 29.97 fps.
+
+        """
+        return common.to_rational(self.fps)
+
+    def get_frame_count(self, start=0, end=None, step=None):
+        """Returns the number of frames iter_frames yields.
+
+        start, end, step -- See iter_frames.
+
+        """
+        return self._get_time_grid(start, end, step)[2]
+
+    def _get_time_grid(self, start=0, end=None, step=None):
+        """Returns (start, step, count) of the frames from start to end
+        as exact fractions.
+
+        """
+        # times are computed from the frame number using exact
+        # fractions, accumulating a float step drifts and adds or drops
+        # a frame at the end of long renders
+        def exact(value):
+            # floats such as 0.1 are read as the decimal they were
+            # written as, not their slightly larger binary value
+            return fractions.Fraction(value).limit_denominator(1000000)
+
+        if end is None:
+            end = self.duration
+        step = (1 / self.get_frame_rate()) if step is None else exact(step)
+
+        start = exact(start)
+        count = max(0, math.ceil((exact(end) - start) / step))
+        return start, step, count
+
+    def _iter_times(self, start=0, end=None, step=None):
+        start, step, count = self._get_time_grid(start, end, step)
+        for n in range(count):
+            yield float(start + n * step)
+
+    def _iter_renders(self, start=0, end=None, step=None):
+        # proxies are only good enough for drafts
+        proxy_height = self.proxy_height if self.render_scale < 1 else None
+
+        with state.State(render_scale = self.render_scale,
+                         proxy_height = proxy_height):
+            for time in self._iter_times(start, end, step):
+                state.set_time(time)
+                yield self.root_clip.get_frame()
+
+    def get_frame_wall(self, width=1920, cols=3, rows=None, frame_selection=None,
+                       workers=1, render_scale=None, cost_model=None):
         """Returns an image with a grid of frames from the project.
 
         Call 'show' on the image to display it directly.
@@ -87,6 +320,21 @@ class Project(common.Node, variable.VariableHold):
         it will be set automatically to accommodate all the given
         times.
 
+        workers -- Number of processes rendering tiles. Each process
+        renders a consecutive range of the selected times, with ranges
+        balanced by estimated cost. The project is sent to the
+        processes in its simple form, so state changed at runtime,
+        such as fonts added with text.font_cache.register_path, is not
+        shared with them. Use workers=1 for projects that depend on
+        it. Operations in the processes are not counted in stats.
+
+        render_scale -- Scale to render tiles at, overriding the
+        render_scale variable. Rendering close to the tile size, such
+        as 'width / cols / project.width', is much faster than
+        rendering full frames and scaling them down.
+
+        cost_model -- analysis.CostModel used to balance workers.
+
         """
         if frame_selection is None:
             rows = rows or 3
@@ -101,36 +349,100 @@ class Project(common.Node, variable.VariableHold):
         tile_height = int(tile_width / self.width * self.height)
         image = PIL.Image.new("RGB", size=(width, tile_height * rows))
 
-        with state.State():
-            count = 0
-            for time in frame_selection:
-                frame = self.get_frame(time)
-                if frame is not None:
-                    tile = frame.resize((tile_width, tile_height))
-                    x = (count % cols) * tile_width
-                    y = int(count / cols) * tile_height
-                    image.paste(tile, (x, y))
-                count += 1
+        # render in time order so videos are decoded forward only
+        order = sorted(range(len(frame_selection)),
+                       key=lambda n: frame_selection[n])
+        times = [frame_selection[n] for n in order]
+        tile_size = (tile_width, tile_height)
+
+        if workers > 1 and len(times) > 1:
+            costs = analysis.estimate_costs(
+                self.root_clip, times, cost_model,
+                self.render_scale if render_scale is None else render_scale)
+            runs = [times[first:last]
+                    for first, last in analysis.partition(costs, workers)]
+            data = self.to_simple().get_json()
+
+            with concurrent.futures.ProcessPoolExecutor(len(runs)) as pool:
+                tiles = []
+                for run_tiles in pool.map(_render_tiles,
+                                          [data] * len(runs),
+                                          runs,
+                                          [tile_size] * len(runs),
+                                          [render_scale] * len(runs)):
+                    tiles.extend(run_tiles)
+        else:
+            tiles = _render_tiles(self, times, tile_size, render_scale)
+
+        for count, tile in zip(order, tiles):
+            x = (count % cols) * tile_width
+            y = int(count / cols) * tile_height
+            image.paste(tile, (x, y))
 
         return image
 
-    def write(self):
-        """Renders the project to the filename given."""
-        with state.State():
-            time = 0
-            frame_time = 1 / self.fps
-            duration = self.duration
+    def write(self, metrics_file=None, metrics_callback=None,
+              openmetrics_file=None):
+        """Renders the project to the filename given.
+
+        metrics_file, metrics_callback, openmetrics_file -- Where to
+        report render metrics, such as fps and ETA, while rendering.
+        See ProgressTracker.
+
+        """
+        self._write(self.filename,
+                    metrics_file = metrics_file,
+                    metrics_callback = metrics_callback,
+                    openmetrics_file = openmetrics_file)
+
+    def write_renditions(self, renditions, metrics_file=None,
+                         metrics_callback=None, openmetrics_file=None):
+        """Renders the project once and encodes it to several files,
+        such as the same video at different sizes.
+
+        renditions -- List of ffmpeg.Rendition objects or (filename,
+        width, height) tuples. Width or height may be None to keep the
+        aspect ratio of the project.
 
+        metrics_file, metrics_callback, openmetrics_file -- See write.
+
+        """
+        renditions = [r if isinstance(r, ffmpeg.Rendition) else ffmpeg.Rendition(*r)
+                      for r in renditions]
+        self._write(", ".join(r.filename for r in renditions),
+                    writer_args = {'renditions': renditions},
+                    metrics_file = metrics_file,
+                    metrics_callback = metrics_callback,
+                    openmetrics_file = openmetrics_file)
+
+    def _write(self, name, writer_args=None, **tracker_args):
+        # the writer is closed before the tracker so that the final
+        # metrics include flushing the last frames
+        with ProgressTracker(self, name, **tracker_args) as tracker:
             with ffmpeg.FfmpegWriter(self.filename,
-                                     (self.width, self.height),
-                                     self.fps) as writer:
-                with ProgressTracker(self) as tracker:
-                    while time < duration:
-                        state.set_time(time)
-                        render = self.root_clip.get_frame()
+                                     self.get_render_size(),
+                                     self.get_frame_rate(),
+                                     pixel_format = self.pixel_format,
+                                     preset = self.preset,
+                                     crf = self.crf,
+                                     threads = self.threads,
+                                     tune = self.tune,
+                                     output_format = self.output_format,
+                                     segment_duration = self.segment_duration,
+                                     **(writer_args or {})) as writer:
+                tracker.writer = writer
+
+                # closed on errors too, restoring the render state
+                with contextlib.closing(self._iter_renders()) as renders:
+                    while True:
+                        start = time.perf_counter()
+                        render = next(renders, None)
+                        if render is None:
+                            break
+                        render_time = time.perf_counter() - start
+
                         writer.write_frame(render.image)
-                        tracker.report_frame(state.global_time)
-                        time += frame_time
+                        tracker.report_frame(state.global_time, render_time)
 
     def to_simple(self):
         s = common.Simple(self)
@@ -148,45 +460,307 @@ class Project(common.Node, variable.VariableHold):
         obj.root_clip = clip.Clip.from_simple(s.get_simple('root_clip'))
         return obj
 
+def _render_tiles(project, times, tile_size, render_scale=None):
+    """Renders the given times, in order, as tiles of the given size.
+
+    project -- Project, or its json representation when called in a
+    worker process.
+
+    """
+    if isinstance(project, str):
+        simple = common.Simple()
+        simple.data = json.loads(project)
+        project = Project.from_simple(simple)
+
+    with project.session(render_scale) as session:
+        return [session.get_frame(time).resize(tile_size, reducing_gap=2.0)
+                for time in times]
+
+class Session:
+    def __init__(self, project, render_scale=None):
+        """Keeps resources used when rendering frames open until the
+        session is closed, so each get_frame only pays for rendering
+        instead of reopening and seeking videos.
+
+        Changes to the project that affect resources, such as changing
+        the color of a color clip, are not seen until the affected
+        resources are invalidated.
+
+        render_scale -- Scale to render at. Uses the render_scale
+        variable of the project if not given.
+
+        """
+        self.project = project
+        self.render_scale = (project.render_scale if render_scale is None
+                             else render_scale)
+        self.resource_manager = resource.ResourceManager()
+
+    def get_frame(self, time=0):
+        """Returns the frame at the given time as an image."""
+        with state.State(self.resource_manager, self.render_scale,
+                         self.project.proxy_height):
+            state.set_time(time)
+            render = self.project.root_clip.get_frame()
+            return render.get_writable_image()
+
+    def invalidate(self, clp=None):
+        """Closes resources so they are reopened on next use.
+
+        clp -- Only close resources used by this clip and its
+        sub-clips and drop their images from the shared image cache.
+        If not given all resources are closed and shared image caches
+        are cleared.
+
+        """
+        if clp is None:
+            self.resource_manager.close()
+            resource.image_cache.clear()
+            return
+
+        paths = []
+        clips = [clp]
+        while clips:
+            c = clips.pop()
+            if c.resource is not None:
+                self.resource_manager.close_resource(c.resource)
+                paths.extend(c.resource.get_cached_paths())
+            clips.extend(i for i in c.items if isinstance(i, clip.Clip))
+        resource.image_cache.remove(paths)
+
+    def close(self):
+        self.resource_manager.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _get_peak_rss():
+    """Returns the peak resident set size of the process in bytes, or
+    None if not available on this platform.
+
+    """
+    try:
+        import resource as rusage
+    except ImportError:
+        return None
+
+    peak = rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
 class ProgressTracker(threading.Thread):
-    def __init__(self, project):
-        threading.Thread.__init__(self)
+    def __init__(self, project, name=None, writer=None, metrics_file=None,
+                 metrics_callback=None, openmetrics_file=None):
+        """Prints progress while rendering and reports render metrics.
+
+        name -- Name shown in the progress line. Defaults to the
+        project filename.
+
+        writer -- FfmpegWriter used for the render. Used for the time
+        spent converting frames and writing them to ffmpeg.
+
+        metrics_file -- Path of a file that metrics are appended to
+        as JSON lines, about once a second and when done.
+
+        metrics_callback -- Called with a dict of the metrics at the
+        same times as metrics_file is written.
+
+        openmetrics_file -- Path of a file that is replaced with the
+        latest metrics in the OpenMetrics text format.
+
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.name = name or project.filename
+        self.writer = writer
+        self.metrics_file = metrics_file
+        self.metrics_callback = metrics_callback
+        self.openmetrics_file = openmetrics_file
+
         self.current_time = 0
         self.current_frame = 0
+        self.duration = project.duration
+        self.total_frames = project.get_frame_count()
+        self.render_time = 0
 
-        frame_padding = len(str(project.duration * project.fps))
+        frame_padding = len(str(self.total_frames))
         time_padding = len("%.2f" % project.duration)
 
         self.fmt = "\r%s  ::  %%%dd frames  ::  %%%d.2f / %.2f sec" % (
-            project.filename,
+            self.name,
             frame_padding,
             time_padding,
             project.duration)
 
-        self.running = True
         self.sleep_duration = 1
+        self.average_window = 10 # seconds used for the moving average fps
 
-    def report_frame(self, current_time):
+        self._stop_event = threading.Event()
+        self._start_time = None
+        self._history = collections.deque() # (time, frame)
+        self._counters = stats.Recording()
+
+    def report_frame(self, current_time, render_time=0):
+        """Reports that a frame was rendered.
+
+        current_time -- Time of the frame in the project.
+
+        render_time -- Seconds spent rendering the frame.
+
+        """
         self.current_time = current_time
         self.current_frame += 1
+        self.render_time += render_time
 
     def write_progress(self):
         sys.stdout.write(self.fmt % (
             self.current_frame,
             self.current_time))
 
+    def get_metrics(self, done=False):
+        """Returns a dict with the current render metrics."""
+        now = time.monotonic()
+        frame = self.current_frame
+
+        self._history.append((now, frame))
+        while (len(self._history) > 2 and
+               now - self._history[1][0] >= self.average_window):
+            self._history.popleft()
+
+        fps = 0
+        if len(self._history) >= 2:
+            (t0, f0), (t1, f1) = self._history[-2], self._history[-1]
+            if t1 > t0:
+                fps = (f1 - f0) / (t1 - t0)
+
+        t0, f0 = self._history[0]
+        fps_average = (frame - f0) / (now - t0) if now > t0 else 0
+
+        eta = None
+        if done:
+            eta = 0
+        elif fps_average > 0:
+            eta = max(0, self.total_frames - frame) / fps_average
+
+        counters = self._counters.get_all()
+        io = self.writer.io if self.writer else ffmpeg.IoStats()
+
+        return {
+            'name': self.name,
+            'timestamp': time.time(),
+            'elapsed': now - self._start_time,
+            'done': done,
+            'frame': frame,
+            'total_frames': self.total_frames,
+            'time': self.current_time,
+            'duration': self.duration,
+            'fps': fps,
+            'fps_average': fps_average,
+            'eta': eta,
+            'render_seconds': self.render_time,
+            'convert_seconds': self.writer.convert_time if self.writer else 0,
+            'write_seconds': self.writer.write_time if self.writer else 0,
+            'decoder_startup_seconds': counters.get('decoder_startup_seconds', 0),
+            'decoder_blocked_seconds': counters.get('decoder_blocked_seconds', 0),
+            'decoder_seeks': counters.get('decoder_seeks', 0),
+            'decoder_restarts': counters.get('decoder_restarts', 0),
+            'encoder_startup_seconds': io.startup_time,
+            'encoder_blocked_seconds': io.blocked_time,
+            'encoder_queue_seconds': io.queue_time,
+            'peak_rss_bytes': _get_peak_rss(),
+            'ffmpeg_processes': ffmpeg.get_process_count(),
+            'counters': counters,
+        }
+
+    def report_metrics(self, done=False):
+        if not (self.metrics_file or self.metrics_callback or
+                self.openmetrics_file):
+            return
+
+        metrics = self.get_metrics(done)
+
+        if self.metrics_file:
+            with open(self.metrics_file, 'a', encoding="utf-8") as f:
+                f.write(json.dumps(metrics) + "\n")
+
+        if self.openmetrics_file:
+            # replace so that scrapers never see a partial file
+            tmp_path = self.openmetrics_file + ".tmp"
+            with open(tmp_path, 'w', encoding="utf-8") as f:
+                f.write(_to_openmetrics(metrics))
+            os.replace(tmp_path, self.openmetrics_file)
+
+        if self.metrics_callback:
+            self.metrics_callback(metrics)
+
     def run(self):
-        while self.running:
-            time.sleep(self.sleep_duration)
+        while not self._stop_event.wait(self.sleep_duration):
             self.write_progress()
+            self.report_metrics()
 
     def __enter__(self):
+        self._start_time = time.monotonic()
+        self._history.append((self._start_time, 0))
+        self._counters.start()
         self.write_progress()
         self.start()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.running = False
+        self._stop_event.set()
         self.join()
+        self._counters.stop()
         self.write_progress()
         sys.stdout.write("\n")
+        self.report_metrics(done = exc_type is None)
+
+# (name, type, help, metrics key) in OpenMetrics output
+_OPENMETRICS = [
+    ("kmvid_frames", "counter", "Rendered frames.", 'frame'),
+    ("kmvid_total_frames", "gauge", "Frames in the render.", 'total_frames'),
+    ("kmvid_fps", "gauge", "Frames per second since the last report.", 'fps'),
+    ("kmvid_fps_average", "gauge", "Moving average of frames per second.", 'fps_average'),
+    ("kmvid_eta_seconds", "gauge", "Estimated seconds until done.", 'eta'),
+    ("kmvid_render_seconds", "counter", "Seconds spent rendering frames.", 'render_seconds'),
+    ("kmvid_convert_seconds", "counter", "Seconds spent converting frames for ffmpeg.", 'convert_seconds'),
+    ("kmvid_write_seconds", "counter", "Seconds spent writing frames to ffmpeg.", 'write_seconds'),
+    ("kmvid_decoder_startup_seconds", "counter", "Seconds spent starting decoders.", 'decoder_startup_seconds'),
+    ("kmvid_decoder_blocked_seconds", "counter", "Seconds blocked reading from decoders.", 'decoder_blocked_seconds'),
+    ("kmvid_decoder_seeks", "counter", "Decoders started to seek.", 'decoder_seeks'),
+    ("kmvid_decoder_restarts", "counter", "Decoders restarted to change frame decimation.", 'decoder_restarts'),
+    ("kmvid_encoder_startup_seconds", "counter", "Seconds spent starting the encoder.", 'encoder_startup_seconds'),
+    ("kmvid_encoder_blocked_seconds", "counter", "Seconds blocked writing to the encoder.", 'encoder_blocked_seconds'),
+    ("kmvid_encoder_queue_seconds", "counter", "Seconds rendering waited for the encoder.", 'encoder_queue_seconds'),
+    ("kmvid_peak_rss_bytes", "gauge", "Peak resident memory of the process.", 'peak_rss_bytes'),
+    ("kmvid_ffmpeg_processes", "gauge", "Running ffmpeg processes.", 'ffmpeg_processes'),
+    ("kmvid_done", "gauge", "1 when the render has finished.", 'done'),
+]
+
+def _quote_label(value):
+    # OpenMetrics only escapes these, other text is kept as UTF-8
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '"%s"' % value
+
+def _to_openmetrics(metrics):
+    label = '{name=%s}' % _quote_label(metrics['name'])
+    lines = []
+    for name, metric_type, help_text, key in _OPENMETRICS:
+        value = metrics[key]
+        if value is None:
+            continue
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        lines.append("# HELP %s %s" % (name, help_text))
+        sample = name + "_total" if metric_type == "counter" else name
+        lines.append("%s%s %s" % (sample, label, float(value)))
+
+    counters = metrics.get('counters')
+    if counters:
+        lines.append("# TYPE kmvid_operations counter")
+        lines.append("# HELP kmvid_operations Counted operations, see kmvid.data.stats.")
+        for key, value in sorted(counters.items()):
+            lines.append("kmvid_operations_total{name=%s,operation=%s} %s" % (
+                _quote_label(metrics['name']), _quote_label(key), float(value)))
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
@@ -1,9 +1,16 @@
 import kmvid.data.common as common
 import kmvid.data.ffmpeg as ffmpeg
 import kmvid.data.state as state
+import kmvid.data.stats as stats
 
+import bisect
+import collections
+import concurrent.futures
+import os
 import os.path
+import re
 import sys
+import threading
 
 import PIL.Image
 
@@ -16,7 +23,15 @@ IMAGE_FORMATS = set([
     "webp", "wmf", "xbm", "xpm",
 ])
 
-VIDEO_FORMATS = set(ffmpeg.get_video_formats().keys())
+def __getattr__(name):
+    # VIDEO_FORMATS requires running ffmpeg, only do so when asked for
+    if name == "VIDEO_FORMATS":
+        return set(get_video_formats())
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+def get_video_formats():
+    """Returns the set of file endings recognized as video formats."""
+    return ffmpeg.get_video_formats().keys()
 
 def is_recognized_format(path):
     """Returns True if the extension name of the path is recognized as
@@ -26,16 +41,23 @@ def is_recognized_format(path):
     _, ext = os.path.splitext(path)
     if len(ext) > 0:
         ext = ext.lower()[1:]
-        return ext in IMAGE_FORMATS or ext in VIDEO_FORMATS
+        return ext in IMAGE_FORMATS or ext in get_video_formats()
     return False
 
 def from_file(path, **kwargs):
-    """Creates a resource from the given file path."""
+    """Creates a resource from the given file path.
+
+    Image paths containing a printf style frame number, such as
+    'shot_%05d.png', are read as image sequences.
+
+    """
     _, ext = os.path.splitext(path)
     ext = ext.lower()[1:]
-    if ext in IMAGE_FORMATS:
+    if ext in IMAGE_FORMATS and is_sequence_pattern(path):
+        return ImageSequenceResource(path=path, **kwargs)
+    elif ext in IMAGE_FORMATS:
         return ImageResource(path=path, **kwargs)
-    elif ext in VIDEO_FORMATS:
+    elif ext in get_video_formats():
         return VideoResource(path=path, **kwargs)
     else:
         raise ValueError(f"Unknown resource format for file '{path}'")
@@ -46,12 +68,29 @@ class Info:
         self.height = None
         self.duration = None
         self.fps = None
+        self.fps_exact = None # (numerator, denominator) if known
 
 class Resource(common.Simpleable):
     def get_info(self):
         raise NotImplementedError()
 
-    def get_frame(self, time):
+    def get_cached_paths(self):
+        """Returns the paths of the files this resource reads through
+        image_cache.
+
+        """
+        return []
+
+    def get_frame(self, time, scale=1):
+        """Returns the image for the given time.
+
+        The returned image may be shared, by the resource or between
+        resources, and must not be modified.
+
+        scale -- Size of the returned image relative to the size given
+        by get_info. Used when rendering at a reduced scale.
+
+        """
         raise NotImplementedError()
 
     def close(self):
@@ -77,6 +116,7 @@ class ColorResource(Resource):
         self.color = color
         self.mode = mode
         self.image = None
+        self._image_scale = None
 
     def get_info(self):
         info = Info()
@@ -95,15 +135,20 @@ class ColorResource(Resource):
         else:
             raise ValueError("Unknown color format: %s", str(self.color))
 
-    def get_frame(self, time):
-        if self.image is None:
+    def get_frame(self, time, scale=1):
+        if self.image is None or self._image_scale != scale:
+            size = (int(self.width), int(self.height))
+            if scale != 1:
+                size = _get_scaled_size(size, scale)
             self.image = PIL.Image.new(
                 mode = self.mode or self._get_mode_from_color(),
-                size = (int(self.width), int(self.height)),
+                size = size,
                 color = self.color)
+            self._image_scale = scale
+            stats.increment("image_alloc")
 
         self._heartbeat()
-        return self.image.copy()
+        return self.image
 
     def close(self):
         self.image = None
@@ -123,48 +168,182 @@ class ColorResource(Resource):
         obj.width = s.get('width')
         obj.height = s.get('height')
         obj.color = s.get('color')
+        if isinstance(obj.color, list):
+            # json has no tuples
+            obj.color = tuple(obj.color)
         obj.mode = s.get('mode')
         return obj
 
+class ImageCache:
+    """Process wide cache of decoded images.
+
+    Images are keyed on path, modification time, file size, mode and
+    scale so that resources showing the same file share a single
+    decoded copy and files edited on disk are decoded again. The
+    total size of cached images is kept below max_bytes by evicting
+    the least recently used entries. Images larger than max_bytes are
+    not cached. Images returned from the cache are shared and must not
+    be modified.
+
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, path, mode=None, scale=None):
+        """Returns True if the image is cached, see get."""
+        key = self._get_key(path, mode, scale)
+        with self._lock:
+            return key in self._images
+
+    def _get_key(self, path, mode, scale):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size, mode, scale)
+
+    def get(self, path, mode=None, scale=None):
+        """Returns the decoded image for the given path.
+
+        mode -- If given the image is converted to this mode.
+
+        scale -- If given the image is decoded at this fraction of its
+        original size. Reduced resolution decoding is used where the
+        file format supports it.
+
+        """
+        key = self._get_key(path, mode, scale)
+
+        with self._lock:
+            image = self._images.get(key, None)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+
+        image = _load_image(path, mode, scale)
+
+        with self._lock:
+            if key not in self._images:
+                size = _get_image_bytes(image)
+                if size <= self.max_bytes:
+                    self._images[key] = image
+                    self.current_bytes += size
+                    self._evict()
+
+        return image
+
+    def remove(self, paths):
+        """Removes all cached images of the given paths."""
+        paths = set(os.path.abspath(p) for p in paths)
+        with self._lock:
+            for key in [k for k in self._images if k[0] in paths]:
+                self.current_bytes -= _get_image_bytes(self._images.pop(key))
+
+    def clear(self):
+        """Removes all cached images."""
+        with self._lock:
+            self._images = collections.OrderedDict()
+            self.current_bytes = 0
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and len(self._images) > 0:
+            _, image = self._images.popitem(last=False)
+            self.current_bytes -= _get_image_bytes(image)
+
+image_cache = ImageCache()
+
+def _get_image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+def _get_scaled_size(size, scale):
+    return (max(1, round(size[0] * scale)),
+            max(1, round(size[1] * scale)))
+
+def _combine_scale(scale, render_scale):
+    """Returns the decode scale for a resource scale, which may be
+    None, combined with the render scale.
+
+    """
+    if render_scale == 1:
+        return scale
+    return (scale or 1) * render_scale
+
+def _load_image(path, mode=None, scale=None):
+    """Decodes the image at path. When scale is below 1 the image is
+    decoded at reduced resolution, using draft mode for JPEG and
+    reduce for other formats, before being resized to the exact
+    scaled size.
+
+    """
+    image = PIL.Image.open(path)
+
+    if scale is not None and scale < 1:
+        size = _get_scaled_size(image.size, scale)
+        image.draft(image.mode, size)
+
+        factor = min(image.width // size[0], image.height // size[1])
+        if factor >= 2:
+            image = image.reduce(factor)
+        if image.size != size:
+            image = image.resize(size)
+
+    if mode is not None:
+        image = image.convert(mode)
+        stats.increment("image_convert")
+
+    image.load()
+    stats.increment("image_alloc")
+    return image
+
 class ImageResource(Resource):
-    def __init__(self, path, mode=None):
+    def __init__(self, path, mode=None, scale=None):
+        """path -- Path to the image file.
+
+        mode -- Image mode to convert the image to.
+
+        scale -- Decodes the image at a fraction of its original size.
+        Use it when the image is only ever shown smaller than its
+        original size to save decoding time and memory.
+
+        """
         Resource.__init__(self)
         self.path = path
         self.mode = mode
-        self.image = None
+        self.scale = scale
 
         self._info = None
 
     def get_info(self):
         if self._info is None:
             self._info = Info()
-            if self.image:
-                self._info.width = self.image.width
-                self._info.height = self.image.height
-            else:
-                with PIL.Image.open(self.path) as img:
-                    self._info.width = img.width
-                    self._info.height = img.height
+            with PIL.Image.open(self.path) as img:
+                size = img.size
+            if self.scale is not None and self.scale < 1:
+                size = _get_scaled_size(size, self.scale)
+            self._info.width, self._info.height = size
 
         return self._info
 
-    def get_frame(self, time):
-        if self.image is None:
-            self.image = PIL.Image.open(self.path)
-            self.image = (self.image
-                          if self.mode is None
-                          else self.image.convert(self.mode))
+    def get_cached_paths(self):
+        return [self.path]
+
+    def get_frame(self, time, scale=1):
+        # not kept on the resource so that the cache budget bounds
+        # the memory used by images
+        image = image_cache.get(self.path, self.mode,
+                                _combine_scale(self.scale, scale))
 
         self._heartbeat()
-        return self.image.copy()
+        return image
 
     def close(self):
-        self.image = None
+        pass
 
     def to_simple(self):
         s = common.Simple(self)
         s.set('path', self.path)
         s.set('mode', self.mode)
+        s.set('scale', self.scale)
         return s
 
     @staticmethod
@@ -173,6 +352,196 @@ class ImageResource(Resource):
             obj = ImageResource(None)
         obj.path = s.get('path')
         obj.mode = s.get('mode')
+        obj.scale = s.get('scale', None)
+        return obj
+
+_SEQUENCE_NUMBER_PATTERN = re.compile(r"%(0\d+)?d")
+
+def is_sequence_pattern(path):
+    """Returns True if the file name of path contains a frame number
+    pattern such as %d or %05d.
+
+    """
+    return _SEQUENCE_NUMBER_PATTERN.search(os.path.basename(path)) is not None
+
+class ImageSequenceResource(Resource):
+    def __init__(self, path, fps=25, start_number=None, mode=None, scale=None,
+                 prefetch=8, workers=4, cache_size=32):
+        """Numbered image files played back as a video.
+
+        path -- Path with a printf style frame number in the file
+        name, for example 'shot_%05d.png'.
+
+        fps -- Frames per second.
+
+        start_number -- Number of the first frame. If not given the
+        lowest number found on disk is used. The sequence ends at the
+        first missing number.
+
+        mode -- Image mode to convert frames to.
+
+        scale -- Decodes frames at a fraction of their original size.
+
+        prefetch -- Number of frames ahead of the requested frame that
+        are decoded in the background into image_cache.
+
+        workers -- Number of threads used for decoding.
+
+        cache_size -- Maximum number of frames queued for decoding.
+        Never less than prefetch + 1. Decoded frames are kept in
+        image_cache and bounded by its budget.
+
+        """
+        Resource.__init__(self)
+        self.path = path
+        self.fps = fps
+        self.start_number = start_number
+        self.mode = mode
+        self.scale = scale
+        self.prefetch = prefetch
+        self.workers = workers
+        self.cache_size = cache_size
+
+        self._info = None
+        self._frame_count = None
+        self._executor = None
+        self._frames = collections.OrderedDict() # frame index -> pending Future
+        self._frames_scale = 1
+
+    def get_info(self):
+        if self._info is None:
+            self._info = Info()
+            self._info.fps = self.fps
+            self._info.duration = self._get_frame_count() / self.fps
+
+            with PIL.Image.open(self._get_frame_path(0)) as img:
+                size = img.size
+            if self.scale is not None and self.scale < 1:
+                size = _get_scaled_size(size, self.scale)
+            self._info.width, self._info.height = size
+
+        return self._info
+
+    def get_frame(self, time, scale=1):
+        index = common.get_frame_index(time, common.to_rational(self.fps))
+        if index < 0 or index >= self._get_frame_count():
+            return None
+
+        if scale != self._frames_scale:
+            for old in self._frames.values():
+                old.cancel()
+            self._frames = collections.OrderedDict()
+            self._frames_scale = scale
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = self.workers)
+
+        decode_scale = _combine_scale(self.scale, scale)
+
+        # finished frames are only held by image_cache, so that its
+        # budget bounds the memory used
+        for n in [n for n, f in self._frames.items() if f.done() and n != index]:
+            del self._frames[n]
+
+        # most recently used last, with the requested frame at the end
+        # so that it is cancelled last
+        last = min(index + self.prefetch, self._get_frame_count() - 1)
+        for n in range(last, index, -1):
+            if n in self._frames:
+                self._frames.move_to_end(n)
+            elif not image_cache.contains(self._get_frame_path(n),
+                                          self.mode, decode_scale):
+                self._frames[n] = self._executor.submit(
+                    image_cache.get,
+                    self._get_frame_path(n),
+                    self.mode,
+                    decode_scale)
+
+        while len(self._frames) > max(self.cache_size, self.prefetch):
+            _, old = self._frames.popitem(last=False)
+            old.cancel()
+
+        future = self._frames.pop(index, None)
+        if future is not None:
+            image = future.result()
+        else:
+            image = image_cache.get(self._get_frame_path(index), self.mode,
+                                    decode_scale)
+
+        self._heartbeat()
+        return image
+
+    def get_cached_paths(self):
+        return [self._get_frame_path(n) for n in range(self._get_frame_count())]
+
+    def _get_frame_path(self, index):
+        number = self._get_start_number() + index
+        return _SEQUENCE_NUMBER_PATTERN.sub(lambda m: m.group(0) % number,
+                                            self.path)
+
+    def _get_start_number(self):
+        if self.start_number is None:
+            numbers = self._find_numbers()
+            if len(numbers) == 0:
+                raise Exception(f"No files found for image sequence: {self.path}")
+            self.start_number = min(numbers)
+        return self.start_number
+
+    def _get_frame_count(self):
+        if self._frame_count is None:
+            numbers = self._find_numbers()
+            count = 0
+            while self._get_start_number() + count in numbers:
+                count += 1
+            self._frame_count = count
+        return self._frame_count
+
+    def _find_numbers(self):
+        """Returns the set of frame numbers that exist on disk."""
+        directory, filename = os.path.split(self.path)
+        parts = _SEQUENCE_NUMBER_PATTERN.split(filename)
+        pattern = re.compile(re.escape(parts[0]) +
+                             "(\\d+)" +
+                             re.escape(parts[-1]) + "$")
+
+        numbers = set()
+        for name in os.listdir(directory or "."):
+            m = pattern.match(name)
+            if m:
+                numbers.add(int(m.group(1)))
+        return numbers
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self._frames = collections.OrderedDict()
+
+    def to_simple(self):
+        s = common.Simple(self)
+        s.set('path', self.path)
+        s.set('fps', self.fps)
+        s.set('start_number', self.start_number)
+        s.set('mode', self.mode)
+        s.set('scale', self.scale)
+        s.set('prefetch', self.prefetch)
+        s.set('workers', self.workers)
+        s.set('cache_size', self.cache_size)
+        return s
+
+    @staticmethod
+    def from_simple(s, obj=None):
+        if obj is None:
+            obj = ImageSequenceResource(None)
+        obj.path = s.get('path')
+        obj.fps = s.get('fps')
+        obj.start_number = s.get('start_number')
+        obj.mode = s.get('mode')
+        obj.scale = s.get('scale')
+        obj.prefetch = s.get('prefetch')
+        obj.workers = s.get('workers')
+        obj.cache_size = s.get('cache_size')
         return obj
 
 class VideoResource(Resource):
@@ -182,6 +551,7 @@ class VideoResource(Resource):
         self.reader = None
 
         self._info = None
+        self._reader_key = None
 
     def get_info(self):
         if self._info is None:
@@ -190,17 +560,46 @@ class VideoResource(Resource):
             self._info.width = probe.width
             self._info.height = probe.height
             self._info.fps = probe.fps
+            self._info.fps_exact = probe.fps_exact
             self._info.duration = probe.duration
 
         return self._info
 
-    def get_frame(self, time):
+    def get_frame(self, time, scale=1):
+        key = self._get_reader_key(scale)
+        if self.reader is not None and self._reader_key != key:
+            self.reader.close()
+            self.reader = None
+
         if self.reader is None:
-            self.reader = ffmpeg.FfmpegReader(self.path)
+            path, size = key
+            self.reader = ffmpeg.FfmpegReader(path, size = size)
+            self._reader_key = key
 
         self._heartbeat()
         return self.reader.get_frame(time)
 
+    def _get_reader_key(self, scale):
+        """Returns the (path, size) to read frames from. Proxies are
+        only used when frames are read at or below the proxy height,
+        scaling a proxy up would decode full size frames from a lower
+        quality source.
+
+        """
+        size = None
+        if scale != 1:
+            info = self.get_info()
+            size = _get_scaled_size((info.width, info.height), scale)
+
+        if state.proxy_height is not None:
+            info = self.get_info()
+            height = size[1] if size else info.height
+            if info.height > state.proxy_height and height <= state.proxy_height:
+                path = ffmpeg.get_proxy(self.path, state.proxy_height)
+                return (path, size)
+
+        return (self.path, size)
+
     def close(self):
         if self.reader is not None:
             self.reader.close()
@@ -225,6 +624,12 @@ class ResourceManager:
     def report_heartbeat(self, resource_instance):
         self.resources.add(resource_instance)
 
+    def close_resource(self, resource_instance):
+        """Closes a single resource if it's managed by this manager."""
+        if resource_instance in self.resources:
+            self.resources.remove(resource_instance)
+            resource_instance.close()
+
     def close(self):
         for r in self.resources:
             r.close()
@@ -267,6 +672,7 @@ class TimeMap(common.Simpleable):
         self.clear()
 
     def _validate(self):
+        self._compiled = None
         errors = []
 
         if self._mapping[0].in_time != 0:
@@ -291,29 +697,28 @@ class TimeMap(common.Simpleable):
         if len(errors) > 0:
             raise ValueError(self.__repr__() + " " + ", ".join(errors))
 
-    def _get_index(self, in_time):
-        for i, e in enumerate(self._mapping):
-            if e.in_time > in_time:
-                return i - 1
-        return None
+    def compile(self):
+        """Returns a CompiledTimeMap for the current mapping. The result
+        is cached until the mapping changes.
+
+        """
+        if self._compiled is None:
+            self._compiled = CompiledTimeMap(
+                [e.in_time for e in self._mapping],
+                [e.get_end_time() for e in self._mapping[:-1]],
+                [e.out_time for e in self._mapping[1:]])
+        return self._compiled
 
     def get(self, in_time):
         """Returns the out_time corresponding to the given in_time."""
-        index = self._get_index(in_time)
-        if index is None:
-            return None
+        return self.compile().get(in_time)
 
-        this = self._mapping[index]
-        next = self._mapping[index + 1]
+    def get_many(self, in_times):
+        """Returns a numpy array with the out_time for each of the given
+        in_times. Times outside the mapping are NaN.
 
-        if this.in_time == in_time:
-            return this.get_end_time()
-
-        in_time_duration = next.in_time - this.in_time
-        out_time_duration = next.out_time - this.get_end_time()
-        factor = (in_time - this.in_time) / in_time_duration
-
-        return this.get_end_time() + out_time_duration * factor
+        """
+        return self.compile().get_many(in_times)
 
     def get_duration(self):
         return self._mapping[-1].in_time
@@ -323,6 +728,7 @@ class TimeMap(common.Simpleable):
         self._mapping = [MappingEntry(0, 0),
                          MappingEntry(self._duration,
                                       self._duration)]
+        self._compiled = None
 
     def set_crop_start(self, duration):
         """Crop the start, removing the given duration.
@@ -437,5 +843,83 @@ class TimeMap(common.Simpleable):
         obj._duration = s.get('duration')
         obj._mapping = [MappingEntry.from_simple(common.Simple.from_data(s, entry_data))
                         for entry_data in s.get('mapping')]
+        obj._compiled = None
 
         return obj
+
+class CompiledTimeMap:
+    def __init__(self, in_times, out_starts, out_ends):
+        """Piecewise linear mapping from in time to out time.
+
+        Segment i covers in times from in_times[i] up to, but not
+        including, in_times[i + 1]. It maps linearly from out_starts[i]
+        to out_ends[i]. Lookups use bisection over in_times.
+
+        in_times -- Sorted breakpoints, one more than there are
+        segments.
+
+        out_starts -- Out time at the start of each segment.
+
+        out_ends -- Out time at the end of each segment.
+
+        """
+        self.in_times = list(in_times)
+        self.out_starts = list(out_starts)
+        self.out_ends = list(out_ends)
+        self._arrays = None
+
+    def get(self, in_time):
+        """Returns the out time for in_time or None if in_time is outside
+        the mapping.
+
+        """
+        index = bisect.bisect_right(self.in_times, in_time) - 1
+        if index < 0 or index >= len(self.out_starts):
+            return None
+
+        start = self.in_times[index]
+        out_start = self.out_starts[index]
+
+        if start == in_time:
+            return out_start
+
+        factor = (in_time - start) / (self.in_times[index + 1] - start)
+        return out_start + (self.out_ends[index] - out_start) * factor
+
+    def get_many(self, in_times):
+        """Returns a numpy array with the out time for each of the given
+        in times. Times outside the mapping are NaN.
+
+        """
+        import numpy as np
+
+        if self._arrays is None:
+            self._arrays = (np.array(self.in_times, dtype=float),
+                            np.array(self.out_starts, dtype=float),
+                            np.array(self.out_ends, dtype=float))
+        in_arr, start_arr, end_arr = self._arrays
+
+        times = np.asarray(in_times, dtype=float)
+        index = np.searchsorted(in_arr, times, side='right') - 1
+        valid = (index >= 0) & (index < len(start_arr))
+        index = np.clip(index, 0, len(start_arr) - 1)
+
+        start = in_arr[index]
+        factor = (times - start) / (in_arr[index + 1] - start)
+        result = start_arr[index] + (end_arr[index] - start_arr[index]) * factor
+
+        return np.where(valid, result, np.nan)
+
+    def shift(self, offset):
+        """Returns a new CompiledTimeMap where in times are moved by
+        offset. Used to express a mapping in the time of a parent
+        clip that starts this clip at offset.
+
+        """
+        return CompiledTimeMap([t + offset for t in self.in_times],
+                               self.out_starts,
+                               self.out_ends)
+
+    def __repr__(self):
+        return "CompiledTimeMap(%s, %s, %s)" % (
+            self.in_times, self.out_starts, self.out_ends)
@@ -5,6 +5,8 @@ global_time = 0
 local_time = 0
 resource_manager = None
 render = None
+render_scale = 1
+proxy_height = None
 
 def set_time(time):
     """Sets the time (local and global). For use at the root level of
@@ -17,40 +19,74 @@ def set_time(time):
     local_time = time
 
 class State:
+    def __init__(self, resource_manager=None, render_scale=1, proxy_height=None):
+        """resource_manager -- ResourceManager to use. Resources used
+        within the state are left open on exit if given, otherwise a
+        new manager is created and closed on exit.
+
+        render_scale -- Scale to render at. Resources return scaled
+        frames and pixel variables are scaled to match, giving the
+        same composition at a different resolution.
+
+        proxy_height -- If given videos taller than this are read from
+        proxies of this height, see ffmpeg.get_proxy.
+
+        """
+        self.resource_manager = resource_manager
+        self.owns_resources = resource_manager is None
+        self.render_scale = render_scale
+        self.proxy_height = proxy_height
+        self.old = None
+
     def __enter__(self):
         global global_time
         global local_time
         global resource_manager
+        global render_scale
+        global proxy_height
+
+        self.old = (global_time, local_time, resource_manager, render_scale,
+                    proxy_height)
 
         global_time = 0
         local_time = 0
-        resource_manager = resource.ResourceManager()
+        render_scale = self.render_scale
+        proxy_height = self.proxy_height
+        if self.owns_resources:
+            self.resource_manager = resource.ResourceManager()
+        resource_manager = self.resource_manager
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         global global_time
         global local_time
         global resource_manager
+        global render_scale
+        global proxy_height
 
-        global_time = 0
-        local_time = 0
+        if self.owns_resources:
+            self.resource_manager.close()
+            self.resource_manager = None
 
-        if resource_manager:
-            resource_manager.close()
-            resource_manager = None
+        (global_time, local_time, resource_manager, render_scale,
+         proxy_height) = self.old
 
 class AdjustLocalTime:
     def __init__(self, time_offset):
         self.time_offset = time_offset
+        self.old = None
 
     def __enter__(self):
         global local_time
+        # restore the exact old value on exit, adding the offset back
+        # doesn't always give the same float
+        self.old = local_time
         local_time -= self.time_offset
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         global local_time
-        local_time += self.time_offset
+        local_time = self.old
 
 class Render:
     def __init__(self, *args, **kwargs):
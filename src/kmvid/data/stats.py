@@ -0,0 +1,94 @@
+import collections
+import threading
+
+# Counters incremented by kmvid:
+#
+#   image_alloc        -- Frames allocated by resources and readers.
+#   image_copy         -- Shared frames copied before being modified.
+#   layer_alloc        -- Temporary images allocated by effects, such
+#                         as draw layers, borders and alpha masks.
+#   image_convert      -- Calls to convert() changing the image mode.
+#   ffmpeg_spawn       -- ffmpeg processes started, for any reason.
+#   ffmpeg_spawn_<reason>
+#                      -- ffmpeg processes started for the reason:
+#                         first_use, backward_seek, threshold_jump,
+#                         restart, reverse_chunk, decimation, writer
+#                         or proxy.
+#   ffprobe            -- ffprobe calls.
+#   decoder_bytes      -- Bytes read from ffmpeg decoder pipes.
+#   encoder_bytes      -- Bytes written to ffmpeg encoder pipes.
+#   decoder_seeks, decoder_restarts
+#                      -- Decoder processes started to seek or to
+#                         change frame decimation, see ffmpeg.IoStats.
+#   decoder_startup_seconds, encoder_startup_seconds
+#                      -- Seconds spent starting ffmpeg processes.
+#   decoder_blocked_seconds, encoder_blocked_seconds
+#                      -- Seconds blocked on reading from or writing
+#                         to ffmpeg pipes.
+#   encoder_queue_seconds
+#                      -- Seconds rendering waited for the encoder.
+#   font_open          -- Font files opened.
+
+counters = collections.Counter()
+
+# counters are incremented from writer and prefetch threads too
+_lock = threading.Lock()
+
+def increment(name, amount=1):
+    """Increments the named counter."""
+    with _lock:
+        counters[name] += amount
+
+def get(name):
+    """Returns the current value of the named counter."""
+    return counters[name]
+
+def get_all():
+    """Returns a dict with the current value of all counters."""
+    with _lock:
+        return dict(counters)
+
+def reset():
+    """Sets all counters to zero."""
+    with _lock:
+        counters.clear()
+
+class Recording:
+    """Counts the events happening while it's active, without resetting
+    the global counters, so that recordings can overlap.
+
+        with stats.Recording() as rec:
+            project.get_frame_wall()
+        print(rec.get("ffmpeg_spawn"))
+
+    """
+
+    def __init__(self):
+        self._start = None
+        self._end = None
+
+    def start(self):
+        self._start = get_all()
+        self._end = None
+
+    def stop(self):
+        self._end = get_all()
+
+    def get(self, name):
+        """Returns how much the named counter changed while recording."""
+        return self.get_all().get(name, 0)
+
+    def get_all(self):
+        """Returns a dict of the counters that changed while recording."""
+        end = self._end if self._end is not None else get_all()
+        start = self._start or {}
+        return {name: value - start.get(name, 0)
+                for name, value in end.items()
+                if value != start.get(name, 0)}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
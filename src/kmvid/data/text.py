@@ -1,3 +1,5 @@
+import kmvid.data.stats as stats
+
 import PIL.Image
 import PIL.ImageDraw
 import PIL.ImageFont
@@ -61,6 +63,7 @@ class FontCache:
 
     def _load_font(self, path, size=16):
         try:
+            stats.increment("font_open")
             return PIL.ImageFont.truetype(path, size=size)
         except OSError:
             pass
@@ -120,6 +123,8 @@ class FontData:
             font = self.font_by_variant.get(variant, None)
             if font is None:
                 raise Exception("No variant '%s' for font '%s'" % (variant, self.name))
+            # font_variant reads the font file again
+            stats.increment("font_open")
             self.cache[key] = font.font_variant(size = size)
         return self.cache[key]
 
@@ -1,7 +1,6 @@
 import kmvid.data.common as common
 import kmvid.data.expression as expression
 import kmvid.data.state as state
-import scipy.interpolate as interpolate
 
 import enum
 import re
@@ -180,7 +179,13 @@ class VariableConfig(common.Simpleable):
                  vartype=None,
                  default=None,
                  doc=None,
-                 value_transform_fn=None):
+                 value_transform_fn=None,
+                 scaled=False):
+        """scaled -- The value is measured in pixels and is multiplied
+        by the render scale when read during rendering. Numbers in
+        lists and tuples are scaled individually.
+
+        """
         global __VARIABLE_CONFIG_INDEX_COUNTER__
         __VARIABLE_CONFIG_INDEX_COUNTER__ += 1
         self.index = __VARIABLE_CONFIG_INDEX_COUNTER__
@@ -188,6 +193,7 @@ class VariableConfig(common.Simpleable):
         self.type = vartype
         self.default = default
         self.doc = doc
+        self.scaled = scaled
 
         force = None
         if type(vartype) is enum.EnumType:
@@ -275,6 +281,10 @@ class Variable(common.Node):
         """
         val = None
 
+        # values from _get_ functions are derived from the render and
+        # are already scaled
+        scale = self.config.scaled and state.render_scale != 1
+
         if len(self._values) == 1:
             val = self._values[0].get_value()
 
@@ -285,11 +295,15 @@ class Variable(common.Node):
             val = self._default.get_value()
 
         elif self.parent is not None and external_lookup:
+            scale = False
             f = getattr(self.parent, '_get_' + self.config.name, None)
             if f is not None:
                 val = f()
 
-        return self.value_transform_fn(val)
+        val = self.value_transform_fn(val)
+        if scale:
+            val = _scale_value(val, state.render_scale)
+        return val
 
     def get_all_variable_values(self):
         return self._values
@@ -307,6 +321,28 @@ class Variable(common.Node):
                        for varval_data in s.get('values')]
         return obj
 
+def _scale_value(value, scale):
+    """Scales a pixel value by the render scale. Non-zero integers
+    stay non-zero so that thin lines and small offsets don't vanish.
+
+    """
+    if value is None or isinstance(value, bool):
+        return value
+
+    elif isinstance(value, int):
+        scaled = int(round(value * scale))
+        if scaled == 0 and value != 0:
+            return 1 if value > 0 else -1
+        return scaled
+
+    elif isinstance(value, float):
+        return value * scale
+
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_scale_value(v, scale) for v in value)
+
+    return value
+
 #--------------------------------------------------
 # variable values
 
@@ -525,6 +561,9 @@ def _get_curve_value(values, index, time):
 
     varval = values[index]
 
+    # scipy is slow to import, only load it when curves are used
+    import scipy.interpolate as interpolate
+
     if varval.time_type == TimeValueType.CURVE:
         ip = interpolate.Akima1DInterpolator(xs, ys)
     elif varval.time_type == TimeValueType.BOUNDED_CURVE:
@@ -0,0 +1,72 @@
+import kmvid.data.analysis as analysis
+import kmvid.data.clip as clip
+import kmvid.data.effect as effect
+import kmvid.data.profiler as profiler
+import kmvid.data.project as project
+
+import unittest
+
+class TestCosts(unittest.TestCase):
+    def _make_project(self):
+        # blurred layers during the last second only
+        p = project.Project(width = 200, height = 100, fps = 10, duration = 4)
+        for _ in range(5):
+            p.add(clip.color(color = (255, 0, 0), width = 200, height = 100,
+                             start_time = 3)
+                  .add(effect.Blur()))
+        return p
+
+    def test_partition(self):
+        self.assertEqual(analysis.partition([1] * 10, 3), [(0, 3), (3, 7), (7, 10)])
+        self.assertEqual(analysis.partition([1, 1, 1, 1, 10, 10], 2), [(0, 5), (5, 6)])
+        self.assertEqual(analysis.partition([0] * 4, 2), [(0, 2), (2, 4)])
+        self.assertEqual(analysis.partition([1, 100, 1], 3), [(0, 1), (1, 2), (2, 3)])
+        self.assertEqual(analysis.partition([5], 3), [(0, 1)])
+        self.assertEqual(analysis.partition([], 3), [])
+
+    def test_estimate(self):
+        p = self._make_project()
+        costs = p.estimate_costs()
+
+        self.assertEqual(len(costs), 40)
+        self.assertEqual(len(set(c for t, c in costs if t < 2.95)), 1)
+        self.assertGreater(costs[-1][1], costs[0][1] * 5)
+
+        half = project.Project.from_simple(p.to_simple())
+        half.render_scale = 0.5
+        self.assertAlmostEqual(half.estimate_costs()[-1][1], costs[-1][1] / 4)
+
+    def test_segments(self):
+        p = self._make_project()
+        segments = p.get_segments(2)
+
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[0][0], 0)
+        self.assertEqual(segments[-1][1], 4)
+        self.assertGreater(segments[0][1], 2.5)
+
+        frames = sum(len(list(p.iter_frames(start, end))) for start, end in segments)
+        self.assertEqual(frames, len(list(p.iter_frames())))
+
+    def test_segments_ntsc(self):
+        p = project.Project(width = 20, height = 10, fps = 29.97, duration = 60)
+        p.add(clip.color(color = (255, 0, 0), width = 20, height = 10))
+        segments = p.get_segments(7)
+
+        rate = p.get_frame_rate()
+        for start, end in segments:
+            self.assertEqual((start * rate).denominator, 1)
+        self.assertEqual(sum(p.get_frame_count(start, end) for start, end in segments),
+                         p.get_frame_count())
+
+    def test_from_profiler(self):
+        p = self._make_project()
+        with profiler.Profiler() as prof:
+            list(p.iter_frames(3, 3.3))
+
+        model = analysis.CostModel.from_profiler(prof)
+        self.assertNotEqual(model.effect_costs['Blur'],
+                            analysis.CostModel.EFFECT_COSTS['Blur'])
+        self.assertEqual(model.effect_costs['Rotate'],
+                         analysis.CostModel.EFFECT_COSTS['Rotate'])
+        self.assertEqual(len(p.estimate_costs(model = model)), 40)
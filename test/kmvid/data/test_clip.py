@@ -1,6 +1,7 @@
 import kmvid.data.clip as clip
 import kmvid.data.effect as effect
 import kmvid.data.state as state
+import kmvid.data.stats as stats
 
 import testbase
 
@@ -38,3 +39,38 @@ class TestClip(testbase.Testbase):
             state.set_time(10)
             render = root.get_frame()
             self.assertImage("clip_start_time", render.image)
+
+    def test_local_time_restored(self):
+        root = clip.color(color=(20, 20, 20), width=50, height=50)
+        child = clip.color(color=(200, 0, 0), width=10, height=10)
+        child.start_time = 0.3
+        root.add(child)
+
+        with state.State():
+            state.set_time(0.9)
+            root.get_frame()
+            self.assertEqual(state.local_time, 0.9)
+
+    def test_shared_frames(self):
+        root = clip.color(color=(20, 20, 20), width=50, height=50)
+        plain = clip.color(color=(200, 0, 0), width=10, height=10)
+        drawn = clip.color(color=(0, 200, 0), width=10, height=10)
+        drawn.add(effect.Draw().config(fill=(0, 0, 255)).rectangle(0, 0, 5, 5))
+        root.add(plain, drawn)
+
+        with state.State():
+            stats.reset()
+            root.get_frame()
+
+            # root is pasted into and drawn is drawn on, plain is
+            # only read from
+            self.assertEqual(stats.get("image_alloc"), 3)
+            self.assertEqual(stats.get("image_copy"), 2)
+
+            self.assertEqual(root.resource.image.getpixel((0, 0)), (20, 20, 20))
+            self.assertEqual(drawn.resource.image.getpixel((0, 0)), (0, 200, 0))
+
+            stats.reset()
+            root.get_frame()
+            self.assertEqual(stats.get("image_alloc"), 0)
+            self.assertEqual(stats.get("image_copy"), 2)
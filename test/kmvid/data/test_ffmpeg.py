@@ -0,0 +1,305 @@
+import kmvid.data.ffmpeg as ffmpeg
+import kmvid.data.stats as stats
+
+import testbase
+
+import PIL.Image
+import os.path
+import tempfile
+import time
+import unittest
+
+@unittest.skipIf(not testbase.has_ffmpeg(), "ffmpeg not available")
+class TestFfmpegReader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = testbase.make_video(os.path.join(self.tmp.name, "video.mp4"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _read_all(self, times):
+        with ffmpeg.FfmpegReader(self.path) as reader:
+            return [reader.get_frame(t).tobytes() for t in times]
+
+    def test_reverse(self):
+        times = [n / 10 + 0.01 for n in range(25)]
+        expected = self._read_all(times)
+
+        with ffmpeg.FfmpegReader(self.path, reverse_chunk_size=8) as reader:
+            reader.get_frame(times[-1])
+
+            stats.reset()
+            for t, frame in reversed(list(zip(times, expected))):
+                with self.subTest(time=t):
+                    self.assertEqual(reader.get_frame(t).tobytes(), frame)
+
+            self.assertEqual(stats.get("ffmpeg_spawn"), 3)
+
+    def test_reverse_chunk_bytes(self):
+        times = [n / 10 + 0.01 for n in range(12)]
+        expected = self._read_all(times)
+
+        with ffmpeg.FfmpegReader(self.path, reverse_chunk_size=8,
+                                 reverse_chunk_bytes=3 * 64 * 48 * 4 + 1) as reader:
+            self.assertEqual(reader.get_reverse_chunk_frames(), 3)
+            reader.get_frame(times[-1])
+
+            stats.reset()
+            for t, frame in reversed(list(zip(times, expected))):
+                with self.subTest(time=t):
+                    self.assertEqual(reader.get_frame(t).tobytes(), frame)
+                    self.assertLessEqual(len(reader._chunk), 3)
+
+            self.assertEqual(stats.get("ffmpeg_spawn"), 4)
+
+    def test_frame_boundaries(self):
+        # times exactly on, and a rounding error away from, frame starts
+        times = [n / 10 for n in range(25)]
+        summed = [sum([0.1] * n) for n in range(25)]
+        expected = self._read_all([t + 0.05 for t in times])
+
+        with ffmpeg.FfmpegReader(self.path) as reader:
+            for n, t in enumerate(summed):
+                with self.subTest(time=t):
+                    self.assertEqual(reader.get_frame_info(t).index, n)
+                    self.assertEqual(reader.get_frame(t).tobytes(), expected[n])
+
+        for n in (3, 7, 21):
+            with ffmpeg.FfmpegReader(self.path) as reader:
+                with self.subTest(time=times[n]):
+                    self.assertEqual(reader.get_frame(times[n]).tobytes(),
+                                     expected[n])
+
+    def test_spawn_reasons(self):
+        with stats.Recording() as rec:
+            with ffmpeg.FfmpegReader(self.path, decimate_ratio=None,
+                                     reset_threshold=0.5) as reader:
+                for t in [0.01, 0.11, 0.21, 2.51, 0.31]:
+                    reader.get_frame(t)
+
+        self.assertEqual(rec.get("ffmpeg_spawn"), 3)
+        self.assertEqual(rec.get("ffmpeg_spawn_first_use"), 1)
+        self.assertEqual(rec.get("ffmpeg_spawn_threshold_jump"), 1)
+        self.assertEqual(rec.get("ffmpeg_spawn_backward_seek"), 1)
+        self.assertEqual(rec.get("ffprobe"), 1)
+        self.assertEqual(rec.get("decoder_bytes"), 5 * 64 * 48 * 3)
+        self.assertEqual(rec.get("decoder_seeks"), 2)
+
+        self.assertEqual(reader.io.spawns, 3)
+        self.assertEqual(reader.io.seeks, 2)
+        self.assertEqual(reader.io.restarts, 0)
+        self.assertEqual(reader.io.frames, 5)
+        self.assertGreater(reader.io.startup_time, 0)
+        self.assertGreater(rec.get("decoder_startup_seconds"), 0)
+
+    def test_decimate(self):
+        times = [n / 10 + 0.01 for n in range(29)]
+        expected = self._read_all(times)
+
+        with ffmpeg.FfmpegReader(self.path) as reader:
+            stats.reset()
+            for n in range(0, 29, 4):
+                with self.subTest(time=times[n]):
+                    self.assertEqual(reader.get_frame(times[n]).tobytes(),
+                                     expected[n])
+
+            self.assertIsNotNone(reader._decimation)
+            self.assertLess(stats.get("image_alloc"), 15)
+
+    def test_decimate_miss(self):
+        times = [n / 10 + 0.01 for n in range(29)]
+        expected = self._read_all(times)
+
+        with ffmpeg.FfmpegReader(self.path) as reader:
+            for n in [0, 3, 6, 9, 12, 14, 15, 18]:
+                with self.subTest(time=times[n]):
+                    self.assertEqual(reader.get_frame(times[n]).tobytes(),
+                                     expected[n])
+
+    def test_missing_file(self):
+        path = os.path.join(self.tmp.name, "missing.mp4")
+        for read in (lambda r: r.get_frame_info(0), lambda r: r.get_frame(0)):
+            with ffmpeg.FfmpegReader(path) as reader:
+                with self.assertRaisesRegex(Exception, "Video file does not exist"):
+                    read(reader)
+
+class TestReadPlanner(unittest.TestCase):
+    def test_plan(self):
+        planner = ffmpeg.ReadPlanner(10, (64, 48), reverse_chunk_size=4,
+                                     decimate_ratio=None, reset_threshold=1)
+        forward, reverse, chunk = (ffmpeg.ReadPlanner.FORWARD,
+                                   ffmpeg.ReadPlanner.REVERSE,
+                                   ffmpeg.ReadPlanner.CHUNK)
+
+        steps = [(0.0, (forward, "first_use")),
+                 (0.1, (forward, None)),
+                 (0.5, (forward, None)),
+                 (2.0, (forward, "threshold_jump")),
+                 (1.9, (reverse, "reverse_chunk")),
+                 (1.7, (chunk, None)),
+                 (1.5, (reverse, "reverse_chunk")),
+                 (0.2, (forward, "backward_seek"))]
+        for time, expected in steps:
+            with self.subTest(time=time):
+                self.assertEqual(planner.plan(time), expected)
+
+        planner.close()
+        self.assertEqual(planner.plan(0.3), (forward, "first_use"))
+
+    def test_decimation(self):
+        planner = ffmpeg.ReadPlanner(10, (64, 48))
+        reasons = [planner.plan(n * 0.3)[1] for n in range(6)]
+        self.assertEqual(reasons, ["first_use", None, None, "decimation", None, None])
+        self.assertEqual(planner.decimation.ratio, 3)
+
+        # a frame that the decimation drops
+        self.assertEqual(planner.plan(1.6)[1], "restart")
+
+    def test_chunk_bytes(self):
+        planner = ffmpeg.ReadPlanner(10, (100, 100), reverse_chunk_bytes=100 * 100 * 4 * 5)
+        self.assertEqual(planner.reverse_chunk_frames, 5)
+
+class TestRendition(unittest.TestCase):
+    def test_threads(self):
+        default = ffmpeg.Rendition("out.mp4", preset = "fast", threads = 2)
+
+        for rendition, threads in [(ffmpeg.Rendition("a.mp4"), "2"),
+                                   (ffmpeg.Rendition("b.mp4", threads = 1), "1")]:
+            with self.subTest(filename = rendition.filename):
+                options = rendition.get_output_options(default)
+                self.assertEqual(options[options.index('-threads') + 1], threads)
+                self.assertEqual(options[-1], rendition.filename)
+
+class TestYuv(unittest.TestCase):
+    def test_rgb_to_yuv420(self):
+        image = PIL.Image.new("RGB", (4, 2), (255, 255, 255))
+        image.paste((0, 0, 0), (2, 0, 4, 2))
+
+        data = ffmpeg.rgb_to_yuv420(image)
+        self.assertEqual(len(data), 4 * 2 + 2 * 2)
+        self.assertEqual(list(data[:8]), [235, 235, 16, 16] * 2)
+        self.assertEqual(list(data[8:]), [128] * 4)
+
+    def test_rgb_to_yuv420_nv12(self):
+        image = PIL.Image.new("RGB", (2, 2), (255, 0, 0))
+
+        planar = ffmpeg.rgb_to_yuv420(image)
+        nv12 = ffmpeg.rgb_to_yuv420(image, nv12 = True)
+        self.assertEqual(planar[:4], nv12[:4])
+        self.assertEqual(nv12[4:], bytes([planar[4], planar[5]]))
+        for a, b in zip(planar, [81] * 4 + [90, 240]):
+            self.assertAlmostEqual(a, b, delta = 1)
+
+    def test_odd_size(self):
+        with self.assertRaises(ValueError):
+            ffmpeg.FfmpegWriter("unused.mp4", (3, 2), 10,
+                                pixel_format = ffmpeg.PixelFormat.NV12)
+
+@unittest.skipIf(not testbase.has_ffmpeg(), "ffmpeg not available")
+class TestFfmpegWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pixel_formats(self):
+        for pixel_format in ffmpeg.PixelFormat:
+            with self.subTest(pixel_format = pixel_format):
+                path = os.path.join(self.tmp.name,
+                                    "%s.mp4" % pixel_format.name)
+                with ffmpeg.FfmpegWriter(path, (64, 48), 10,
+                                         pixel_format = pixel_format,
+                                         preset = "ultrafast",
+                                         crf = 0) as writer:
+                    for n in range(5):
+                        writer.write_frame(
+                            PIL.Image.new("RGB", (64, 48), (200, 50, 50)))
+
+                with ffmpeg.FfmpegReader(path) as reader:
+                    pixel = reader.get_frame(0.25).getpixel((32, 24))
+                    for a, b in zip(pixel, (200, 50, 50)):
+                        self.assertAlmostEqual(a, b, delta = 4)
+
+    def test_io_stats(self):
+        path = os.path.join(self.tmp.name, "out.mp4")
+        frame = PIL.Image.new("RGB", (640, 480))
+
+        with ffmpeg.FfmpegWriter(path, (640, 480), 10, preset = "ultrafast") as writer:
+            writer.write_frame(frame)
+
+        # the first frame is part of the startup
+        self.assertEqual(writer.io.frames, 1)
+        self.assertGreater(writer.io.startup_time, 0)
+        self.assertEqual(writer.io.blocked_time, 0)
+
+    def test_renditions(self):
+        renditions = [
+            ffmpeg.Rendition(os.path.join(self.tmp.name, "full.mp4")),
+            ffmpeg.Rendition(os.path.join(self.tmp.name, "half.mp4"),
+                             width = 32),
+            ffmpeg.Rendition(os.path.join(self.tmp.name, "small.mp4"),
+                             width = 16, height = 16, crf = 30)]
+
+        with ffmpeg.FfmpegWriter(None, (64, 48), 10,
+                                 preset = "ultrafast",
+                                 threads = 2,
+                                 renditions = renditions) as writer:
+            for n in range(5):
+                writer.write_frame(PIL.Image.new("RGB", (64, 48)))
+
+        probes = [ffmpeg.Ffprobe(r.filename) for r in renditions]
+        self.assertEqual([p.size for p in probes], [(64, 48), (32, 24), (16, 16)])
+        self.assertEqual([p.pix_fmt for p in probes], ["yuv420p"] * 3)
+
+    def test_hls(self):
+        path = os.path.join(self.tmp.name, "stream.m3u8")
+
+        with ffmpeg.FfmpegWriter(path, (64, 48), 10,
+                                 preset = "ultrafast",
+                                 output_format = ffmpeg.OutputFormat.HLS,
+                                 segment_duration = 1) as writer:
+            for n in range(40):
+                writer.write_frame(PIL.Image.new("RGB", (64, 48)))
+
+            # segments are published while still writing
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                if os.path.exists(path):
+                    with open(path) as f:
+                        if "#EXTINF" in f.read():
+                            break
+                time.sleep(0.05)
+            else:
+                self.fail("no segment published")
+
+        with open(path) as f:
+            playlist = f.read()
+        self.assertEqual(playlist.count("#EXTINF"), 4)
+        self.assertIn("#EXT-X-ENDLIST", playlist)
+        self.assertEqual(writer.output_pixel_format, "yuv420p")
+
+    def test_fragmented_mp4(self):
+        path = os.path.join(self.tmp.name, "stream.mp4")
+
+        with ffmpeg.FfmpegWriter(path, (64, 48), 10,
+                                 preset = "ultrafast",
+                                 output_format = "fragmented_mp4",
+                                 segment_duration = 1) as writer:
+            for n in range(30):
+                writer.write_frame(PIL.Image.new("RGB", (64, 48)))
+
+        self.assertAlmostEqual(ffmpeg.Ffprobe(path).duration, 3, delta = 0.2)
+        self.assertEqual(ffmpeg.Ffprobe(path).pix_fmt, "yuv420p")
+
+    def test_output_pixel_format(self):
+        path = os.path.join(self.tmp.name, "stream.mp4")
+
+        with ffmpeg.FfmpegWriter(path, (64, 48), 10,
+                                 preset = "ultrafast",
+                                 output_format = "fragmented_mp4",
+                                 output_pixel_format = "yuv444p") as writer:
+            writer.write_frame(PIL.Image.new("RGB", (64, 48)))
+
+        self.assertEqual(ffmpeg.Ffprobe(path).pix_fmt, "yuv444p")
@@ -0,0 +1,118 @@
+import kmvid.data.clip as clip
+import kmvid.data.effect as effect
+import kmvid.data.profiler as profiler
+import kmvid.data.project as project
+import kmvid.data.resource as resource
+import kmvid.data.variable as variable
+
+import PIL.Image
+import json
+import os.path
+import tempfile
+import unittest
+
+class TestProfiler(unittest.TestCase):
+    def _make_project(self):
+        p = project.Project(width = 40, height = 30, fps = 10, duration = 1)
+        c = clip.color(color = (255, 0, 0), width = 10, height = 10)
+        c.add(effect.Pos(x = 5, y = 5))
+        c.add(effect.Blur())
+        p.add(c)
+        return p
+
+    def test_profile(self):
+        p = self._make_project()
+        apply = effect.Blur.apply
+
+        with profiler.Profiler() as prof:
+            self.assertIsNot(effect.Blur.apply, apply)
+            list(p.iter_frames(0, 0.3))
+
+        self.assertIs(effect.Blur.apply, apply)
+
+        stats = {(s.kind, s.name): s for s in prof.get_stats()}
+        self.assertEqual(stats[('effect', 'Blur')].count, 3)
+        self.assertEqual(stats[('effect', 'Blur')].pixels, 3 * 10 * 10)
+        self.assertEqual(stats[('clip', 'Clip')].count, 6)
+        self.assertEqual(stats[('resource', 'ColorResource')].count, 6)
+
+        for s in stats.values():
+            self.assertLessEqual(s.self_total, s.total)
+
+        by_node = prof.get_stats(by_node = True)
+        self.assertEqual(len([s for s in by_node if s.name == 'Clip']), 2)
+
+        frames = prof.get_frames()
+        self.assertEqual([round(f[0], 2) for f in frames], [0, 0.1, 0.2])
+        self.assertIn('Blur', frames[0][2])
+
+        self.assertIn('Blur', prof.get_summary())
+
+    def test_trace(self):
+        p = self._make_project()
+
+        with profiler.Profiler() as prof:
+            p.get_frame(0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            prof.save_trace(path)
+            with open(path) as f:
+                trace = json.load(f)
+
+        names = [e['name'] for e in trace['traceEvents']]
+        self.assertIn('Blur', names)
+        self.assertIn('Frame', names)
+        for e in trace['traceEvents']:
+            self.assertEqual(e['ph'], 'X')
+            self.assertGreaterEqual(e['dur'], 0)
+
+@variable.holder
+class LeakingEffect(effect.Effect):
+    def __init__(self):
+        effect.Effect.__init__(self)
+
+    def apply(self, render):
+        key = ("leak", len(resource.image_cache._images))
+        resource.image_cache._images[key] = PIL.Image.new("RGB", (100, 100))
+
+class TestMemoryProfiler(unittest.TestCase):
+    def tearDown(self):
+        resource.image_cache.clear()
+
+    def test_samples(self):
+        p = project.Project(width = 40, height = 30, fps = 10, duration = 1)
+        c = clip.color(color = (255, 0, 0), width = 10, height = 10)
+        p.add(c)
+
+        get_frame_internal = clip.Clip._get_frame_internal
+        with profiler.MemoryProfiler(every = 2) as mem:
+            list(p.iter_frames(0, 0.95))
+        self.assertIs(clip.Clip._get_frame_internal, get_frame_internal)
+
+        self.assertEqual(mem.frames, 10)
+        self.assertEqual([s.frame for s in mem.samples], [1, 3, 5, 7, 9])
+        self.assertEqual(mem.samples[0].image_bytes["clip %s ColorResource" % c.global_id],
+                         10 * 10 * 3)
+        self.assertGreater(mem.samples[-1].rss_bytes, 0)
+        self.assertIsNotNone(mem.samples[-1].traced_bytes)
+        self.assertNotIn("images", [l[0].split()[0] for l in mem.get_leaks()])
+
+    def test_leak(self):
+        p = project.Project(width = 40, height = 30, fps = 10, duration = 1)
+        p.add(clip.color(color = (255, 0, 0), width = 10, height = 10)
+              .add(LeakingEffect()))
+
+        with profiler.MemoryProfiler(every = 2, trace = False) as mem:
+            list(p.iter_frames(0, 0.95))
+
+        leaks = {name: (before, after) for name, before, after in mem.get_leaks()}
+        self.assertEqual(leaks["images image_cache"], (100 * 100 * 3, 9 * 100 * 100 * 3))
+        self.assertIn("images image_cache", mem.get_summary())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "memory.json")
+            mem.save(path)
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(len(data['samples']), 5)
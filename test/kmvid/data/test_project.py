@@ -0,0 +1,373 @@
+import kmvid.data.analysis as analysis
+import kmvid.data.clip as clip
+import kmvid.data.common as common
+import kmvid.data.effect as effect
+import kmvid.data.expression as expression
+import kmvid.data.ffmpeg as ffmpeg
+import kmvid.data.project as project
+import kmvid.data.resource as resource
+import kmvid.data.state as state
+import kmvid.data.stats as stats
+
+import testbase
+
+import PIL.ImageChops
+import PIL.ImageStat
+import collections
+import fractions
+import json
+import os.path
+import tempfile
+import unittest
+
+class TestProject(testbase.Testbase):
+    def _make_project(self):
+        p = project.Project(width = 40, height = 30, fps = 10, duration = 1)
+        c = clip.color(color = (255, 0, 0), width = 10, height = 10)
+        c.add(effect.Pos(x = expression.parse(('*', 'time', 20))))
+        p.add(c)
+        return p
+
+    def test_iter_frames(self):
+        p = self._make_project()
+
+        frames = list(p.iter_frames(0.2, 0.6))
+        self.assertEqual(len(frames), 4)
+        for n, frame in enumerate(frames):
+            with self.subTest(n = n):
+                expected = p.get_frame(0.2 + n * 0.1)
+                self.assertEqual(frame.tobytes(), expected.tobytes())
+        self.assertNotEqual(frames[0].tobytes(), frames[-1].tobytes())
+
+        self.assertIsNone(state.resource_manager)
+
+    def test_iter_frames_step(self):
+        p = self._make_project()
+        self.assertEqual(len(list(p.iter_frames(step = 0.25))), 4)
+
+    def test_iter_frames_count(self):
+        p = self._make_project()
+        self.assertEqual(len(list(p.iter_frames(0, 1))), 10)
+        self.assertEqual(len(list(p.iter_frames(0.1, 0.3))), 2)
+        self.assertEqual(len(list(p.iter_frames(step = 0.1))), 10)
+
+        long = project.Project(width = 40, height = 30, fps = 29.97, duration = 600)
+        self.assertEqual(long.analyze().frames, 17983)
+        self.assertEqual(long.get_frame_count(), 17983)
+        self.assertEqual(project.ProgressTracker(long).total_frames, 17983)
+
+    def test_frame_rate(self):
+        self.assertEqual(project.Project(fps = 25).get_frame_rate(), 25)
+        self.assertEqual(project.Project(fps = 29.97).get_frame_rate(),
+                         fractions.Fraction(30000, 1001))
+        self.assertEqual(project.Project(fps = 23.976).get_frame_rate(),
+                         fractions.Fraction(24000, 1001))
+        self.assertEqual(project.Project(fps = 12.5).get_frame_rate(),
+                         fractions.Fraction(25, 2))
+        self.assertEqual(common.to_rational("30000/1001"),
+                         fractions.Fraction(30000, 1001))
+        self.assertEqual(common.to_rational((60, 1)), 60)
+
+        rate = fractions.Fraction(30000, 1001)
+        for n in (0, 1, 299, 17982, 10 ** 6):
+            with self.subTest(n = n):
+                self.assertEqual(common.get_frame_index(common.get_frame_time(n, rate),
+                                                        rate), n)
+
+    def test_iter_frames_numpy(self):
+        p = self._make_project()
+
+        frame = next(p.iter_frames(fmt = "numpy"))
+        self.assertEqual(frame.shape, (30, 40, 3))
+        self.assertEqual(tuple(frame[5, 5]), (255, 0, 0))
+
+    def test_openmetrics_labels(self):
+        metrics = {key: None for _, _, _, key in project._OPENMETRICS}
+        metrics.update(name = 'Ålesund "final"\\cut\n2', frame = 3,
+                       counters = {'ffprobe': 1})
+
+        text = project._to_openmetrics(metrics)
+        label = 'name="Ålesund \\"final\\"\\\\cut\\n2"'
+        self.assertIn('kmvid_frames_total{%s} 3.0' % label, text)
+        self.assertIn('kmvid_operations_total{%s,operation="ffprobe"} 1.0' % label,
+                      text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+    def test_iter_frames_close(self):
+        p = self._make_project()
+
+        frames = p.iter_frames()
+        next(frames)
+        self.assertIsNotNone(state.resource_manager)
+        frames.close()
+        self.assertIsNone(state.resource_manager)
+
+    def test_frame_wall(self):
+        p = self._make_project()
+        times = [0.9, 0.1, 0.5, 0.3]
+
+        wall = p.get_frame_wall(width = 80, cols = 2, frame_selection = times)
+        self.assertEqual(wall.size, (80, 60))
+        for n, t in enumerate(times):
+            with self.subTest(time = t):
+                tile = wall.crop(((n % 2) * 40, (n // 2) * 30,
+                                  (n % 2) * 40 + 40, (n // 2) * 30 + 30))
+                self.assertEqual(tile.tobytes(), p.get_frame(t).tobytes())
+
+        parallel = p.get_frame_wall(width = 80, cols = 2,
+                                    frame_selection = times, workers = 2)
+        self.assertEqual(parallel.tobytes(), wall.tobytes())
+
+    def test_render_scale(self):
+        p = project.Project(width = 200, height = 100, fps = 10, duration = 1)
+        c = clip.color(color = (255, 0, 0), width = 80, height = 40)
+        c.add(effect.Pos(x = 20, y = expression.parse(('*', 'height', 0.5))))
+        c.add(effect.Draw()
+              .config(fill = (0, 0, 255))
+              .rectangle(10, 10, 20, 20))
+        c.add(effect.Border(width = 4, color = (0, 255, 0)))
+        p.add(c)
+
+        full = p.get_frame(0.5).resize((100, 50))
+
+        p.render_scale = 0.5
+        self.assertEqual(p.get_render_size(), (100, 50))
+        half = p.get_frame(0.5)
+        self.assertEqual(half.size, (100, 50))
+
+        diff = PIL.ImageChops.difference(full, half).convert("L")
+        self.assertLess(PIL.ImageStat.Stat(diff).mean[0], 3)
+
+        with p.session(render_scale = 1) as s:
+            self.assertEqual(s.get_frame(0.5).size, (200, 100))
+
+    def test_session_invalidate(self):
+        p = self._make_project()
+        red = p.root_clip.items[0]
+
+        with p.session() as s:
+            self.assertEqual(s.get_frame(0).getpixel((0, 0)), (255, 0, 0))
+
+            red.resource.color = (0, 255, 0)
+            self.assertEqual(s.get_frame(0).getpixel((0, 0)), (255, 0, 0))
+
+            s.invalidate(red)
+            self.assertEqual(s.get_frame(0).getpixel((0, 0)), (0, 255, 0))
+
+            red.resource.color = (0, 0, 255)
+            s.invalidate()
+            self.assertEqual(s.get_frame(0).getpixel((0, 0)), (0, 0, 255))
+
+        self.assertIsNone(red.resource.image)
+
+    def test_session_invalidate_images(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "image.png")
+            PIL.Image.new("RGB", (40, 30), (0, 255, 0)).save(path)
+
+            p = project.Project(width = 40, height = 30, fps = 10, duration = 1)
+            img = clip.image(path)
+            p.add(img)
+
+            with p.session() as s:
+                s.get_frame(0)
+                self.assertTrue(resource.image_cache.contains(path))
+                s.invalidate(img)
+                self.assertFalse(resource.image_cache.contains(path))
+
+@unittest.skipIf(not testbase.has_ffmpeg(), "ffmpeg not available")
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = testbase.make_video(os.path.join(self.tmp.name, "video.mp4"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_analyze(self):
+        p = project.Project(width = 64, height = 48, fps = 10, duration = 1.95)
+        fast = clip.video(self.path, start_time = 0.5)
+        fast.time.set_speed(3)
+        p.add(clip.video(self.path), fast)
+
+        a = p.analyze()
+        with stats.Recording() as rec:
+            list(p.iter_frames())
+
+        self.assertEqual(a.frames, 20)
+        self.assertEqual(a.concurrent_readers, {self.path: 2})
+        self.assertEqual(a.peak_open_decoders, 2)
+        self.assertEqual(a.peak_open_resources, 3)
+
+        spawns = sum((r.spawns for r in a.resources), collections.Counter())
+        self.assertEqual(sum(spawns.values()), rec.get("ffmpeg_spawn"))
+        for reason, count in spawns.items():
+            self.assertEqual(count, rec.get("ffmpeg_spawn_" + reason))
+
+        plain = a.resources[1]
+        self.assertEqual(plain.sequential, 19)
+        self.assertEqual(plain.get_restarts(), 0)
+        self.assertEqual(a.resources[2].skips, a.resources[2].accesses - 1)
+
+    def test_analyze_jumps(self):
+        root = clip.video(self.path)
+        times = [0.05, 0.15, 2.55, 0.35, 0.25, 0.15, 2.95]
+
+        a = analysis.analyze(root, times, 10)
+        with stats.Recording() as rec:
+            with state.State():
+                for t in times:
+                    state.set_time(t)
+                    root.get_frame()
+
+        video = a.resources[0]
+        self.assertEqual(video.backward_jumps, 3)
+        self.assertEqual(video.skips, 2)
+        self.assertEqual(dict(video.spawns), {'first_use': 1, 'reverse_chunk': 1})
+        self.assertEqual(rec.get("ffmpeg_spawn_reverse_chunk"), 1)
+        self.assertEqual(rec.get("ffmpeg_spawn"), 2)
+        self.assertIn("1 estimated decoder restarts", a.get_summary())
+
+    def test_warm_reader(self):
+        p = project.Project(width = 64, height = 48, fps = 10)
+        p.add(clip.video(self.path))
+
+        times = (0.5, 0.55, 0.6, 0.65, 0.7)
+
+        stats.reset()
+        expected = [p.get_frame(t).tobytes() for t in times]
+        self.assertEqual(stats.get("ffmpeg_spawn"), len(times))
+
+        stats.reset()
+        with p.session() as s:
+            for t, frame in zip(times, expected):
+                self.assertEqual(s.get_frame(t).tobytes(), frame)
+        self.assertEqual(stats.get("ffmpeg_spawn"), 1)
+
+    def test_proxy(self):
+        old_cache_dir = ffmpeg._CACHE_DIR
+        ffmpeg._CACHE_DIR = os.path.join(self.tmp.name, "cache")
+        try:
+            p = project.Project(width = 64, height = 48, fps = 10, render_scale = 0.5)
+            p.add(clip.video(self.path))
+            video = p.root_clip.items[0].resource
+            times = (2.5, 0.5)
+            original = [p.get_frame(t) for t in times]
+            with p.session(render_scale = 1) as s:
+                full = s.get_frame(0.5)
+
+            p.proxy_height = 24
+            p.make_proxies()
+            self.assertEqual(
+                len(os.listdir(os.path.join(ffmpeg._CACHE_DIR, "proxies"))), 1)
+
+            def difference(a, b):
+                diff = PIL.ImageChops.difference(a, b).convert("L")
+                return PIL.ImageStat.Stat(diff).mean[0]
+
+            stats.reset()
+            with p.session() as s:
+                proxy = [s.get_frame(t) for t in times]
+                self.assertNotEqual(video.reader.filename, self.path)
+                self.assertEqual(video.reader.size, (32, 24))
+            self.assertEqual(stats.get("ffmpeg_spawn"), 2)
+
+            for n in range(len(times)):
+                self.assertEqual(proxy[n].size, original[n].size)
+                self.assertNotEqual(proxy[n].tobytes(), original[n].tobytes())
+                self.assertLess(difference(proxy[n], original[n]),
+                                difference(proxy[n], original[1 - n]))
+
+            # proxies are never scaled up
+            with p.session(render_scale = 1) as s:
+                self.assertEqual(s.get_frame(0.5).tobytes(), full.tobytes())
+                self.assertEqual(video.reader.filename, self.path)
+                self.assertEqual(video.reader.size, (64, 48))
+
+            # final renders use the original
+            p.render_scale = 1
+            frames = list(p.iter_frames(0.5, 0.6))
+            self.assertEqual(frames[0].tobytes(), full.tobytes())
+        finally:
+            ffmpeg._CACHE_DIR = old_cache_dir
+
+    def test_proxy_full_scale(self):
+        old_cache_dir = ffmpeg._CACHE_DIR
+        ffmpeg._CACHE_DIR = os.path.join(self.tmp.name, "cache")
+        try:
+            p = project.Project(width = 64, height = 48, fps = 10,
+                                proxy_height = 24)
+            p.add(clip.video(self.path))
+            video = p.root_clip.items[0].resource
+
+            with stats.Recording() as rec:
+                with p.session() as s:
+                    s.get_frame(0.5)
+                    self.assertEqual(video.reader.filename, self.path)
+                    self.assertEqual(video.reader.size, (64, 48))
+                list(p.iter_frames(0.5, 0.7))
+
+            self.assertEqual(rec.get("ffmpeg_spawn_proxy"), 0)
+            self.assertFalse(os.path.exists(ffmpeg._CACHE_DIR))
+        finally:
+            ffmpeg._CACHE_DIR = old_cache_dir
+
+    def test_write_error(self):
+        p = project.Project(width = 64, height = 48, fps = 10, duration = 1,
+                            preset = "ultrafast",
+                            filename = os.path.join(self.tmp.name, "out.mp4"))
+        p.add(clip.video(self.path))
+
+        def write_frame(writer, image):
+            raise RuntimeError("write failed")
+
+        old_write_frame = ffmpeg.FfmpegWriter.write_frame
+        ffmpeg.FfmpegWriter.write_frame = write_frame
+        try:
+            p.write()
+            self.fail("write did not raise")
+        except RuntimeError:
+            # checked while the traceback still holds the render frames
+            self.assertIsNone(state.resource_manager)
+            self.assertEqual(state.render_scale, 1)
+        finally:
+            ffmpeg.FfmpegWriter.write_frame = old_write_frame
+
+    def test_metrics(self):
+        p = project.Project(width = 64, height = 48, fps = 10, duration = 1,
+                            preset = "ultrafast",
+                            filename = os.path.join(self.tmp.name, "out.mp4"))
+        p.add(clip.video(self.path))
+
+        metrics_file = os.path.join(self.tmp.name, "metrics.jsonl")
+        openmetrics_file = os.path.join(self.tmp.name, "metrics.prom")
+        reports = []
+
+        p.write(metrics_file = metrics_file,
+                metrics_callback = reports.append,
+                openmetrics_file = openmetrics_file)
+
+        with open(metrics_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines, reports)
+
+        last = lines[-1]
+        self.assertTrue(last['done'])
+        self.assertEqual(last['eta'], 0)
+        self.assertGreaterEqual(last['frame'], 10)
+        self.assertGreater(last['render_seconds'], 0)
+        self.assertGreater(last['write_seconds'], 0)
+        self.assertEqual(last['ffmpeg_processes'], 0)
+        self.assertEqual(ffmpeg.get_process_count(), 0)
+        self.assertEqual(last['counters']['ffmpeg_spawn_writer'], 1)
+        self.assertGreater(last['counters']['encoder_bytes'], 0)
+        self.assertGreater(last['decoder_startup_seconds'], 0)
+        self.assertGreater(last['encoder_startup_seconds'], 0)
+        self.assertGreater(last['encoder_blocked_seconds'], 0)
+        self.assertEqual(last['decoder_seeks'], 0)
+
+        with open(openmetrics_file) as f:
+            text = f.read()
+        self.assertIn('kmvid_frames_total{name=', text)
+        self.assertIn('operation="ffmpeg_spawn_writer"} 1.0', text)
+        self.assertTrue(text.endswith("# EOF\n"))
@@ -1,8 +1,15 @@
+import kmvid.data.clip as clip
 import kmvid.data.resource as resource
+import kmvid.data.state as state
 
 import itertools
+import math
+import os.path
+import tempfile
 import testbase
 
+import PIL.Image
+
 class TestResource(testbase.Testbase):
     def test_clear(self):
         tm = resource.TimeMap(10)
@@ -111,3 +118,156 @@ class TestResource(testbase.Testbase):
         self.assertEqual(tm.get(2), 4)
         self.assertEqual(tm.get(5), None)
         self.assertEqual(tm.get_duration(), 5)
+
+    def test_get_many(self):
+        tm = resource.TimeMap(10)
+        tm.set_crop_start(2)
+        tm.set_crop_end(1)
+        tm.set_speed(2)
+
+        times = [-1, 0, 0.3, 1, 2.5, 3.4, 3.5, 4, 100]
+        expected = [tm.get(t) for t in times]
+        result = tm.get_many(times)
+
+        for t, e, r in zip(times, expected, result):
+            with self.subTest(time=t):
+                if e is None:
+                    self.assertTrue(math.isnan(r))
+                else:
+                    self.assertAlmostEqual(e, r)
+
+    def test_compiled_cache(self):
+        tm = resource.TimeMap(10)
+        self.assertIs(tm.compile(), tm.compile())
+        self.assertEqual(tm.get(4), 4)
+
+        tm.set_speed(2)
+        self.assertEqual(tm.get(4), 8)
+
+class TestImageCache(testbase.Testbase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.jpg = os.path.join(self.tmp.name, "image.jpg")
+        self.png = os.path.join(self.tmp.name, "image.png")
+        PIL.Image.new("RGB", (400, 200), (200, 10, 10)).save(self.jpg)
+        PIL.Image.new("RGB", (400, 200), (10, 200, 10)).save(self.png)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_shared(self):
+        cache = resource.ImageCache()
+
+        a = cache.get(self.png)
+        b = cache.get(self.png)
+        self.assertIs(a, b)
+        self.assertEqual(cache.current_bytes, 400 * 200 * 3)
+
+        self.assertIsNot(a, cache.get(self.png, mode="RGBA"))
+        self.assertIsNot(a, cache.get(self.png, scale=0.5))
+
+    def test_scale(self):
+        cache = resource.ImageCache()
+
+        for path in [self.jpg, self.png]:
+            for scale, size in [(0.5, (200, 100)),
+                                (0.25, (100, 50)),
+                                (0.3, (120, 60)),
+                                (1, (400, 200))]:
+                with self.subTest(path=path, scale=scale):
+                    self.assertEqual(cache.get(path, scale=scale).size, size)
+
+    def test_eviction(self):
+        cache = resource.ImageCache(max_bytes=400 * 200 * 3)
+
+        a = cache.get(self.png)
+        cache.get(self.jpg)
+        self.assertEqual(cache.current_bytes, 400 * 200 * 3)
+        self.assertIsNot(a, cache.get(self.png))
+
+        cache.max_bytes = 10
+        self.assertIsNot(cache.get(self.jpg), cache.get(self.jpg))
+
+    def test_modified(self):
+        cache = resource.ImageCache()
+        self.assertEqual(cache.get(self.png).getpixel((0, 0)), (10, 200, 10))
+
+        PIL.Image.new("RGB", (400, 200), (10, 10, 200)).save(self.png)
+        st = os.stat(self.png)
+        os.utime(self.png, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertEqual(cache.get(self.png).getpixel((0, 0)), (10, 10, 200))
+
+        cache.remove([self.png])
+        self.assertEqual(cache.current_bytes, 0)
+        self.assertFalse(cache.contains(self.png))
+
+    def test_resource(self):
+        res = resource.ImageResource(self.png, mode="RGBA", scale=0.5)
+
+        self.assertEqual(res.get_info().width, 200)
+        self.assertEqual(res.get_info().height, 100)
+
+        frame = res.get_frame(0)
+        self.assertEqual(frame.size, (200, 100))
+        self.assertEqual(frame.mode, "RGBA")
+        self.assertIs(res.get_frame(0), frame)
+        self.assertTrue(resource.image_cache.contains(self.png, "RGBA", 0.5))
+
+class TestImageSequence(testbase.Testbase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "shot_%04d.png")
+        for n in range(3, 13):
+            PIL.Image.new("L", (8, 4), n).save(self.path % n)
+        PIL.Image.new("L", (8, 4), 99).save(self.path % 20)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_info(self):
+        res = resource.from_file(self.path, fps=5)
+        self.assertIsInstance(res, resource.ImageSequenceResource)
+
+        info = res.get_info()
+        self.assertEqual(info.width, 8)
+        self.assertEqual(info.height, 4)
+        self.assertEqual(info.fps, 5)
+        self.assertEqual(info.duration, 2)
+
+    def test_frames(self):
+        res = resource.ImageSequenceResource(self.path, fps=5, prefetch=2, cache_size=4)
+        try:
+            for time, value in [(0, 3), (0.1, 3), (0.2, 4), (1.9, 12), (0.4, 5)]:
+                with self.subTest(time=time):
+                    self.assertEqual(res.get_frame(time).getpixel((0, 0)), value)
+                    self.assertLessEqual(len(res._frames), 4)
+
+            self.assertIsNone(res.get_frame(2))
+            self.assertIsNone(res.get_frame(-1))
+        finally:
+            res.close()
+
+    def test_time_map(self):
+        c = clip.image_sequence(self.path, fps=5)
+        c.time.set_speed(2)
+        self.assertEqual(c.duration, 1)
+
+        with state.State():
+            state.set_time(0.5)
+            self.assertEqual(c.get_frame().image.getpixel((0, 0)), 8)
+
+    def test_source_time_map(self):
+        outer = clip.color(start_time=2)
+        inner = clip.color(start_time=3)
+        leaf = clip.image_sequence(self.path, fps=5, start_time=1)
+        leaf.time.set_crop_start(0.5)
+        outer.add(inner.add(leaf))
+
+        stm = leaf.get_source_time_map()
+        self.assertEqual(stm.get(5), None)
+        self.assertEqual(stm.get(6), 0.5)
+        self.assertEqual(stm.get(7), 1.5)
+        self.assertEqual(stm.get(7.5), None)
+        self.assertEqual(list(stm.get_many([6, 7])), [0.5, 1.5])
+
+        self.assertIsNone(inner.get_source_time_map())
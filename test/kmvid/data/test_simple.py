@@ -16,6 +16,7 @@ class TestSimple(unittest.TestCase):
 
             clip.color(),
             clip.image("/path"),
+            clip.image_sequence("/path_%d.png"),
             clip.video("/path"),
 
             draw.Config(color=(1, 2, 3), fill=(4, 5, 6), pen_width=10),
@@ -38,6 +39,7 @@ class TestSimple(unittest.TestCase):
 
             resource.ColorResource(),
             resource.ImageResource("a.jpg"),
+            resource.ImageSequenceResource("a_%04d.png", fps=24),
             resource.VideoResource("a.mp4"),
             resource.MappingEntry(2, 3, 5),
             resource.TimeMap(5),
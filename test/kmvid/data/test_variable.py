@@ -136,6 +136,22 @@ class TestVariable(testbase.Testbase):
         self.assertEqual(var.start_time, 10)
         self.assertEqual(var.time_type, variable.TimeValueType.LINEAR)
 
+    def test_scaled_values(self):
+        cfg = variable.VariableConfig(vartype=int, default=10, scaled=True)
+        var = variable.Variable(cfg)
+
+        path_cfg = variable.VariableConfig(scaled=True)
+        path = variable.Variable(path_cfg)
+        path.set_value([(10, 20), (1, 0.5)])
+
+        self.assertEqual(10, var.get_value())
+        with state.State(render_scale = 0.25):
+            self.assertEqual(2, var.get_value())
+            var.set_value(1)
+            self.assertEqual(1, var.get_value())
+            self.assertEqual([(2, 5), (1, 0.125)], path.get_value())
+        self.assertEqual(1, var.get_value())
+
     def test_expression_values(self):
         with state.State():
             c = clip.color(color=(30, 30, 30), width=100, height=100)
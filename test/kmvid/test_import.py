@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+import unittest
+
+_CODE = """
+import subprocess
+import sys
+
+def popen(*args, **kwargs):
+    raise AssertionError("subprocess spawned during import: %s" % str(args))
+subprocess.Popen = popen
+
+import kmvid.script
+
+print(",".join(m for m in ("numpy", "scipy") if m in sys.modules))
+"""
+
+class TestImport(unittest.TestCase):
+    def test_lazy_import(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+
+        result = subprocess.run([sys.executable, "-c", _CODE],
+                                capture_output = True,
+                                text = True,
+                                env = env)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "")
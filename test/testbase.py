@@ -1,8 +1,11 @@
 import kmvid.data.clip as clip
+import kmvid.data.ffmpeg as ffmpeg
 import kmvid.data.state as state
 
 import os
 import os.path
+import shutil
+import subprocess
 import unittest
 
 import PIL.Image
@@ -95,6 +98,22 @@ def _get_tc_filename(test_obj, tc_id):
 
     return f"{test_obj.__module__}__{test_obj.__class__.__name__}__{id}.png"
 
+def has_ffmpeg():
+    return (shutil.which(ffmpeg._FFMPEG_PATH) is not None and
+            shutil.which(ffmpeg._FFPROBE_PATH) is not None)
+
+def make_video(path, duration=3, fps=10, size=(64, 48)):
+    """Generates a test video with ffmpeg."""
+    subprocess.run([ffmpeg._FFMPEG_PATH,
+                    '-y', '-loglevel', 'quiet',
+                    '-f', 'lavfi',
+                    '-i', 'testsrc=size=%dx%d:rate=%d' % (size[0], size[1], fps),
+                    '-t', str(duration),
+                    '-pix_fmt', 'yuv420p',
+                    path],
+                   check = True)
+    return path
+
 class Testbase(unittest.TestCase):
     def assertImage(self, tc_id, image_or_clip):
         image = image_or_clip